@@ -0,0 +1,97 @@
+from collections import Counter
+
+from sqlalchemy import and_, select
+
+from importer import validate_row
+from models import Category, CategoryStat, db, notify_change, Question
+
+# Rows per INSERT or DELETE ... IN statement, to stay below the bound parameter limit of older SQLite versions
+CHUNK_SIZE = 200
+
+
+def chunks(items, size=CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def insert_rows(rows):
+    """
+    Inserts rows with one multi-row INSERT per chunk and returns their ids in the same order
+    """
+    table = Question.__table__
+    ids = []
+    for chunk in chunks(rows):
+        statement = table.insert().values(chunk)
+        if db.engine.dialect.full_returning:
+            ids += db.session.execute(statement.returning(table.c.id)).scalars().all()
+        else:
+            # SQLite holds the write lock for the whole statement and numbers its rows consecutively
+            last_id = db.session.execute(statement).lastrowid
+            ids += range(last_id - len(chunk) + 1, last_id + 1)
+    return ids
+
+
+def create_questions(items):
+    """
+    Validates items like POST /questions and inserts the valid ones in one transaction.
+    Returns a result per item: the id of the created question or the reason it was rejected.
+    """
+    category_ids = {category_id for category_id, in db.session.query(Category.id)}
+    results = []
+    rows = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("not an object")
+            rows.append(validate_row(item, category_ids))
+            results.append({"index": index, "status": "created"})
+        except ValueError as exception:
+            results.append({"index": index, "status": "rejected", "error": str(exception)})
+    if rows:
+        ids = iter(insert_rows(rows))
+        CategoryStat.adjust(Counter((row["category_id"], row["difficulty"]) for row in rows))
+        db.session.commit()
+        for result in results:
+            if result["status"] == "created":
+                result["id"] = next(ids)
+        notify_change("questions", "bulk")
+    return results
+
+
+def delete_rows(condition):
+    """
+    Deletes the questions matching condition and returns their (id, category_id, difficulty) rows
+    """
+    table = Question.__table__
+    columns = (table.c.id, table.c.category_id, table.c.difficulty)
+    if db.engine.dialect.full_returning:
+        return db.session.execute(table.delete().where(condition).returning(*columns)).all()
+    rows = db.session.execute(select(*columns).where(condition)).all()
+    for chunk in chunks([row.id for row in rows]):
+        db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+    return rows
+
+
+def delete_questions(ids=None, category_id=None, difficulty=None):
+    """
+    Deletes the questions of ids, or those matching the category and difficulty filters,
+    in one transaction. Returns the ids of the deleted questions.
+    """
+    table = Question.__table__
+    if ids is not None:
+        rows = []
+        for chunk in chunks(ids):
+            rows += delete_rows(table.c.id.in_(chunk))
+    else:
+        conditions = []
+        if category_id is not None:
+            conditions.append(table.c.category_id == category_id)
+        if difficulty is not None:
+            conditions.append(table.c.difficulty == difficulty)
+        rows = delete_rows(and_(*conditions))
+    deleted = Counter((row.category_id, row.difficulty) for row in rows)
+    CategoryStat.adjust({key: -count for key, count in deleted.items()})
+    db.session.commit()
+    if rows:
+        notify_change("questions", "bulk")
+    return [row.id for row in rows]
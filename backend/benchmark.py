@@ -0,0 +1,552 @@
+"""
+Benchmarks the API routes against synthetic question banks.
+
+Seeds a database with each requested bank size, drives the routes through the
+Flask test client and prints latency percentiles and throughput as JSON:
+
+    python benchmark.py --sizes 10000,100000 --categories 20 --output results.json
+    python benchmark.py --database postgresql://localhost:5432/trivia_bench --sizes 1000000
+
+Each route also reports the mean CPU time of the process per request. Passing
+--compare with an earlier output lists the CPU time change of every route, and
+reports routes whose p95 latency grew by more than --tolerance, exiting with
+status 1 if any did. --stdlib-json serializes with the standard library instead
+of orjson, to compare the two:
+
+    python benchmark.py --stdlib-json --output stdlib.json
+    python benchmark.py --compare stdlib.json
+
+Passing --concurrency also drives the read routes with that many requests in
+flight at once, through the Flask app on a thread pool and through the async
+ASGI app on one event loop, and reports both throughputs under "concurrency":
+
+    python benchmark.py --sizes 100000 --concurrency 32
+
+Passing --compression measures the CPU time and the bytes sent by the larger
+responses with each content encoding, under "compression".
+
+Passing --scores writes that many quiz answers one commit per answer and in
+batches of each flush size, and reports the answers written per second and the
+latency of POST /scores under "scores":
+
+    python benchmark.py --scores 20000
+
+Passing --fanout publishes change events to that many idle /events subscribers
+of the async app and reports the delay until every subscriber received each
+event under "fanout":
+
+    python benchmark.py --fanout 1000,10000
+
+Passing --startup times importing flaskr and calling create_app() in fresh
+interpreters, as a worker boots, and reports the medians under "startup":
+
+    python benchmark.py --startup 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serialization
+from compression import encodings
+from events import AsyncSubscriber, Broker, LoopFanout
+from flaskr import create_app
+from flaskr.asgi import create_asgi_app
+from models import Category, db, Score
+from scores import ScoreBuffer
+from stats import rebuild_category_stats
+from synthetic import insert_questions, WORDS
+
+FLUSH_SIZES = (100, 500, 2000)
+FANOUT_EVENTS = 50
+
+
+def seed(size, categories, rng):
+    """
+    Replaces the database content with categories and size synthetic questions
+    """
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Category.__table__.insert(),
+                       [{"id": index, "name": f"Category {index}"} for index in range(1, categories + 1)])
+    insert_questions(size, list(range(1, categories + 1)), rng)
+    db.session.commit()
+    rebuild_category_stats()
+
+
+def percentile(samples, fraction):
+    """
+    Nearest-rank percentile of sorted samples
+    """
+    return samples[max(0, min(len(samples) - 1, round(fraction * len(samples)) - 1))]
+
+
+def summarize(outcomes, elapsed):
+    """
+    Latency percentiles and throughput of (seconds, status code) outcomes
+    """
+    requests = len(outcomes)
+    latencies = sorted(seconds for seconds, _ in outcomes)
+    statuses = {}
+    for _, status in outcomes:
+        statuses[status] = statuses.get(status, 0) + 1
+    return {
+        "requests": requests,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / requests * 1000, 3),
+        "requests_per_second": round(requests / elapsed, 1),
+    }
+
+
+def measure(client, make_request, requests, warmup):
+    for _ in range(warmup):
+        make_request(client)
+    outcomes = []
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    for _ in range(requests):
+        request_started = time.perf_counter()
+        response = make_request(client)
+        outcomes.append((time.perf_counter() - request_started, response.status_code))
+    cpu_seconds = time.process_time() - cpu_started
+    return {**summarize(outcomes, time.perf_counter() - started), "cpu_ms": round(cpu_seconds / requests * 1000, 3)}
+
+
+def scenarios(size, categories, rng):
+    """
+    Returns (route name, request function) pairs over a bank of size questions
+    """
+    pages = max(1, size // 10)
+    deletable = rng.sample(range(1, size + 1), min(size, 10000))
+
+    def previous_questions():
+        return [rng.randint(1, size) for _ in range(5)]
+
+    return [
+        ("GET /questions", lambda client: client.get(f"/questions?page={rng.randint(1, pages)}")),
+        ("GET /categories/<id>/questions",
+         lambda client: client.get(f"/categories/{rng.randint(1, categories)}/questions")),
+        ("POST /questions (search)", lambda client: client.post("/questions", json={"searchTerm": rng.choice(WORDS)})),
+        ("POST /quizzes", lambda client: client.post("/quizzes", json={
+            "previous_questions": previous_questions(),
+            "quiz_category": {"id": rng.randint(0, categories), "name": ""}
+        })),
+        ("DELETE /questions/<id>", lambda client: client.delete(f"/questions/{deletable.pop()}")),
+    ]
+
+
+def concurrent_scenarios(size, categories, rng):
+    """
+    Returns (route name, method, path function, body function) tuples for the read routes,
+    which can run in any order and so be compared under concurrency
+    """
+    pages = max(1, size // 10)
+
+    def quiz_body():
+        return {"previous_questions": [rng.randint(1, size) for _ in range(5)],
+                "quiz_category": {"id": rng.randint(0, categories), "name": ""}}
+
+    return [
+        ("GET /questions", "GET", lambda: f"/questions?page={rng.randint(1, pages)}", lambda: None),
+        ("GET /categories/<id>/questions", "GET", lambda: f"/categories/{rng.randint(1, categories)}/questions",
+         lambda: None),
+        ("POST /quizzes", "POST", lambda: "/quizzes", quiz_body),
+    ]
+
+
+def measure_wsgi(app, method, path, body, requests, concurrency):
+    """
+    Sends requests through the Flask app from concurrency threads, each with its own test client
+    """
+    local = threading.local()
+
+    def send(_):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        started = time.perf_counter()
+        response = local.client.open(path(), method=method, json=body())
+        return time.perf_counter() - started, response.status_code
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        started = time.perf_counter()
+        outcomes = list(executor.map(send, range(requests)))
+        return summarize(outcomes, time.perf_counter() - started)
+
+
+async def asgi_request(app, method, path, body):
+    path, _, query = path.partition("?")
+    scope = {"type": "http", "method": method, "path": path, "query_string": query.encode()}
+    payload = json.dumps(body).encode() if body is not None else b""
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": payload}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]["status"]
+
+
+async def measure_asgi(app, method, path, body, requests, concurrency):
+    """
+    Sends requests to the ASGI app from one event loop, at most concurrency at a time
+    """
+    slots = asyncio.Semaphore(concurrency)
+
+    async def send():
+        async with slots:
+            started = time.perf_counter()
+            status = await asgi_request(app, method, path(), body())
+            return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    outcomes = await asyncio.gather(*(send() for _ in range(requests)))
+    return summarize(outcomes, time.perf_counter() - started)
+
+
+def run_concurrency(app, database, size, categories, requests, warmup, concurrency, rng):
+    """
+    Compares the throughput of the Flask and the async ASGI app with concurrency requests in flight
+    """
+    results = []
+    asgi_app = create_asgi_app({"SQLALCHEMY_DATABASE_URI": database, "DEBUG": False})
+
+    async def measure_all(method, path, body):
+        for _ in range(warmup):
+            await asgi_request(asgi_app, method, path(), body())
+        return await measure_asgi(asgi_app, method, path, body, requests, concurrency)
+
+    try:
+        for route, method, path, body in concurrent_scenarios(size, categories, rng):
+            for _ in range(warmup):
+                app.test_client().open(path(), method=method, json=body())
+            for server, result in (
+                    ("wsgi", measure_wsgi(app, method, path, body, requests, concurrency)),
+                    ("asgi", asyncio.run(measure_all(method, path, body)))):
+                results.append({"size": size, "route": route, "server": server, "concurrency": concurrency,
+                                **result})
+                print(f"{size:>9} {route:<32} {server} x{concurrency} p95 {result['p95_ms']:>8}ms "
+                      f"{result['requests_per_second']:>8} req/s", file=sys.stderr)
+    finally:
+        asyncio.run(asgi_app.engine.dispose())
+    return results
+
+
+def run_compression(app, size, categories, requests, seed_value):
+    """
+    Measures the CPU time per request and the mean body size of the larger responses with each
+    content encoding. The compressed body cache is turned off so that every response is compressed.
+    """
+    app.extensions["compressed_cache"].size = 0
+    client = app.test_client()
+    pages = max(1, size // 10)
+    routes = [
+        ("GET /questions", lambda rng, headers: client.get(f"/questions?page={rng.randint(1, pages)}",
+                                                           headers=headers)),
+        ("POST /questions (search)", lambda rng, headers: client.post("/questions", headers=headers,
+                                                                      json={"searchTerm": rng.choice(WORDS)})),
+        ("GET /questions/export", lambda rng, headers: client.get(
+            f"/questions/export?category={rng.randint(1, categories)}&difficulty={rng.randint(1, 5)}",
+            headers=headers)),
+    ]
+    results = []
+    for route, make_request in routes:
+        identity = None
+        for encoding in ("identity",) + encodings():
+            # Every encoding sends the same requests
+            rng = random.Random(seed_value)
+            sent = 0
+            cpu_started = time.process_time()
+            for _ in range(requests):
+                sent += len(make_request(rng, {"Accept-Encoding": encoding}).get_data())
+            cpu_ms = (time.process_time() - cpu_started) / requests * 1000
+            result = {"size": size, "route": route, "encoding": encoding, "requests": requests,
+                      "cpu_ms": round(cpu_ms, 3), "bytes": round(sent / requests)}
+            if identity is None:
+                identity = result
+            else:
+                saved_kb = (identity["bytes"] - result["bytes"]) / 1024
+                result["saved_bytes"] = identity["bytes"] - result["bytes"]
+                result["ratio"] = round(result["bytes"] / identity["bytes"], 3) if identity["bytes"] else None
+                result["extra_cpu_ms_per_saved_kb"] = \
+                    round((cpu_ms - identity["cpu_ms"]) / saved_kb, 4) if saved_kb > 0 else None
+            results.append(result)
+            print(f"{size:>9} {route:<32} {encoding:<8} cpu {result['cpu_ms']:>8}ms {result['bytes']:>9} bytes",
+                  file=sys.stderr)
+    return results
+
+
+def run_scores(app, categories, answers, requests, warmup, rng):
+    """
+    Measures the answers written per second one commit per answer, as Question.insert does,
+    and through ScoreBuffer flushes of each of FLUSH_SIZES, then the latency of POST /scores
+    """
+    rows = [{"player": f"player{rng.randrange(1000)}", "category_id": rng.randint(1, categories),
+             "question_id": rng.randint(1, answers), "correct": rng.random() < 0.6} for _ in range(answers)]
+    results = []
+    # Single commits are slow enough that a sample gives the rate
+    sample = rows[:min(answers, 1000)]
+    started = time.perf_counter()
+    for row in sample:
+        db.session.add(Score(**row))
+        db.session.commit()
+    seconds = time.perf_counter() - started
+    results.append({"mode": "commit per answer", "answers": len(sample),
+                    "answers_per_second": round(len(sample) / seconds, 1)})
+    for flush_size in FLUSH_SIZES:
+        buffer = ScoreBuffer(app, flush_size)
+        started = time.perf_counter()
+        for start in range(0, answers, flush_size):
+            buffer.pending.extend(rows[start:start + flush_size])
+            buffer.flush()
+        seconds = time.perf_counter() - started
+        results.append({"mode": f"flush of {flush_size}", "answers": buffer.flushed, "flushes": buffer.flushes,
+                        "answers_per_second": round(buffer.flushed / seconds, 1)})
+    for result in results:
+        print(f"scores {result['mode']:<20} {result['answers_per_second']:>10} answers/s", file=sys.stderr)
+
+    result = measure(app.test_client(), lambda client: client.post("/scores", json={
+        "player": f"player{rng.randrange(1000)}", "quiz_category": {"id": rng.randint(1, categories)},
+        "question_id": rng.randint(1, answers), "correct": rng.random() < 0.6}), requests, warmup)
+    results.append({"mode": "POST /scores", **result})
+    print(f"scores {'POST /scores':<20} p50 {result['p50_ms']:>8}ms p95 {result['p95_ms']:>8}ms", file=sys.stderr)
+    app.extensions["score_buffer"].flush()
+    return results
+
+
+def run_fanout(counts, events=FANOUT_EVENTS, interval=0.1):
+    """
+    Publishes events from a separate thread, as request threads do, to count subscribers waiting
+    on asyncio queues of one event loop. Reports the delay from publish to the last subscriber.
+    """
+    results = []
+    for count in counts:
+        broker = Broker()
+        published = []
+        delivered = {}
+
+        def publisher():
+            for _ in range(events):
+                published.append(time.perf_counter())
+                broker.publish("questions.changed", {})
+                time.sleep(interval)
+
+        async def consume(subscriber):
+            for _ in range(events):
+                event = await subscriber.queue.get()
+                delivered[event.id] = time.perf_counter()
+
+        async def fan_out():
+            loop = asyncio.get_running_loop()
+            fanout = LoopFanout(loop)
+            broker.subscribe(fanout)
+            subscribers = [AsyncSubscriber(events) for _ in range(count)]
+            fanout.queues.update(subscribers)
+            consumers = asyncio.gather(*(consume(subscriber) for subscriber in subscribers))
+            await loop.run_in_executor(None, publisher)
+            await consumers
+
+        asyncio.run(fan_out())
+        latencies = sorted(delivered[index + 1] - sent for index, sent in enumerate(published))
+        result = {"subscribers": count, "events": events,
+                  "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+                  "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+                  "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+                  "max_ms": round(latencies[-1] * 1000, 3)}
+        results.append(result)
+        print(f"fanout {count:>9} subscribers p50 {result['p50_ms']:>8}ms p95 {result['p95_ms']:>8}ms "
+              f"max {result['max_ms']:>8}ms", file=sys.stderr)
+    return results
+
+
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+create_app({"SQLALCHEMY_DATABASE_URI": sys.argv[1]})
+created = time.perf_counter()
+print(json.dumps({"import": imported - started, "create_app": created - imported}))
+"""
+
+
+def run_startup(database, runs):
+    """
+    Times the import of flaskr and create_app() in runs fresh interpreters
+    """
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, database], check=True, capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        samples.append(json.loads(output.splitlines()[-1]))
+    result = {"runs": runs}
+    for step in ("import", "create_app"):
+        result[f"{step}_ms"] = round(statistics.median(sample[step] for sample in samples) * 1000, 3)
+    result["total_ms"] = round(statistics.median(sample["import"] + sample["create_app"] for sample in samples)
+                               * 1000, 3)
+    print(f"startup import {result['import_ms']:>8}ms create_app {result['create_app_ms']:>8}ms "
+          f"total {result['total_ms']:>8}ms", file=sys.stderr)
+    return result
+
+
+def run(database, sizes, categories, requests, warmup, seed_value, concurrency=0, orjson=True, compression=False,
+        answers=0):
+    results = []
+    concurrent_results = []
+    compression_results = []
+    score_results = []
+    for size in sizes:
+        rng = random.Random(seed_value)
+        # Rate limits and the concurrency cap would turn the benchmark's own requests away
+        app = create_app({"SQLALCHEMY_DATABASE_URI": database, "DEBUG": False, "USE_ORJSON": orjson,
+                          "RATE_LIMITS": {}, "MAX_CONCURRENT_REQUESTS": 0})
+        with app.app_context():
+            started = time.perf_counter()
+            seed(size, categories, rng)
+            seconds = time.perf_counter() - started
+            print(f"seeded {size} questions in {seconds:.1f}s", file=sys.stderr)
+            client = app.test_client()
+            for route, make_request in scenarios(size, categories, rng):
+                # Deletes use up their ids, so they are not warmed up
+                route_warmup = 0 if route.startswith("DELETE") else warmup
+                result = measure(client, make_request, min(requests, size), route_warmup)
+                results.append({"size": size, "categories": categories, "route": route, **result})
+                print(f"{size:>9} {route:<32} p50 {result['p50_ms']:>8}ms p95 {result['p95_ms']:>8}ms "
+                      f"p99 {result['p99_ms']:>8}ms {result['requests_per_second']:>8} req/s "
+                      f"cpu {result['cpu_ms']:>8}ms", file=sys.stderr)
+            db.session.remove()
+            if compression:
+                compression_results += run_compression(app, size, categories, min(requests, size), seed_value)
+            if concurrency:
+                concurrent_results += run_concurrency(app, database, size, categories, min(requests, size),
+                                                      warmup, concurrency, rng)
+            if answers:
+                score_results += [{"size": size, **result} for result in
+                                  run_scores(app, categories, answers, min(requests, size), warmup, rng)]
+                db.session.remove()
+            db.get_engine().dispose()
+    return results, concurrent_results, compression_results, score_results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the results whose p95 latency grew by more than tolerance over the baseline
+    """
+    previous = {(result["size"], result["route"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["size"], result["route"]))
+        if before and result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append({"size": result["size"], "route": result["route"],
+                                "baseline_p95_ms": before["p95_ms"], "p95_ms": result["p95_ms"]})
+    return regressions
+
+
+def cpu_changes(results, baseline):
+    """
+    Returns the CPU time per request of each result next to its baseline
+    """
+    previous = {(result["size"], result["route"]): result for result in baseline["results"]}
+    changes = []
+    for result in results:
+        before = previous.get((result["size"], result["route"]))
+        if before and "cpu_ms" in before:
+            changes.append({"size": result["size"], "route": result["route"], "baseline_cpu_ms": before["cpu_ms"],
+                            "cpu_ms": result["cpu_ms"],
+                            "change": round(result["cpu_ms"] / before["cpu_ms"] - 1, 3) if before["cpu_ms"] else None})
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", help="Database URL to seed, a temporary SQLite file by default. "
+                                           "Its tables are dropped and recreated.")
+    parser.add_argument("--sizes", default="10000", help="Comma separated question bank sizes (default: 10000)")
+    parser.add_argument("--categories", type=int, default=6, help="Number of categories (default: 6)")
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests per route (default: 200)")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests per route (default: 10)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--output", help="File to write the JSON results to, standard output by default")
+    parser.add_argument("--compare", help="Earlier JSON results to check for p95 regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 growth over --compare (default: 0.2)")
+    parser.add_argument("--stdlib-json", action="store_true", help="Serialize with the standard library, not orjson")
+    parser.add_argument("--compression", action="store_true",
+                        help="Measure the CPU time and bytes of each content encoding")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="Requests in flight for the sync against async comparison (default: 0, skipped)")
+    parser.add_argument("--startup", type=int, default=0,
+                        help="Fresh interpreters timed for import and create_app (default: 0, skipped)")
+    parser.add_argument("--fanout", help="Comma separated subscriber counts for the event fan-out test")
+    parser.add_argument("--scores", type=int, default=0,
+                        help="Quiz answers written for the score flush load test (default: 0, skipped)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    database = args.database
+    if database is None:
+        handle, path = tempfile.mkstemp(prefix="trivia_bench_", suffix=".db")
+        os.close(handle)
+        database = f"sqlite:///{path}"
+    try:
+        # Timed first, so the database is already there but not yet seeded
+        startup = run_startup(database, args.startup) if args.startup else None
+        results, concurrent_results, compression_results, score_results = run(
+            database, sizes, args.categories, args.requests, args.warmup, args.seed, args.concurrency,
+            not args.stdlib_json, args.compression, args.scores)
+    finally:
+        if args.database is None:
+            os.remove(path)
+
+    report = {
+        "meta": {
+            "database": database.split("://")[0],
+            "json": "stdlib" if args.stdlib_json or serialization.orjson is None else "orjson",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+    if args.compression:
+        report["compression"] = compression_results
+    if args.concurrency:
+        report["concurrency"] = concurrent_results
+    if args.scores:
+        report["scores"] = score_results
+    if args.startup:
+        report["startup"] = startup
+    if args.fanout:
+        report["fanout"] = run_fanout([int(count) for count in args.fanout.split(",")])
+    regressions = []
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        report["cpu"] = cpu_changes(results, baseline)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+import functools
+import hashlib
+import threading
+import time
+
+from flask import current_app, has_app_context, make_response, request
+
+from models import Category, db, on_change, table_versions
+from replicas import primary_reads
+
+
+class CategoryCache:
+    """
+    In-process copy of the categories table. Categories rarely change, so listings
+    are served from memory. The copy is dropped whenever a category is inserted or
+    deleted through the models and reloaded once older than ttl seconds, which bounds
+    how long changes made by other processes go unseen.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        self.categories = []
+        self.names = {}
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def _entries(self):
+        with self.lock:
+            if self.loaded_at is not None and time.monotonic() - self.loaded_at <= self.ttl:
+                self.hits += 1
+                return self.categories, self.names
+            self.misses += 1
+        with primary_reads():
+            categories = db.session.query(Category.id, Category.name).order_by(Category.name).all()
+        names = {category_id: name for category_id, name in categories}
+        with self.lock:
+            self.categories = categories
+            self.names = names
+            self.loaded_at = time.monotonic()
+        return categories, names
+
+    def all(self):
+        """
+        Returns the (id, name) pairs of all categories ordered by name
+        """
+        return self._entries()[0]
+
+    def name(self, category_id):
+        """
+        Returns the name of the category, or None if it does not exist
+        """
+        return self._entries()[1].get(category_id)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def get_category_cache():
+    return current_app.extensions["category_cache"]
+
+
+@on_change
+def sync_category_cache(table, action, record):
+    if not has_app_context() or table != "categories":
+        return
+    cache = current_app.extensions.get("category_cache")
+    if cache is not None:
+        cache.invalidate()
+
+
+def table_etag(tables):
+    """
+    Builds the ETag of the current request URL from the versions of tables.
+    Versions are counted per process, so the current ETAG_TTL period is mixed in:
+    changes made by other processes are seen once the period rolls over.
+    """
+    period = int(time.time() // current_app.config["ETAG_TTL"])
+    versions = ",".join(f"{table}={table_versions.get(table, 0)}" for table in tables)
+    key = f"{request.full_path}|{versions}|{period}"
+    return hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+
+
+def conditional(*tables):
+    """
+    Decorates a GET view whose body only depends on the request URL and tables.
+    Requests whose If-None-Match holds the current ETag get a 304 without running the view.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = table_etag(tables)
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            max_age = current_app.config["HTTP_CACHE_MAX_AGE"]
+            response.headers["Cache-Control"] = f"private, max-age={max_age}" if max_age else "no-cache"
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,125 @@
+import gzip
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/csv", "text/plain")
+
+
+class CompressedCache:
+    """
+    LRU cache of compressed bodies by (ETag, encoding), so responses that did not change
+    are not compressed again. Bodies without an ETag are never cached.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.lock = threading.Lock()
+        self.bodies = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            body = self.bodies.get(key)
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bodies.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if not self.size:
+            return
+        with self.lock:
+            self.bodies[key] = body
+            self.bodies.move_to_end(key)
+            while len(self.bodies) > self.size:
+                self.bodies.popitem(last=False)
+
+
+def encodings():
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate():
+    """
+    Returns the encoding preferred by the request's Accept-Encoding, br over gzip, or None
+    """
+    return request.accept_encodings.best_match(encodings())
+
+
+def compress(data, encoding, config):
+    if encoding == "br":
+        return brotli.compress(data, quality=config["BROTLI_QUALITY"])
+    return gzip.compress(data, compresslevel=config["GZIP_LEVEL"], mtime=0)
+
+
+def compress_stream(chunks, encoding, config):
+    """
+    Compresses a streamed body chunk by chunk, so it is never held in memory at once
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=config["BROTLI_QUALITY"])
+        process, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(config["GZIP_LEVEL"], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = process(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def compress_response(response):
+    """
+    Compresses text bodies of successful responses with the encoding negotiated by the client.
+    Bodies below COMPRESS_MIN_SIZE are sent as is. Compressed responses get a weak ETag,
+    as their bytes differ from the identity response.
+    """
+    config = current_app.config
+    if (response.status_code != 200 or response.direct_passthrough or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    if response.is_streamed:
+        encoding = negotiate()
+        response.vary.add("Accept-Encoding")
+        if encoding:
+            response.response = compress_stream(response.response, encoding, config)
+            response.headers["Content-Encoding"] = encoding
+            response.headers.pop("Content-Length", None)
+        return response
+
+    data = response.get_data()
+    if len(data) < config["COMPRESS_MIN_SIZE"]:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate()
+    if not encoding:
+        return response
+    etag, weak = response.get_etag()
+    cache = current_app.extensions["compressed_cache"]
+    body = cache.get((etag, encoding)) if etag else None
+    if body is None:
+        body = compress(data, encoding, config)
+        if etag:
+            cache.put((etag, encoding), body)
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    app.extensions["compressed_cache"] = CompressedCache(app.config["COMPRESS_CACHE_SIZE"])
+    app.after_request(compress_response)
@@ -16,3 +16,94 @@ PORT = ""
 DATABASE_NAME = ""
 SQLALCHEMY_DATABASE_URI = f'{DIALECT}://{USER}:{PASSWORD}@{HOST}:{PORT}/{DATABASE_NAME}'
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Connection pool of each worker process, ignored for SQLite.
+# Size it so that workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) stays below the server's max_connections.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 10))
+# Seconds after which connections are replaced, and whether they are checked before use (survives failovers)
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = True
+# Per-statement timeout on Postgres, 0 disables it
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 5000))
+
+# Read replicas as a comma separated list of database URLs. Read-only routes are spread over them round-robin.
+# Replicas are checked by connecting at most every REPLICA_CHECK_SECONDS, and skipped for REPLICA_RETRY_SECONDS
+# after failing. With no replica every query goes to SQLALCHEMY_DATABASE_URI.
+SQLALCHEMY_REPLICA_URIS = [uri for uri in os.environ.get("REPLICA_DATABASE_URLS", "").split(",") if uri]
+REPLICA_CHECK_SECONDS = 5
+REPLICA_RETRY_SECONDS = 30
+
+# Text responses of at least COMPRESS_MIN_SIZE bytes are compressed with brotli, when it is installed,
+# or gzip, as negotiated with the client. COMPRESS_CACHE_SIZE compressed bodies are kept by ETag.
+COMPRESS_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+COMPRESS_CACHE_SIZE = 256
+
+# Token bucket rate limits per client (X-API-Key header, else address): (tokens per second, burst).
+# "search" covers searches through POST /questions, "quizzes" the quiz question routes and "scores" POST /scores.
+# Buckets are kept in memory per process unless RATELIMIT_STORAGE_URL is a redis:// URL.
+RATE_LIMITS = {"search": (5, 20), "quizzes": (10, 30), "scores": (10, 30)}
+RATELIMIT_STORAGE_URL = os.environ.get("RATELIMIT_STORAGE_URL", "memory://")
+# API keys that get a bucket of their own; requests with any other key are limited by address
+RATELIMIT_API_KEYS = {key for key in os.environ.get("RATELIMIT_API_KEYS", "").split(",") if key}
+
+# Requests a process handles at once, by default as many as the connection pool holds, 0 disables the cap.
+# Requests over it wait at most ADMISSION_TIMEOUT seconds for a slot, then get a 503.
+MAX_CONCURRENT_REQUESTS = None
+ADMISSION_TIMEOUT = 0.1
+
+# Most questions or ids accepted by one request to the /questions/batch endpoints
+QUESTION_BATCH_LIMIT = 1000
+
+# Serialize JSON responses with orjson when it is installed, else with the standard library
+USE_ORJSON = True
+
+# Seconds before the in-memory quiz question pools are rebuilt from the database, in the background
+QUIZ_POOL_TTL = 300
+
+# Seconds a quiz session may stay idle, and the most sessions kept in memory
+QUIZ_SESSION_TTL = 1800
+QUIZ_SESSION_LIMIT = 10000
+
+# Answers are written to the scores table in batches: once SCORE_FLUSH_SIZE are waiting or every
+# SCORE_FLUSH_SECONDS. At most SCORE_BUFFER_LIMIT are held while the database cannot be written to.
+SCORE_FLUSH_SIZE = 500
+SCORE_FLUSH_SECONDS = 1.0
+SCORE_BUFFER_LIMIT = 100000
+
+# Players kept on each leaderboard, and seconds before the leaderboards are reloaded from the database
+LEADERBOARD_SIZE = 100
+LEADERBOARD_TTL = 300
+
+# Seconds between keepalive comments on idle /events streams, events queued per stream before it is
+# reset, and events kept for clients resuming with Last-Event-ID
+SSE_KEEPALIVE_SECONDS = 15
+SSE_QUEUE_SIZE = 100
+SSE_HISTORY = 1000
+# Most /events streams the Flask app keeps open at once; each holds a worker thread, so streams over it
+# get a 503. Set to 0 when running on gevent, where a stream only holds a greenlet.
+SSE_MAX_STREAMS = 8
+
+# Difficulty adaptive quizzes start at, and the answers weighed before it changes
+QUIZ_START_DIFFICULTY = 1
+QUIZ_ADAPTIVE_WINDOW = 4
+
+# Seconds before the in-memory search index, used on databases without full-text search, is rebuilt
+SEARCH_INDEX_TTL = 300
+
+# Seconds the in-process category cache is served before it is reloaded
+CATEGORY_CACHE_TTL = 60
+
+# Seconds after which ETags change even without a local write, so writes made by other workers are seen.
+# Responses may be reused by clients for HTTP_CACHE_MAX_AGE seconds, 0 means they always revalidate.
+ETAG_TTL = 30
+HTTP_CACHE_MAX_AGE = 0
+
+# Log a warning when one statement runs this many times in a request (a likely N+1 pattern), 0 disables it,
+# and when a single statement takes at least SQL_SLOW_QUERY_MS milliseconds
+SQL_REPEAT_WARN_THRESHOLD = 10
+SQL_SLOW_QUERY_MS = 500
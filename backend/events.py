@@ -0,0 +1,226 @@
+import asyncio
+import queue
+import threading
+from collections import deque, namedtuple
+
+from flask import current_app, has_app_context
+
+from models import on_change
+from serialization import dumps
+
+KEEPALIVE = ": keepalive\n\n"
+# Tells the client it missed events and should fetch the data again
+RESET = "event: reset\ndata: {}\n\n"
+
+EVENT_TYPES = {
+    ("questions", "insert"): "question.created",
+    ("questions", "update"): "question.updated",
+    ("questions", "delete"): "question.deleted",
+    ("questions", "bulk"): "questions.changed",
+    ("categories", "insert"): "category.created",
+    ("categories", "update"): "category.updated",
+    ("categories", "delete"): "category.deleted",
+}
+
+
+class Event(namedtuple("Event", "id type data")):
+    __slots__ = ()
+
+    def encode(self):
+        return f"id: {self.id}\nevent: {self.type}\ndata: {dumps(self.data)}\n\n"
+
+
+def change_event(table, action, record):
+    """
+    Returns the (type, data) of the event published for a committed change, or None
+    """
+    event_type = EVENT_TYPES.get((table, action))
+    if event_type is None:
+        return None
+    if record is None:
+        return event_type, {}
+    if action == "delete":
+        data = {"id": record.id}
+        if table == "questions":
+            data["category_id"] = record.category_id
+        return event_type, data
+    return event_type, record.format()
+
+
+class Broker:
+    """
+    In-process fan-out of change events. Subscribers are objects with a put(event) method that
+    must not block. The last history events are kept so reconnecting clients can resume from
+    their Last-Event-ID.
+    """
+
+    def __init__(self, history=1000):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.history = deque(maxlen=history)
+        self.last_id = 0
+        self.published = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def subscribe(self, subscriber, limit=0):
+        """
+        Adds subscriber and returns True, or returns False when limit subscribers are open already
+        """
+        with self.lock:
+            if limit and len(self.subscribers) >= limit:
+                self.rejected += 1
+                return False
+            self.subscribers.add(subscriber)
+            return True
+
+    def replay(self, last_event_id=None):
+        """
+        Returns the events published after last_event_id, or None when some of them
+        are no longer in the history
+        """
+        with self.lock:
+            if last_event_id is None or last_event_id >= self.last_id:
+                return []
+            if not self.history or self.history[0].id > last_event_id + 1:
+                return None
+            return [event for event in self.history if event.id > last_event_id]
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, event_type, data):
+        with self.lock:
+            self.last_id += 1
+            event = Event(self.last_id, event_type, data)
+            self.history.append(event)
+            subscribers = list(self.subscribers)
+            self.published += 1
+        for subscriber in subscribers:
+            subscriber.put(event)
+        return event
+
+
+class QueueSubscriber:
+    """
+    Subscriber of a WSGI stream. get() blocks the worker; under gevent it only blocks the greenlet,
+    so idle streams do not hold a thread. Events beyond size are dropped and the stream is reset.
+    """
+
+    def __init__(self, size=100):
+        self.queue = queue.Queue(size)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def reset(self):
+        self.overflowed = False
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class LoopFanout:
+    """
+    Hands events to the asyncio queues of one event loop. It is subscribed to the broker once
+    per loop, so a publish costs one call_soon_threadsafe however many streams the loop serves.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queues = set()
+
+    def put(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self.deliver, event)
+        except RuntimeError:
+            # The loop was closed
+            pass
+
+    def deliver(self, event):
+        for subscriber in list(self.queues):
+            subscriber.put(event)
+
+
+class AsyncSubscriber:
+    """
+    Subscriber of an ASGI stream, fed by the LoopFanout of its event loop
+    """
+
+    def __init__(self, size=100):
+        self.queue = asyncio.Queue(size)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def reset(self):
+        self.overflowed = False
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+def parse_last_event_id(value):
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def opening(backlog):
+    """
+    Returns the first chunk of a stream, sending the backlog replayed for the client,
+    and the id of its last event
+    """
+    if backlog is None:
+        return "retry: 3000\n\n" + RESET, 0
+    return "retry: 3000\n\n" + "".join(event.encode() for event in backlog), backlog[-1].id if backlog else 0
+
+
+def event_stream(subscriber, backlog, keepalive):
+    """
+    Yields the Server-Sent Events chunks of a WSGI stream. Events already sent with the backlog are skipped.
+    """
+    chunk, last_id = opening(backlog)
+    yield chunk
+    while True:
+        event = subscriber.get(keepalive)
+        if subscriber.overflowed:
+            subscriber.reset()
+            yield RESET
+        elif event is None:
+            yield KEEPALIVE
+        elif event.id > last_id:
+            last_id = event.id
+            yield event.encode()
+
+
+def get_broker():
+    return current_app.extensions["events"]
+
+
+@on_change
+def publish_change(table, action, record):
+    if not has_app_context():
+        return
+    broker = current_app.extensions.get("events")
+    if broker is None:
+        return
+    event = change_event(table, action, record)
+    if event is not None:
+        broker.publish(*event)
@@ -0,0 +1,70 @@
+import csv
+import io
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from models import db, format_question_row, Question, QUESTION_COLUMNS, QUESTION_FIELDS
+from serialization import dumps
+
+BATCH_SIZE = 1000
+FIELDS = QUESTION_FIELDS
+
+
+def export_rows(category_id=None, difficulty=None, batch_size=BATCH_SIZE):
+    """
+    Yields the formatted questions, optionally of one category and difficulty, in id order.
+    Rows are read through a server-side cursor batch_size at a time, so memory use
+    does not grow with the size of the table.
+    """
+    statement = select(*QUESTION_COLUMNS).order_by(Question.id)
+    if category_id is not None:
+        statement = statement.where(Question.category_id == category_id)
+    if difficulty is not None:
+        statement = statement.where(Question.difficulty == difficulty)
+    result = db.session.execute(statement.execution_options(stream_results=True))
+    for rows in result.partitions(batch_size):
+        for row in rows:
+            yield format_question_row(row)
+
+
+def to_ndjson(rows):
+    for row in rows:
+        yield dumps(row) + "\n"
+
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()
+
+    yield line(FIELDS)
+    for row in rows:
+        yield line([row[field] for field in FIELDS])
+
+
+def export_questions(format="ndjson", category_id=None, difficulty=None):
+    """
+    Yields the question bank as chunks of NDJSON or CSV text
+    """
+    serialize = to_csv if format == "csv" else to_ndjson
+    return serialize(export_rows(category_id, difficulty))
+
+
+@click.command("export-questions")
+@click.option("--output", type=click.File("w", encoding="utf-8"), default="-",
+              help="File to write to, standard output by default.")
+@click.option("--format", "format", type=click.Choice(["ndjson", "csv"]), default="ndjson", show_default=True)
+@click.option("--category", type=int, default=None, help="Only export questions of this category id.")
+@click.option("--difficulty", type=int, default=None, help="Only export questions of this difficulty.")
+@with_appcontext
+def export_questions_command(output, format, category, difficulty):
+    """Exports the question bank as NDJSON or CSV."""
+    for chunk in export_questions(format, category, difficulty):
+        output.write(chunk)
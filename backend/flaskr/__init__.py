@@ -1,16 +1,90 @@
-from flask import Flask, abort, jsonify, request
+import math
+
+from flask import Flask, Response, abort, jsonify, request, stream_with_context
 from flask_cors import CORS
+from werkzeug.exceptions import ServiceUnavailable
+from sqlalchemy import func, select
 from models import Category
-from models import setup_db, Question
+from models import db, setup_db, Question
 
-from utils import populate_database, paginate_questions
+from batch import create_questions, delete_questions
+from cache import CategoryCache, conditional, get_category_cache
+from compression import init_compression
+from events import Broker, QueueSubscriber, event_stream, get_broker, parse_last_event_id
+from exporter import export_questions, export_questions_command
+from handlers import categories_payload, current_category, new_category_name, previous_questions, question_request, \
+    questions_payload, quiz_category, quiz_difficulty, quiz_payload, record_session_answer, session_deleted_payload, \
+    session_question_payload, session_started_payload
+from importer import BATCH_SIZE, decode_lines, import_questions, import_questions_command
+from instrumentation import init_instrumentation
+from pooling import pool_stats
+from quiz import QuestionPool, QuizSessionStore, draw_question, get_quiz_sessions, next_session_question, \
+    start_quiz_session
+from ratelimit import check_rate_limit, init_rate_limits, rate_limited
+from replicas import replica_reads, use_replica
+from scores import get_leaderboard, init_scores, record_answer
+from search import search_questions
+from serialization import init_json
+from stats import category_stats, question_total, rebuild_stats_command
+from utils import paginate, seed_command
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    setup_db(app, test_config)
+    init_json(app)
+    app.extensions["category_cache"] = CategoryCache(app.config["CATEGORY_CACHE_TTL"])
+    app.extensions["question_pool"] = QuestionPool(app.config["QUIZ_POOL_TTL"])
+    app.extensions["quiz_sessions"] = QuizSessionStore(app.config["QUIZ_SESSION_TTL"], app.config["QUIZ_SESSION_LIMIT"])
+    init_scores(app)
+    app.extensions["events"] = Broker(app.config["SSE_HISTORY"])
     CORS(app, resources={r"/api/*": {"origins": "*"}})
+    # Registered first so that it runs after the other after_request hooks
+    init_compression(app)
+    init_instrumentation(app)
+    init_rate_limits(app)
+    category_cache = app.extensions["category_cache"]
+    app.extensions["metrics"].register("trivia_category_cache_hits_total", "counter", "Category cache hits.",
+                                       lambda: {(): category_cache.hits})
+    app.extensions["metrics"].register("trivia_category_cache_misses_total", "counter", "Category cache misses.",
+                                       lambda: {(): category_cache.misses})
+    compressed_cache = app.extensions["compressed_cache"]
+    app.extensions["metrics"].register("trivia_compressed_cache_hits_total", "counter",
+                                       "Responses served from the compressed body cache.",
+                                       lambda: {(): compressed_cache.hits})
+    app.extensions["metrics"].register("trivia_compressed_cache_misses_total", "counter",
+                                       "Compressible responses with an ETag that had to be compressed.",
+                                       lambda: {(): compressed_cache.misses})
+    rate_limiter = app.extensions["rate_limiter"]
+    app.extensions["metrics"].register("trivia_rate_limited_total", "counter", "Requests refused by a rate limit.",
+                                       lambda: {(("limit", name),): count
+                                                for name, count in rate_limiter.rejected.items()})
+    score_buffer = app.extensions["score_buffer"]
+    app.extensions["metrics"].register("trivia_scores_pending", "gauge", "Answers waiting to be written.",
+                                       lambda: {(): len(score_buffer)})
+    app.extensions["metrics"].register("trivia_scores_flushed_total", "counter", "Answers written to the database.",
+                                       lambda: {(): score_buffer.flushed})
+    app.extensions["metrics"].register("trivia_scores_dropped_total", "counter",
+                                       "Answers dropped because SCORE_BUFFER_LIMIT were waiting.",
+                                       lambda: {(): score_buffer.dropped})
+    broker = app.extensions["events"]
+    app.extensions["metrics"].register("trivia_event_subscribers", "gauge", "Open /events streams.",
+                                       lambda: {(): len(broker)})
+    app.extensions["metrics"].register("trivia_events_published_total", "counter", "Change events published.",
+                                       lambda: {(): broker.published})
+    app.extensions["metrics"].register("trivia_event_streams_rejected_total", "counter",
+                                       "/events streams refused because SSE_MAX_STREAMS were open.",
+                                       lambda: {(): broker.rejected})
+    if "admission" in app.extensions:
+        admission = app.extensions["admission"]
+        app.extensions["metrics"].register("trivia_admission_rejected_total", "counter",
+                                           "Requests refused because the process was at MAX_CONCURRENT_REQUESTS.",
+                                           lambda: {(): admission.rejected})
+    app.cli.add_command(import_questions_command)
+    app.cli.add_command(export_questions_command)
+    app.cli.add_command(rebuild_stats_command)
+    app.cli.add_command(seed_command)
 
     # CORS Headers
     @app.after_request
@@ -23,6 +97,10 @@ def create_app(test_config=None):
         )
         return response
 
+    def requested_category():
+        cur_cat_id = request.args.get("category", None, type=int)
+        return current_category(cur_cat_id, get_category_cache().name(cur_cat_id) if cur_cat_id else None)
+
     """
     Category
 
@@ -30,12 +108,8 @@ def create_app(test_config=None):
 
     @app.route("/categories", methods=["POST"])
     def create_category():
-        body = request.get_json()
-        name = body.get("name", None)
-        if not name:
-            abort(400)
-        name = name.title()
-        if Category.query.filter_by(name=name).one_or_none():
+        name = new_category_name(request.get_json())
+        if Category.query.filter(func.lower(Category.name) == name.lower()).one_or_none():
             abort(409)
         category = Category(name=name)
         try:
@@ -52,29 +126,38 @@ def create_app(test_config=None):
             abort(422)
 
     @app.route("/categories")
+    @conditional("categories")
+    @replica_reads
     def retrieve_categories():
-        categories = Category.query.order_by(Category.name).all()
-        if len(categories) == 0:
-            abort(404)
-        categories = {cat.id: cat.name for cat in categories}
+        return jsonify(categories_payload(get_category_cache().all()))
+
+    @app.route("/categories/stats")
+    @conditional("categories", "questions")
+    @replica_reads
+    def retrieve_category_stats():
+        stats = category_stats()
+        categories = [{
+            "id": cat_id,
+            "name": name,
+            "totalQuestions": sum(stats.get(cat_id, {}).values()),
+            "difficulties": stats.get(cat_id, {})
+        } for cat_id, name in get_category_cache().all()]
         return jsonify({
             "success": True,
-            "categories": categories
+            "categories": categories,
+            "totalQuestions": sum(category["totalQuestions"] for category in categories)
         })
 
     @app.route("/categories/<int:category_id>/questions")
+    @conditional("categories", "questions")
+    @replica_reads
     def retrieve_category_questions(category_id):
-        category = Category.query.filter_by(id=category_id).one_or_none()
-        if not category:
+        category_name = get_category_cache().name(category_id)
+        if not category_name:
             abort(404)
-        selection = Question.query.filter_by(category_id=category_id).all()
-        current_questions = paginate_questions(request, selection)
-        return jsonify({
-            "success": True,
-            "questions": current_questions,
-            "totalQuestions": len(selection),
-            "currentCategory": category.name
-        })
+        selection = select(Question).where(Question.category_id == category_id).order_by(Question.id)
+        current_questions, pagination = paginate(request.args, selection, lambda: question_total(category_id))
+        return jsonify(questions_payload(current_questions, pagination, category_name))
 
     """
     Question
@@ -84,96 +167,202 @@ def create_app(test_config=None):
     @app.route("/questions", methods=["POST"])
     def create_question():
         body = request.get_json()
-        new_question = body.get("question", None)
-        new_answer = body.get("answer", None)
-        new_category = body.get("category", None)
-        new_difficulty = body.get("difficulty", None)
-        search_term = body.get("searchTerm", None)
-        cur_cat_id = request.args.get("category", None, type=int)
-        if cur_cat_id:
-            current_category = Category.query.get(cur_cat_id).one_or_none()
-            if current_category is None:
-                abort(404)
-        else:
-            current_category = Category(name="All")
+        category = requested_category()
+        action, value = question_request(body)
 
-        if search_term:
-            selection = Question.query.filter(Question.question.ilike(f"%{search_term}%")).all()
-            if len(selection) == 0:
+        if action == "search":
+            check_rate_limit("search")
+            use_replica()
+            selection, rank = search_questions(value)
+            current_questions, pagination = paginate(request.args, selection, rank=rank)
+            if len(current_questions) == 0 and not pagination.get("totalQuestions"):
                 abort(404)
-            current_questions = paginate_questions(request, selection)
-            return jsonify({
-                "success": True,
-                "questions": current_questions,
-                "totalQuestions": len(selection),
-                "currentCategory": current_category.name
-            })
-        elif new_question and new_answer and new_category and new_difficulty:
-            try:
-                question = Question(question=new_question, answer=new_answer, category_id=new_category,
-                                    difficulty=new_difficulty)
-                question.insert()
-                return jsonify({"success": True})
-            except:
-                abort(422)
+            return jsonify(questions_payload(current_questions, pagination, category))
+        try:
+            question = Question(**value)
+            question.insert()
+            return jsonify({"success": True})
+        except:
+            abort(422)
+
+    @app.route("/questions/import", methods=["POST"])
+    def import_question_bank():
+        data_format = request.args.get("format") or ("csv" if request.mimetype == "text/csv" else "ndjson")
+        if data_format not in ("ndjson", "csv"):
+            abort(400)
+        batch_size = max(1, request.args.get("batch_size", BATCH_SIZE, type=int))
+        try:
+            report = import_questions(decode_lines(request.stream), data_format, batch_size)
+        except Exception:
+            abort(422)
+        return jsonify({
+            "success": True,
+            **report
+        })
+
+    @app.route("/questions/batch", methods=["POST"])
+    def create_question_batch():
+        items = (request.get_json() or {}).get("questions")
+        if not isinstance(items, list) or not items:
+            abort(400)
+        if len(items) > app.config["QUESTION_BATCH_LIMIT"]:
+            abort(413)
+        try:
+            results = create_questions(items)
+        except Exception:
+            db.session.rollback()
+            abort(422)
+        created = sum(result["status"] == "created" for result in results)
+        return jsonify({
+            "success": True,
+            "created": created,
+            "rejected": len(results) - created,
+            "results": results
+        })
+
+    @app.route("/questions/batch", methods=["DELETE"])
+    def delete_question_batch():
+        body = request.get_json() or {}
+        ids = body.get("ids")
+        category_id = body.get("category")
+        difficulty = body.get("difficulty")
+        # Every filter given must be an integer, not a bool or a string, as it selects what is deleted
+        if any(type(body[key]) is not int for key in ("category", "difficulty") if key in body):
+            abort(400)
+        if ids is not None:
+            if not isinstance(ids, list) or not all(type(question_id) is int for question_id in ids):
+                abort(400)
+            if len(ids) > app.config["QUESTION_BATCH_LIMIT"]:
+                abort(413)
+        elif category_id is None and difficulty is None:
+            abort(400)
+        try:
+            deleted = delete_questions(ids, category_id, difficulty)
+        except Exception:
+            db.session.rollback()
+            abort(422)
+        if ids is None:
+            results = [{"id": question_id, "status": "deleted"} for question_id in deleted]
         else:
+            deleted_ids = set(deleted)
+            results = [{"id": question_id, "status": "deleted" if question_id in deleted_ids else "not found"}
+                       for question_id in dict.fromkeys(ids)]
+        return jsonify({
+            "success": True,
+            "deleted": len(deleted),
+            "results": results
+        })
+
+    @app.route("/questions/export")
+    @replica_reads
+    def export_question_bank():
+        data_format = request.args.get("format", "ndjson")
+        if data_format not in ("ndjson", "csv"):
             abort(400)
+        category_id = request.args.get("category", None, type=int)
+        difficulty = request.args.get("difficulty", None, type=int)
+        chunks = export_questions(data_format, category_id, difficulty)
+        mimetype = "text/csv" if data_format == "csv" else "application/x-ndjson"
+        return Response(stream_with_context(chunks), mimetype=mimetype, headers={
+            "Content-Disposition": f"attachment; filename=questions.{data_format}"
+        })
 
     @app.route("/quizzes", methods=["POST"])
+    @replica_reads
+    @rate_limited("quizzes")
     def get_quiz():
         body = request.get_json()
-        previous_questions = body.get("previous_questions", None)
-        cat_id = int(body["quiz_category"]["id"])
-        quiz_category = cat_id if cat_id > 0 else None
+        category = quiz_category(body)
+        difficulty = quiz_difficulty(body, app.config)
         question = None
         try:
-            if previous_questions and quiz_category:
-                question = Question.query.filter(Question.category_id == quiz_category) \
-                    .filter(Question.id.not_in(previous_questions)).first()
-            elif quiz_category:
-                question = Question.query.filter(Question.category_id == quiz_category).first()
-            elif previous_questions:
-                question = Question.query.filter(Question.id.not_in(previous_questions)).first()
-            else:
-                question = Question.query.first()
+            question = draw_question(category, previous_questions(body), difficulty)
+        except Exception as e:
+            abort(422)
+
+        return jsonify(quiz_payload(question.format() if question else None))
+
+    @app.route("/quizzes/sessions", methods=["POST"])
+    @replica_reads
+    @rate_limited("quizzes")
+    def create_quiz_session():
+        body = request.get_json()
+        category = quiz_category(body)
+        if category is not None and get_category_cache().name(category) is None:
+            abort(404)
+        session_id, session = start_quiz_session(category, bool(body.get("adaptive")))
+        return jsonify(session_started_payload(session_id, session))
+
+    @app.route("/quizzes/sessions/<session_id>/next", methods=["POST"])
+    @replica_reads
+    @rate_limited("quizzes")
+    def get_session_quiz(session_id):
+        session = get_quiz_sessions().get(session_id)
+        if session is None:
+            abort(404)
+        record_session_answer(session, request.get_json(silent=True) or {})
+        try:
+            question = next_session_question(session)
         except Exception as e:
             abort(422)
 
-        if question:
-            return jsonify({
-                "success": True,
-                "question": question.format()
-            })
+        return jsonify(session_question_payload(session, question.format() if question else None))
+
+    @app.route("/quizzes/sessions/<session_id>", methods=["DELETE"])
+    def delete_quiz_session(session_id):
+        return jsonify(session_deleted_payload(session_id, get_quiz_sessions().end(session_id)))
+
+    @app.route("/scores", methods=["POST"])
+    @rate_limited("scores")
+    def create_score():
+        body = request.get_json() or {}
+        player = body.get("player")
+        correct = body.get("correct")
+        question_id = body.get("question_id")
+        try:
+            cat_id = int(body["quiz_category"]["id"])
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+        if (not isinstance(player, str) or not player.strip() or len(player) > 80 or not isinstance(correct, bool)
+                or (question_id is not None and not isinstance(question_id, int))):
+            abort(400)
+        quiz_category = cat_id if cat_id > 0 else None
+        if quiz_category is not None and get_category_cache().name(quiz_category) is None:
+            abort(422)
+        score = record_answer(player.strip(), quiz_category, question_id, correct)
         return jsonify({
-            "success": True
-        })
-        
+            "success": True,
+            "player": player.strip(),
+            "score": score
+        }), 202
 
-        
+    @app.route("/leaderboard")
+    def retrieve_leaderboard():
+        cat_id = request.args.get("category", 0, type=int)
+        limit = request.args.get("limit", 10, type=int)
+        if limit < 1 or limit > app.config["LEADERBOARD_SIZE"]:
+            abort(400)
+        quiz_category = cat_id if cat_id > 0 else None
+        if quiz_category is not None and get_category_cache().name(quiz_category) is None:
+            abort(404)
+        top = get_leaderboard().top(quiz_category, limit)
+        return jsonify({
+            "success": True,
+            "category": quiz_category,
+            "leaderboard": [{"rank": rank, "player": player, "score": score}
+                            for rank, (player, score) in enumerate(top, 1)]
+        })
 
     @app.route("/questions")
+    @conditional("categories", "questions")
+    @replica_reads
     def retrieve_questions():
-        cur_cat_id = request.args.get("category", None, type=int)
-        if cur_cat_id:
-            current_category = Category.query.filter(Category.id == cur_cat_id).one_or_none()
-            if current_category is None:
-                abort(404)
-        else:
-            current_category = Category(name="All")
-        selection = Question.query.order_by(Question.id).all()
-        current_questions = paginate_questions(request, selection)
+        category = requested_category()
+        current_questions, pagination = paginate(request.args, select(Question).order_by(Question.id), question_total)
         if len(current_questions) == 0:
             abort(404)
 
-        return jsonify(
-            {
-                "success": True,
-                "currentCategory": current_category.name,
-                "categories": {cat.id: cat.name for cat in Category.query.all()},
-                "questions": current_questions,
-                "totalQuestions": len(selection)
-            }
-        )
+        return jsonify(questions_payload(current_questions, pagination, category, get_category_cache().all()))
 
     @app.route("/questions/<int:question_id>", methods=["DELETE"])
     def delete_question(question_id):
@@ -194,6 +383,33 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    @app.route("/events")
+    def stream_events():
+        broker = get_broker()
+        subscriber = QueueSubscriber(app.config["SSE_QUEUE_SIZE"])
+        if not broker.subscribe(subscriber, app.config["SSE_MAX_STREAMS"]):
+            raise ServiceUnavailable(retry_after=math.ceil(app.config["SSE_KEEPALIVE_SECONDS"]))
+        backlog = broker.replay(parse_last_event_id(request.headers.get("Last-Event-ID")))
+        response = Response(event_stream(subscriber, backlog, app.config["SSE_KEEPALIVE_SECONDS"]),
+                            mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        response.call_on_close(lambda: broker.unsubscribe(subscriber))
+        return response
+
+    @app.route("/pool")
+    def retrieve_pool_stats():
+        stats = pool_stats(db.engine.pool)
+        if "replicas" in app.extensions:
+            stats["replicas"] = app.extensions["replicas"].stats()
+        return jsonify({
+            "success": True,
+            **stats
+        })
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(app.extensions["metrics"].render(), mimetype="text/plain; version=0.0.4")
+
     @app.errorhandler(400)
     def bad_request(error):
         return (
@@ -229,10 +445,27 @@ def create_app(test_config=None):
             409
         )
 
-    try:
-        if Category.query.count() == 0 or Question.query.count() == 0:
-            populate_database()
-    except:
-        print("")
+    @app.errorhandler(413)
+    def too_large(error):
+        return (
+            jsonify({"success": False, "error": 413, "message": "request entity too large"}),
+            413
+        )
+
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return (
+            jsonify({"success": False, "error": 429, "message": "too many requests"}),
+            429,
+            {"Retry-After": str(error.retry_after or 1)}
+        )
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return (
+            jsonify({"success": False, "error": 503, "message": "service unavailable"}),
+            503,
+            {"Retry-After": str(error.retry_after or 1)}
+        )
 
     return app
@@ -0,0 +1,536 @@
+"""
+Async serving mode of the Trivia API.
+
+create_asgi_app() builds an ASGI application with the same JSON routes, contracts and
+error responses as create_app(), backed by SQLAlchemy's asyncio engine (asyncpg on
+Postgres, aiosqlite on SQLite). Requests waiting on the database do not hold a worker
+thread, so one process serves many concurrent quiz requests:
+
+    uvicorn --factory flaskr.asgi:create_asgi_app
+
+GET /events streams question bank changes as Server-Sent Events. Each open stream is
+a coroutine waiting on an asyncio queue, so idle subscribers cost no thread.
+
+Request parsing and response payloads come from the handlers module shared with the WSGI
+app. Bulk import/export, /categories/stats, /questions/batch, /scores, /leaderboard,
+/metrics and /pool are only served by the WSGI app.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+from urllib.parse import parse_qsl
+
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import abort, HTTPException, ServiceUnavailable, TooManyRequests
+
+import config
+from events import AsyncSubscriber, Broker, change_event, KEEPALIVE, LoopFanout, opening, parse_last_event_id, \
+    RESET
+from handlers import categories_payload, current_category, error_payload, new_category_name, \
+    previous_questions, question_request, questions_payload, quiz_category, quiz_difficulty, quiz_payload, \
+    record_session_answer, session_deleted_payload, session_question_payload, session_started_payload
+from models import Category, CategoryStat, format_question_row, notify_change, Question, QUESTION_COLUMNS
+from quiz import open_quiz_session, QuestionPool, QuizSessionStore
+from ratelimit import admission_limit, AsyncAdmissionControl, client_key_of, create_rate_limiter
+from search import MemorySearch, PostgresSearch
+from utils import count_statement, Page
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+CORS_HEADERS = [
+    (b"access-control-allow-headers", b"Content-Type,Authorization,true"),
+    (b"access-control-allow-methods", b"GET,PUT,POST,DELETE,OPTIONS"),
+]
+
+
+logger = logging.getLogger(__name__)
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = MultiDict(parse_qsl(scope["query_string"].decode(), keep_blank_values=True))
+        self.headers = {name.decode().lower(): value.decode() for name, value in scope.get("headers", [])}
+        self.client = scope.get("client")
+        self.body = body
+
+    def client_key(self, api_keys):
+        return client_key_of(self.headers.get("x-api-key"), self.client[0] if self.client else None, api_keys)
+
+    def get_json(self, silent=False):
+        """
+        Returns the JSON body, None without one. An invalid body answers 400, or returns None when silent.
+        """
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError:
+            if silent:
+                return None
+            abort(400)
+
+
+def load_config(test_config=None):
+    settings = {key: getattr(config, key) for key in dir(config) if key.isupper()}
+    settings.update(test_config or {})
+    return settings
+
+
+def async_engine_options(settings):
+    """
+    Builds the asyncio engine URL and options from the same settings as the WSGI app
+    """
+    url = make_url(settings["SQLALCHEMY_DATABASE_URI"])
+    backend = url.get_backend_name()
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+    options = {}
+    if backend == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            options["poolclass"] = StaticPool
+        elif not os.path.isabs(url.database):
+            # Flask-SQLAlchemy resolves relative SQLite paths against the flaskr package
+            url = url.set(database=os.path.join(os.path.dirname(__file__), url.database))
+    else:
+        options.update({
+            "pool_size": settings["DB_POOL_SIZE"],
+            "max_overflow": settings["DB_MAX_OVERFLOW"],
+            "pool_timeout": settings["DB_POOL_TIMEOUT"],
+            "pool_recycle": settings["DB_POOL_RECYCLE"],
+            "pool_pre_ping": settings["DB_POOL_PRE_PING"],
+        })
+        if settings["DB_STATEMENT_TIMEOUT_MS"]:
+            timeout = str(settings["DB_STATEMENT_TIMEOUT_MS"])
+            options["connect_args"] = {"server_settings": {"statement_timeout": timeout}}
+    return url, options
+
+
+class AsyncTriviaApp:
+    """
+    ASGI application serving the Trivia API routes with an asyncio database engine
+    """
+
+    def __init__(self, settings):
+        self.config = settings
+        url, options = async_engine_options(settings)
+        self.engine = create_async_engine(url, **options)
+        self.sessions = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.question_pool = QuestionPool(settings["QUIZ_POOL_TTL"])
+        self.quiz_sessions = QuizSessionStore(settings["QUIZ_SESSION_TTL"], settings["QUIZ_SESSION_LIMIT"])
+        self.search_index = PostgresSearch() if url.get_backend_name() == "postgresql" \
+            else MemorySearch(settings["SEARCH_INDEX_TTL"])
+        # Held while the pool or the search index loads, so concurrent requests wait for one load
+        self.pool_lock = asyncio.Lock()
+        self.pool_refresh = None
+        self.search_lock = asyncio.Lock()
+        self.events = Broker(settings["SSE_HISTORY"])
+        self.fanouts = {}
+        self.rate_limiter = create_rate_limiter(settings)
+        limit = admission_limit(settings)
+        self.admission = AsyncAdmissionControl(limit, settings["ADMISSION_TIMEOUT"]) if limit else None
+        self.routes = [
+            ("POST", r"/categories", self.create_category),
+            ("GET", r"/categories", self.retrieve_categories),
+            ("GET", r"/categories/(?P<category_id>\d+)/questions", self.retrieve_category_questions),
+            ("POST", r"/questions", self.create_question),
+            ("GET", r"/questions", self.retrieve_questions),
+            ("DELETE", r"/questions/(?P<question_id>\d+)", self.delete_question),
+            ("POST", r"/quizzes", self.get_quiz),
+            ("POST", r"/quizzes/sessions", self.create_quiz_session),
+            ("POST", r"/quizzes/sessions/(?P<session_id>[^/]+)/next", self.get_session_quiz),
+            ("DELETE", r"/quizzes/sessions/(?P<session_id>[^/]+)", self.delete_quiz_session),
+        ]
+        self.routes = [(method, re.compile(pattern + "$"), handler) for method, pattern, handler in self.routes]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        if scope["path"] == "/events" and scope["method"] == "GET":
+            return await self.stream_events(scope, receive, send)
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        status, payload, headers = await self.dispatch(Request(scope, body))
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")] + CORS_HEADERS + headers,
+        })
+        await send({"type": "http.response.body", "body": json.dumps(payload, sort_keys=True).encode()})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def fanout(self):
+        """
+        Returns the LoopFanout of the running event loop, subscribing it to the broker on first use
+        """
+        loop = asyncio.get_running_loop()
+        fanout = self.fanouts.get(loop)
+        if fanout is None:
+            fanout = self.fanouts[loop] = LoopFanout(loop)
+            self.events.subscribe(fanout)
+        return fanout
+
+    async def stream_events(self, scope, receive, send):
+        """
+        Streams change events until the client disconnects, with a keepalive comment
+        after SSE_KEEPALIVE_SECONDS without events
+        """
+        last_event_id = parse_last_event_id(dict(scope["headers"]).get(b"last-event-id", b"").decode())
+        subscriber = AsyncSubscriber(self.config["SSE_QUEUE_SIZE"])
+        fanout = self.fanout()
+        fanout.queues.add(subscriber)
+        chunk, last_id = opening(self.events.replay(last_event_id))
+        disconnected = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        getter = None
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"),
+                            (b"x-accel-buffering", b"no")] + CORS_HEADERS,
+            })
+            while chunk is not None:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+                if getter is None:
+                    getter = asyncio.ensure_future(subscriber.queue.get())
+                done, _ = await asyncio.wait({getter, disconnected}, timeout=self.config["SSE_KEEPALIVE_SECONDS"],
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    chunk = None
+                elif getter not in done:
+                    chunk = KEEPALIVE
+                else:
+                    event = getter.result()
+                    getter = None
+                    if subscriber.overflowed:
+                        subscriber.reset()
+                        chunk = RESET
+                    elif event.id > last_id:
+                        last_id = event.id
+                        chunk = event.encode()
+                    else:
+                        chunk = ""
+        finally:
+            fanout.queues.discard(subscriber)
+            disconnected.cancel()
+            if getter is not None:
+                getter.cancel()
+
+    @staticmethod
+    async def wait_for_disconnect(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    async def dispatch(self, request):
+        """
+        Runs the handler of the request and returns the status, payload and extra headers of the response.
+        Handlers run once admitted under MAX_CONCURRENT_REQUESTS, like the requests of the WSGI app.
+        """
+        headers = []
+        admitted = False
+        try:
+            if self.admission is not None:
+                admitted = await self.admission.admit()
+                if not admitted:
+                    raise ServiceUnavailable(retry_after=1)
+            return 200, await self.route(request), headers
+        except HTTPException as error:
+            status = error.code
+            if status in (429, 503):
+                headers = [(b"retry-after", str(error.retry_after or 1).encode())]
+        except Exception:
+            logger.exception("Exception on %s %s", request.method, request.path)
+            status = 500
+        finally:
+            if admitted:
+                self.admission.release()
+        return status, error_payload(status), headers
+
+    async def route(self, request):
+        path_matched = False
+        for method, pattern, handler in self.routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            path_matched = True
+            if method == request.method:
+                async with self.sessions() as session:
+                    return await handler(session, request, **match.groupdict())
+        abort(405 if path_matched else 404)
+
+    def check_rate_limit(self, request, name):
+        """
+        Takes a token from the RATE_LIMITS bucket called name, or answers 429 like the WSGI app
+        """
+        retry_after = self.rate_limiter.take(name, request.client_key(self.config["RATELIMIT_API_KEYS"]),
+                                           self.config["RATE_LIMITS"], logger)
+        if retry_after is not None:
+            raise TooManyRequests(retry_after=retry_after)
+
+    """
+    Shared helpers
+
+    """
+
+    async def category_name(self, session, category_id):
+        return (await session.execute(select(Category.name).where(Category.id == category_id))).scalar()
+
+    async def load_questions(self, session, question_ids):
+        rows = await session.execute(select(*QUESTION_COLUMNS).where(Question.id.in_(question_ids)))
+        questions = {row.id: format_question_row(row) for row in rows}
+        return [questions[question_id] for question_id in question_ids if question_id in questions]
+
+    async def count(self, session, selection):
+        if isinstance(selection, list):
+            return len(selection)
+        return (await session.execute(count_statement(selection))).scalar()
+
+    async def paginate(self, session, request, selection, rank=None):
+        """
+        Async counterpart of utils.paginate: pages through a select() of Question,
+        or a list of question ids, by `cursor` or `page`
+        """
+        page = Page(request.args)
+        if isinstance(selection, list):
+            questions = await self.load_questions(session, page.ids(selection, rank))
+        else:
+            questions = page.questions(await session.execute(page.statement(selection, rank)))
+        total = await self.count(session, selection) if page.counted else None
+        return page.fields(questions, lambda: total)
+
+    async def ensure_question_pool(self, session):
+        """
+        Loads the question pool on first use. A stale pool keeps being served while a background task
+        rebuilds it, like the WSGI app's rebuild thread.
+        """
+        pool = self.question_pool
+        if pool.buckets is None:
+            async with self.pool_lock:
+                if pool.buckets is None and pool.start_refresh():
+                    await self.load_question_pool(session)
+        elif pool.is_stale() and pool.start_refresh():
+            self.pool_refresh = asyncio.create_task(self.refresh_question_pool())
+
+    async def load_question_pool(self, session):
+        statement = select(Question.id, Question.category_id, Question.difficulty)
+        try:
+            self.question_pool.fill((await session.execute(statement)).all())
+        except Exception:
+            self.question_pool.abandon_refresh()
+            raise
+
+    async def refresh_question_pool(self):
+        try:
+            async with self.sessions() as session:
+                await self.load_question_pool(session)
+        except Exception:
+            logger.exception("Rebuilding the quiz question pools failed")
+
+    async def search(self, session, term):
+        """
+        Returns the matches for term and what they are ranked by. The in-memory index is (re)built here, with this
+        app's engine, as MemorySearch.search only reads the index it holds.
+        """
+        index = self.search_index
+        if isinstance(index, MemorySearch) and index.is_stale():
+            async with self.search_lock:
+                if index.is_stale():
+                    index.fill((await session.execute(select(Question.id, Question.question, Question.answer))).all())
+        return index.ranked(term)
+
+    async def adjust_stats(self, session, counts):
+        """
+        Adds the {(category_id, difficulty): change} counts to category_stats in the session's transaction
+        """
+        adjustment = CategoryStat.adjustment(self.engine.dialect.name, counts)
+        if adjustment is not None:
+            await session.execute(*adjustment)
+
+    def changed(self, table, action, record):
+        """
+        Keeps this app's in-memory pools in step with a committed change and notifies the model listeners
+        """
+        if table == "questions" and action == "insert":
+            self.question_pool.add(record.id, record.category_id, record.difficulty)
+            if isinstance(self.search_index, MemorySearch):
+                self.search_index.add(record.id, record.question, record.answer)
+        elif table == "questions" and action == "delete":
+            self.question_pool.remove(record.id, record.category_id, record.difficulty)
+            if isinstance(self.search_index, MemorySearch):
+                self.search_index.remove(record.id)
+        event = change_event(table, action, record)
+        if event is not None:
+            self.events.publish(*event)
+        notify_change(table, action, record)
+
+    """
+    Category
+
+    """
+
+    async def create_category(self, session, request):
+        name = new_category_name(request.get_json())
+        statement = select(Category.id).where(func.lower(Category.name) == name.lower())
+        if (await session.execute(statement)).first():
+            abort(409)
+        category = Category(name=name)
+        try:
+            session.add(category)
+            await session.commit()
+        except Exception:
+            abort(422)
+        self.changed("categories", "insert", category)
+        return {"success": True, "created": category.id}
+
+    async def retrieve_categories(self, session, request):
+        categories = (await session.execute(select(Category.id, Category.name).order_by(Category.name))).all()
+        return categories_payload(categories)
+
+    async def retrieve_category_questions(self, session, request, category_id):
+        category_name = await self.category_name(session, int(category_id))
+        if not category_name:
+            abort(404)
+        selection = select(Question).where(Question.category_id == int(category_id)).order_by(Question.id)
+        current_questions, pagination = await self.paginate(session, request, selection)
+        return questions_payload(current_questions, pagination, category_name)
+
+    async def requested_category(self, session, request):
+        cur_cat_id = request.args.get("category", None, type=int)
+        name = await self.category_name(session, cur_cat_id) if cur_cat_id else None
+        return current_category(cur_cat_id, name)
+
+    """
+    Question
+
+    """
+
+    async def create_question(self, session, request):
+        body = request.get_json()
+        category = await self.requested_category(session, request)
+        action, value = question_request(body)
+        if action == "search":
+            self.check_rate_limit(request, "search")
+            selection, rank = await self.search(session, value)
+            current_questions, pagination = await self.paginate(session, request, selection, rank)
+            if len(current_questions) == 0 and not pagination.get("totalQuestions"):
+                abort(404)
+            return questions_payload(current_questions, pagination, category)
+        try:
+            question = Question(**value)
+            session.add(question)
+            await self.adjust_stats(session, {(question.category_id, question.difficulty): 1})
+            await session.commit()
+        except Exception:
+            abort(422)
+        self.changed("questions", "insert", question)
+        return {"success": True}
+
+    async def retrieve_questions(self, session, request):
+        category = await self.requested_category(session, request)
+        current_questions, pagination = await self.paginate(session, request, select(Question).order_by(Question.id))
+        if len(current_questions) == 0:
+            abort(404)
+        categories = (await session.execute(select(Category.id, Category.name))).all()
+        return questions_payload(current_questions, pagination, category, categories)
+
+    async def delete_question(self, session, request, question_id):
+        question_id = int(question_id)
+        try:
+            question = await session.get(Question, question_id)
+            await session.delete(question)
+            await self.adjust_stats(session, {(question.category_id, question.difficulty): -1})
+            await session.commit()
+        except Exception:
+            abort(422)
+        self.changed("questions", "delete", question)
+        return {"success": True, "deleted": question_id}
+
+    """
+    Quiz
+
+    """
+
+    async def draw_question(self, session, category_id, exclude, difficulty=None):
+        await self.ensure_question_pool(session)
+        exclude = set(exclude)
+        while True:
+            question_id = self.question_pool.choose_near(category_id, difficulty, exclude)
+            if question_id is None:
+                return None
+            question = await session.get(Question, question_id)
+            if question is not None and (category_id is None or question.category_id == category_id):
+                return question
+            self.question_pool.remove(question_id)
+            exclude.add(question_id)
+
+    async def get_quiz(self, session, request):
+        self.check_rate_limit(request, "quizzes")
+        body = request.get_json()
+        category = quiz_category(body)
+        difficulty = quiz_difficulty(body, self.config)
+        try:
+            question = await self.draw_question(session, category, previous_questions(body), difficulty)
+        except Exception:
+            abort(422)
+        return quiz_payload(question.format() if question else None)
+
+    async def create_quiz_session(self, session, request):
+        self.check_rate_limit(request, "quizzes")
+        body = request.get_json()
+        category = quiz_category(body)
+        if category is not None and await self.category_name(session, category) is None:
+            abort(404)
+        await self.ensure_question_pool(session)
+        session_id, quiz = open_quiz_session(self.quiz_sessions, self.question_pool, category,
+                                             bool(body.get("adaptive")), self.config)
+        return session_started_payload(session_id, quiz)
+
+    async def get_session_quiz(self, session, request, session_id):
+        self.check_rate_limit(request, "quizzes")
+        quiz = self.quiz_sessions.get(session_id)
+        if quiz is None:
+            abort(404)
+        record_session_answer(quiz, request.get_json(silent=True) or {})
+        await self.ensure_question_pool(session)
+        try:
+            question = await self.next_session_question(session, quiz)
+        except Exception:
+            abort(422)
+        return session_question_payload(quiz, question.format() if question else None)
+
+    @staticmethod
+    async def next_session_question(session, quiz):
+        while True:
+            question_id = quiz.next_id()
+            if question_id is None:
+                return None
+            question = await session.get(Question, question_id)
+            if question is not None:
+                return question
+
+    async def delete_quiz_session(self, session, request, session_id):
+        return session_deleted_payload(session_id, self.quiz_sessions.end(session_id))
+
+
+def create_asgi_app(test_config=None):
+    return AsyncTriviaApp(load_config(test_config))
@@ -0,0 +1,210 @@
+"""
+Request parsing and response payloads of the API routes, shared by the WSGI app (flaskr) and
+the async app (flaskr.asgi). The two apps only differ in how they reach the database, so the
+validation and the response of each route are written once, here. Invalid requests raise
+werkzeug's HTTPExceptions, which both apps answer with the same JSON errors.
+"""
+from werkzeug.exceptions import abort
+
+from quiz import AdaptiveQuizSession, DIFFICULTIES, next_difficulty
+
+ERROR_MESSAGES = {
+    400: "bad request",
+    404: "resource not found",
+    405: "method not allowed",
+    409: "resource exists",
+    413: "request entity too large",
+    422: "unprocessable",
+    429: "too many requests",
+    500: "internal server error",
+    503: "service unavailable",
+}
+
+
+def error_payload(status):
+    return {"success": False, "error": status, "message": ERROR_MESSAGES[status]}
+
+
+def json_object(body):
+    """
+    Returns a request body that has to be a JSON object, or answers 400
+    """
+    if not isinstance(body, dict):
+        abort(400)
+    return body
+
+
+"""
+Category
+
+"""
+
+
+def new_category_name(body):
+    """
+    Returns the title-cased name of the category created by POST /categories
+    """
+    name = json_object(body).get("name", None)
+    if not name or not isinstance(name, str):
+        abort(400)
+    return name.title()
+
+
+def current_category(category_id, name):
+    """
+    Returns the currentCategory of a question listing filtered by the `category` argument: "All"
+    without one, else the name of the category, which has to exist
+    """
+    if not category_id:
+        return "All"
+    if name is None:
+        abort(404)
+    return name
+
+
+def categories_payload(categories):
+    """
+    Returns the response of GET /categories for (id, name) pairs
+    """
+    if len(categories) == 0:
+        abort(404)
+    return {
+        "success": True,
+        "categories": {cat_id: name for cat_id, name in categories}
+    }
+
+
+"""
+Question
+
+"""
+
+
+def question_request(body):
+    """
+    Returns ("search", term) for a search through POST /questions, or ("create", columns) with the
+    columns of the question to create. Answers 400 to anything else.
+    """
+    body = json_object(body)
+    search_term = body.get("searchTerm", None)
+    if search_term:
+        return "search", search_term
+    columns = {
+        "question": body.get("question", None),
+        "answer": body.get("answer", None),
+        "category_id": body.get("category", None),
+        "difficulty": body.get("difficulty", None),
+    }
+    if not all(columns.values()):
+        abort(400)
+    return "create", columns
+
+
+def questions_payload(questions, pagination, current_category, categories=None):
+    """
+    Returns the response of a question listing or search, with the pagination fields of the page
+    """
+    payload = {
+        "success": True,
+        "questions": questions,
+        **pagination,
+        "currentCategory": current_category
+    }
+    if categories is not None:
+        payload["categories"] = {cat_id: name for cat_id, name in categories}
+    return payload
+
+
+"""
+Quiz
+
+"""
+
+
+def quiz_category(body):
+    """
+    Returns the category of a quiz request, None for all categories (id 0).
+    Answers 400 when quiz_category is missing or its id is not a number.
+    """
+    try:
+        cat_id = int(json_object(body)["quiz_category"]["id"])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    return cat_id if cat_id > 0 else None
+
+
+def previous_questions(body):
+    return body.get("previous_questions", None) or []
+
+
+def quiz_difficulty(body, config):
+    """
+    Returns the difficulty of the question to draw for an adaptive POST /quizzes request, or None
+    when the request is not adaptive
+    """
+    if not body.get("adaptive"):
+        return None
+    try:
+        difficulty = next_difficulty(int(body.get("difficulty") or config["QUIZ_START_DIFFICULTY"]),
+                                     body.get("recent_answers") or [], config["QUIZ_ADAPTIVE_WINDOW"])
+    except (TypeError, ValueError):
+        abort(400)
+    if difficulty not in DIFFICULTIES:
+        abort(400)
+    return difficulty
+
+
+def quiz_payload(question):
+    """
+    Returns the response of POST /quizzes for a formatted question, or for None once all were played
+    """
+    if question:
+        return {
+            "success": True,
+            "question": question
+        }
+    return {
+        "success": True
+    }
+
+
+def session_started_payload(session_id, session):
+    return {
+        "success": True,
+        "session_id": session_id,
+        "totalQuestions": session.remaining()
+    }
+
+
+def record_session_answer(session, body):
+    """
+    Hands the answer to the previous question, sent to POST /quizzes/sessions/{id}/next, to an adaptive session
+    """
+    if "correct" in body and isinstance(session, AdaptiveQuizSession):
+        session.record(body["correct"])
+
+
+def session_question_payload(session, question):
+    """
+    Returns the response of POST /quizzes/sessions/{id}/next for a formatted question, or for None
+    once all were played
+    """
+    if question:
+        return {
+            "success": True,
+            "question": question,
+            "remaining": session.remaining()
+        }
+    return {
+        "success": True,
+        "remaining": 0
+    }
+
+
+def session_deleted_payload(session_id, ended):
+    if not ended:
+        abort(404)
+    return {
+        "success": True,
+        "deleted": session_id
+    }
@@ -0,0 +1,157 @@
+import csv
+import io
+import json
+import time
+from collections import Counter
+
+import click
+from flask.cli import with_appcontext
+
+from models import Category, CategoryStat, db, notify_change, Question
+
+BATCH_SIZE = 5000
+# Rejected rows listed in a report, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+FIELDS = ("question", "answer", "difficulty", "category_id")
+
+
+def read_ndjson(lines):
+    """
+    Yields (line number, row) for each non-blank line of an NDJSON stream.
+    Lines that are not JSON objects are yielded with the error message as row.
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as exception:
+            yield line_number, f"invalid JSON: {exception.msg}"
+            continue
+        yield line_number, row if isinstance(row, dict) else "expected a JSON object"
+
+
+def read_csv(lines):
+    """
+    Yields (line number, row) for each record of a CSV stream with a header line
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def validate_row(row, category_ids):
+    """
+    Returns the column values of a row to import, raising ValueError if it does not fit the Question schema.
+    The category may be given as `category` (like POST /questions) or `category_id`.
+    """
+    question = row.get("question")
+    answer = row.get("answer")
+    if not isinstance(question, str) or not question.strip():
+        raise ValueError("missing question")
+    if not isinstance(answer, str) or not answer.strip():
+        raise ValueError("missing answer")
+    try:
+        difficulty = int(row.get("difficulty"))
+        category_id = int(row.get("category_id", row.get("category")))
+    except (TypeError, ValueError):
+        raise ValueError("difficulty and category must be integers")
+    if not 1 <= difficulty <= 5:
+        raise ValueError("difficulty must be between 1 and 5")
+    if category_id not in category_ids:
+        raise ValueError(f"unknown category {category_id}")
+    return {"question": question, "answer": answer, "difficulty": difficulty, "category_id": category_id}
+
+
+def insert_batch(rows):
+    """
+    Inserts rows in the current transaction, with COPY on Postgres and executemany elsewhere
+    """
+    connection = db.session.connection()
+    if connection.dialect.name == "postgresql":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[field] for field in FIELDS])
+        buffer.seek(0)
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY questions ({', '.join(FIELDS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    else:
+        connection.execute(Question.__table__.insert(), rows)
+
+
+def import_questions(lines, format="ndjson", batch_size=BATCH_SIZE):
+    """
+    Imports the questions of an NDJSON or CSV stream of text lines, committing every batch_size rows.
+    Only one batch is held in memory. Returns a report of the imported and rejected rows
+    along with the throughput of each batch.
+    """
+    reader = read_csv if format == "csv" else read_ndjson
+    category_ids = {category_id for category_id, in db.session.query(Category.id)}
+    report = {"imported": 0, "rejected": 0, "errors": [], "batches": []}
+    batch = []
+
+    def flush():
+        started = time.perf_counter()
+        try:
+            insert_batch(batch)
+            CategoryStat.adjust(Counter((row["category_id"], row["difficulty"]) for row in batch))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        seconds = time.perf_counter() - started
+        report["imported"] += len(batch)
+        report["batches"].append({
+            "rows": len(batch),
+            "seconds": round(seconds, 4),
+            "rowsPerSecond": round(len(batch) / seconds) if seconds else None
+        })
+        batch.clear()
+
+    try:
+        for line_number, row in reader(lines):
+            try:
+                if isinstance(row, str):
+                    raise ValueError(row)
+                batch.append(validate_row(row, category_ids))
+            except ValueError as exception:
+                report["rejected"] += 1
+                if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                    report["errors"].append({"line": line_number, "error": str(exception)})
+                continue
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    finally:
+        if report["imported"]:
+            notify_change("questions", "bulk")
+    return report
+
+
+def decode_lines(stream, encoding="utf-8"):
+    """
+    Yields the text lines of a binary stream one at a time
+    """
+    for line in stream:
+        yield line.decode(encoding)
+
+
+@click.command("import-questions")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "format", type=click.Choice(["ndjson", "csv"]), default=None,
+              help="File format, guessed from the file extension by default.")
+@click.option("--batch-size", default=BATCH_SIZE, show_default=True, help="Rows per transaction.")
+@with_appcontext
+def import_questions_command(path, format, batch_size):
+    """Bulk imports questions from an NDJSON or CSV file."""
+    if format is None:
+        format = "csv" if path.lower().endswith(".csv") else "ndjson"
+    with open(path, encoding="utf-8", newline="") as lines:
+        report = import_questions(lines, format, batch_size)
+    for number, batch in enumerate(report["batches"], start=1):
+        click.echo(f"batch {number}: {batch['rows']} rows in {batch['seconds']}s ({batch['rowsPerSecond']} rows/s)")
+    for error in report["errors"]:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(f"imported {report['imported']} questions, rejected {report['rejected']}")
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's context: a statement that fails never reaches after_cursor_execute
+    context.query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - context.query_started
+    if not has_request_context() or "sql_queries" not in g:
+        return
+    g.sql_queries += 1
+    g.sql_seconds += duration
+    g.sql_statements[statement] += 1
+    if duration > g.sql_slowest[0]:
+        g.sql_slowest = (duration, statement)
+
+
+def install_query_hooks():
+    """
+    Times every statement run by any engine and adds it to the current request's totals
+    """
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+
+class Metrics:
+    """
+    Request and SQL totals per endpoint, rendered in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.request_seconds = Counter()
+        self.sql_queries = Counter()
+        self.sql_seconds = Counter()
+        self.sql_slowest = {}
+        self.gauges = []
+
+    def record(self, endpoint, status, seconds, queries, sql_seconds, slowest):
+        with self.lock:
+            self.requests[(endpoint, status)] += 1
+            self.request_seconds[endpoint] += seconds
+            self.sql_queries[endpoint] += queries
+            self.sql_seconds[endpoint] += sql_seconds
+            self.sql_slowest[endpoint] = max(self.sql_slowest.get(endpoint, 0), slowest)
+
+    def register(self, name, kind, help, collect):
+        """
+        Adds a metric whose {labels tuple: value} samples are read from collect() at render time
+        """
+        self.gauges.append((name, kind, help, collect))
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(samples.items()):
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        with self.lock:
+            family("trivia_requests_total", "counter", "Requests handled, by endpoint and status.",
+                   {(("endpoint", endpoint), ("status", status)): count
+                    for (endpoint, status), count in self.requests.items()})
+            family("trivia_request_duration_seconds_total", "counter", "Time spent handling requests.",
+                   {(("endpoint", endpoint),): round(seconds, 6) for endpoint, seconds in self.request_seconds.items()})
+            family("trivia_sql_queries_total", "counter", "SQL statements run while handling requests.",
+                   {(("endpoint", endpoint),): count for endpoint, count in self.sql_queries.items()})
+            family("trivia_sql_duration_seconds_total", "counter", "Time spent running SQL statements.",
+                   {(("endpoint", endpoint),): round(seconds, 6) for endpoint, seconds in self.sql_seconds.items()})
+            family("trivia_sql_slowest_query_seconds", "gauge", "Slowest SQL statement seen, by endpoint.",
+                   {(("endpoint", endpoint),): round(seconds, 6) for endpoint, seconds in self.sql_slowest.items()})
+        for name, kind, help, collect in self.gauges:
+            family(name, kind, help, collect())
+        return "\n".join(lines) + "\n"
+
+
+def start_request():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+    g.sql_statements = Counter()
+    g.sql_slowest = (0.0, None)
+
+
+def finish_request(response):
+    """
+    Adds the SQL totals of the request to its Server-Timing header and to the metrics,
+    and logs statements repeated often enough to point at an N+1 query pattern
+    """
+    if "sql_queries" not in g:
+        return response
+    seconds = time.perf_counter() - g.request_started
+    slowest, statement = g.sql_slowest
+    response.headers.add("Server-Timing", f'db;dur={g.sql_seconds * 1000:.2f};desc="{g.sql_queries} queries"')
+    response.headers.add("Server-Timing", f"db-slowest;dur={slowest * 1000:.2f}")
+    response.headers.add("Server-Timing", f"app;dur={seconds * 1000:.2f}")
+    endpoint = request.endpoint or "unmatched"
+    current_app.extensions["metrics"].record(endpoint, response.status_code, seconds, g.sql_queries,
+                                             g.sql_seconds, slowest)
+
+    threshold = current_app.config["SQL_REPEAT_WARN_THRESHOLD"]
+    for repeated, count in g.sql_statements.items():
+        if threshold and count >= threshold:
+            current_app.logger.warning("Possible N+1 query in %s: statement ran %d times: %s",
+                                       endpoint, count, repeated)
+    if statement is not None and slowest * 1000 >= current_app.config["SQL_SLOW_QUERY_MS"]:
+        current_app.logger.warning("Slow query in %s took %.1fms: %s", endpoint, slowest * 1000, statement)
+    return response
+
+
+def init_instrumentation(app):
+    app.extensions["metrics"] = Metrics()
+    app.before_request(start_request)
+    app.after_request(finish_request)
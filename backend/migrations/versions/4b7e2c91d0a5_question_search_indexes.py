@@ -0,0 +1,35 @@
+"""question search indexes
+
+Revision ID: 4b7e2c91d0a5
+Revises: e16d1aa13dcb
+Create Date: 2026-10-18 09:12:04.518203
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '4b7e2c91d0a5'
+down_revision = 'e16d1aa13dcb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Full-text and trigram indexes only exist on Postgres, other databases use search.MemorySearch
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute(
+        "CREATE INDEX ix_questions_search ON questions "
+        "USING gin (to_tsvector('english', question || ' ' || answer))"
+    )
+    op.execute('CREATE INDEX ix_questions_question_trgm ON questions USING gin (question gin_trgm_ops)')
+    op.execute('CREATE INDEX ix_questions_answer_trgm ON questions USING gin (answer gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('DROP INDEX IF EXISTS ix_questions_answer_trgm')
+    op.execute('DROP INDEX IF EXISTS ix_questions_question_trgm')
+    op.execute('DROP INDEX IF EXISTS ix_questions_search')
@@ -0,0 +1,34 @@
+"""scores
+
+Revision ID: 5e9b0d4c7a12
+Revises: c3f81a7d52e4
+Create Date: 2026-10-18 16:02:44.871305
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5e9b0d4c7a12'
+down_revision = 'c3f81a7d52e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('scores',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('player', sa.String(length=80), nullable=False),
+    sa.Column('category_id', sa.Integer(), nullable=True),
+    sa.Column('question_id', sa.Integer(), nullable=True),
+    sa.Column('correct', sa.Boolean(), nullable=False),
+    sa.Column('answered_at', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+    sa.ForeignKeyConstraint(['category_id'], ['categories.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_scores_category_id_player', 'scores', ['category_id', 'player'])
+
+
+def downgrade():
+    op.drop_index('ix_scores_category_id_player', table_name='scores')
+    op.drop_table('scores')
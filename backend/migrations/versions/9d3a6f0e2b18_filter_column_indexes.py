@@ -0,0 +1,26 @@
+"""filter column indexes
+
+Revision ID: 9d3a6f0e2b18
+Revises: 4b7e2c91d0a5
+Create Date: 2026-10-18 10:03:47.220911
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9d3a6f0e2b18'
+down_revision = '4b7e2c91d0a5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The leading category_id column also serves filters on category_id alone
+    op.create_index('ix_questions_category_id_difficulty', 'questions', ['category_id', 'difficulty'])
+    op.create_index('ix_categories_name_lower', 'categories', [sa.text('lower(name)')], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_categories_name_lower', table_name='categories')
+    op.drop_index('ix_questions_category_id_difficulty', table_name='questions')
@@ -0,0 +1,36 @@
+"""category stats
+
+Revision ID: c3f81a7d52e4
+Revises: 9d3a6f0e2b18
+Create Date: 2026-10-18 14:21:09.538104
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c3f81a7d52e4'
+down_revision = '9d3a6f0e2b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('category_stats',
+    sa.Column('category_id', sa.Integer(), nullable=False),
+    sa.Column('difficulty', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['category_id'], ['categories.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('category_id', 'difficulty')
+    )
+    # Counts the questions already in the database
+    op.execute(
+        'INSERT INTO category_stats (category_id, difficulty, count) '
+        'SELECT category_id, difficulty, count(*) FROM questions '
+        'WHERE category_id IS NOT NULL AND difficulty IS NOT NULL '
+        'GROUP BY category_id, difficulty'
+    )
+
+
+def downgrade():
+    op.drop_table('category_stats')
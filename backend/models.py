@@ -1,8 +1,15 @@
-from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, String, Integer
+import os
+from collections import Counter
 
-db = SQLAlchemy()
+from sqlalchemy import Boolean, Column, DateTime, String, Integer, Index, func, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import column_property
+
+from instrumentation import install_query_hooks
+from pooling import engine_options
+from replicas import init_replicas, RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
 
 """
 setup_db(app)
@@ -10,11 +17,52 @@ setup_db(app)
 """
 
 
-def setup_db(app):
+def setup_db(app, test_config=None):
     app.config.from_object('config')
+    if test_config:
+        app.config.update(test_config)
+    init_replicas(app)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
     db.app = app
     db.init_app(app)
-    migrate = Migrate(app, db)
+    install_query_hooks()
+    init_migrate(app)
+
+
+def init_migrate(app):
+    """
+    Registers Flask-Migrate for the flask command, which serves `flask db`. Flask-Migrate loads
+    Alembic, a large share of the import time, so app servers and tests do not import it.
+    """
+    if os.environ.get("FLASK_RUN_FROM_CLI") == "true":
+        from flask_migrate import Migrate
+        Migrate(app, db)
+
+
+"""
+Change notifications
+
+"""
+
+change_listeners = []
+# Bumped on every change to a table, used to build ETags without reading the data
+table_versions = {'categories': 0, 'questions': 0}
+
+
+def on_change(listener):
+    """
+    Registers listener(table, action, record) to be called after each committed change.
+    action is "insert", "update" or "delete". Changes made with set-based statements
+    are reported as "bulk" with no record.
+    """
+    change_listeners.append(listener)
+    return listener
+
+
+def notify_change(table, action, record=None):
+    table_versions[table] = table_versions.get(table, 0) + 1
+    for listener in change_listeners:
+        listener(table, action, record)
 
 
 """
@@ -28,7 +76,12 @@ class Category(db.Model):
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False, unique=True)
-    questions = db.relationship('Question', backref='category', lazy=True)
+    # Questions are deleted with the category by Category.delete, not nulled out one by one
+    questions = db.relationship('Question', backref='category', lazy=True, passive_deletes='all')
+
+    __table_args__ = (
+        Index('ix_categories_name_lower', func.lower(name), unique=True),
+    )
 
     def __init__(self, name):
         self.name = name
@@ -36,12 +89,17 @@ class Category(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        notify_change('categories', 'insert', self)
 
     def delete(self):
-        for question in self.questions:
-            db.session.delete(question)
+        db.session.execute(CategoryStat.__table__.delete().where(CategoryStat.category_id == self.id))
+        db.session.execute(Score.__table__.delete().where(Score.category_id == self.id))
+        deleted = db.session.execute(Question.__table__.delete().where(Question.category_id == self.id))
         db.session.delete(self)
         db.session.commit()
+        if deleted.rowcount:
+            notify_change('questions', 'bulk')
+        notify_change('categories', 'delete', self)
 
     def format(self):
         return {
@@ -62,8 +120,16 @@ class Question(db.Model):
     id = Column(Integer, primary_key=True)
     question = Column(String, nullable=False)
     answer = Column(String, nullable=False)
-    difficulty = Column(Integer, nullable=False)
-    category_id = Column(Integer, db.ForeignKey('categories.id'), nullable=False)
+    # active_history loads the old value of an expired attribute before it is replaced,
+    # so update() always knows which category_stats row to move the question from
+    difficulty = column_property(Column(Integer, nullable=False), active_history=True)
+    category_id = column_property(Column(Integer, db.ForeignKey('categories.id'), nullable=False),
+                                  active_history=True)
+
+    # Also serves filters on category_id alone
+    __table_args__ = (
+        Index('ix_questions_category_id_difficulty', 'category_id', 'difficulty'),
+    )
 
     def __init__(self, question, answer, category_id, difficulty):
         self.question = question
@@ -73,14 +139,26 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
+        CategoryStat.adjust({(self.category_id, self.difficulty): 1})
         db.session.commit()
+        notify_change('questions', 'insert', self)
 
     def update(self):
+        state = inspect(self).attrs
+        category, difficulty = state.category_id.history, state.difficulty.history
+        if category.deleted or difficulty.deleted:
+            counts = Counter()
+            counts[(category.deleted or category.unchanged)[0], (difficulty.deleted or difficulty.unchanged)[0]] -= 1
+            counts[self.category_id, self.difficulty] += 1
+            CategoryStat.adjust(counts)
         db.session.commit()
+        notify_change('questions', 'update', self)
 
     def delete(self):
         db.session.delete(self)
+        CategoryStat.adjust({(self.category_id, self.difficulty): -1})
         db.session.commit()
+        notify_change('questions', 'delete', self)
 
     def format(self):
         return {
@@ -90,3 +168,86 @@ class Question(db.Model):
             'category_id': self.category_id,
             'difficulty': self.difficulty
         }
+
+
+"""
+CategoryStat
+
+"""
+
+
+class CategoryStat(db.Model):
+    """
+    Number of questions of each category and difficulty. Kept up to date in the same
+    transaction as the questions, so counts are read without scanning the questions table.
+    """
+    __tablename__ = 'category_stats'
+
+    category_id = Column(Integer, db.ForeignKey('categories.id', ondelete='CASCADE'), primary_key=True)
+    difficulty = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    @staticmethod
+    def adjustment(dialect_name, counts):
+        """
+        Returns the upsert statement and rows adding the {(category_id, difficulty): change} counts,
+        or None when nothing changes
+        """
+        rows = [{'category_id': category_id, 'difficulty': difficulty, 'count': change}
+                for (category_id, difficulty), change in counts.items() if change]
+        if not rows:
+            return None
+        insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+        statement = insert(CategoryStat.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements=['category_id', 'difficulty'],
+            set_={'count': CategoryStat.__table__.c.count + statement.excluded['count']}
+        )
+        return statement, rows
+
+    @staticmethod
+    def adjust(counts):
+        """
+        Adds the {(category_id, difficulty): change} counts in the current transaction
+        """
+        adjustment = CategoryStat.adjustment(db.engine.dialect.name, counts)
+        if adjustment is not None:
+            db.session.execute(*adjustment)
+
+
+"""
+Score
+
+"""
+
+
+class Score(db.Model):
+    """
+    One answer given in a quiz. Rows are written in batches by scores.ScoreBuffer,
+    not one commit per answer. category_id is null for quizzes over all categories.
+    """
+    __tablename__ = 'scores'
+
+    id = Column(Integer, primary_key=True)
+    player = Column(String(80), nullable=False)
+    category_id = Column(Integer, db.ForeignKey('categories.id', ondelete='CASCADE'))
+    # Kept when the question is deleted, so past results stand
+    question_id = Column(Integer)
+    correct = Column(Boolean, nullable=False)
+    answered_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        Index('ix_scores_category_id_player', category_id, player),
+    )
+
+
+# Columns of Question.format(), to build question payloads from rows without loading Question objects
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer, Question.category_id, Question.difficulty)
+QUESTION_FIELDS = tuple(column.key for column in QUESTION_COLUMNS)
+
+
+def format_question_row(row):
+    """
+    Formats a row of QUESTION_COLUMNS the same way as Question.format()
+    """
+    return dict(zip(QUESTION_FIELDS, row))
@@ -0,0 +1,87 @@
+import threading
+import time
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import ArgumentError
+from sqlalchemy.pool import QueuePool
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that also records how long checkouts waited for a free connection
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with self.stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self.stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+
+def engine_options(config):
+    """
+    Builds the SQLAlchemy engine options from the DB_* settings of config.
+    SQLite keeps the pooling chosen by Flask-SQLAlchemy. Options in
+    SQLALCHEMY_ENGINE_OPTIONS take precedence.
+    """
+    try:
+        url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    except (ArgumentError, ValueError):
+        # Such as the blank template of config.py. The engine reports it once it connects,
+        # so that the app and the flask commands still start before the database is configured.
+        return dict(config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    options = {}
+    if url.get_backend_name() != "sqlite":
+        options.update({
+            "poolclass": TimedQueuePool,
+            "pool_size": config["DB_POOL_SIZE"],
+            "max_overflow": config["DB_MAX_OVERFLOW"],
+            "pool_timeout": config["DB_POOL_TIMEOUT"],
+            "pool_recycle": config["DB_POOL_RECYCLE"],
+            "pool_pre_ping": config["DB_POOL_PRE_PING"],
+        })
+    if url.get_backend_name() == "postgresql" and config["DB_STATEMENT_TIMEOUT_MS"]:
+        options["connect_args"] = {"options": f"-c statement_timeout={int(config['DB_STATEMENT_TIMEOUT_MS'])}"}
+    options.update(config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    return options
+
+
+def pool_stats(pool):
+    """
+    Returns the occupancy of a connection pool and, for TimedQueuePool, its checkout wait times
+    """
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "checkedIn": pool.checkedin(),
+            "checkedOut": pool.checkedout(),
+            "overflow": max(0, pool.overflow()),
+            "maxOverflow": pool._max_overflow,
+        })
+    if isinstance(pool, TimedQueuePool):
+        with pool.stats_lock:
+            stats.update({
+                "checkouts": pool.checkouts,
+                "timeouts": pool.timeouts,
+                "waitSeconds": round(pool.wait_seconds, 6),
+                "maxWaitSeconds": round(pool.max_wait_seconds, 6),
+            })
+    return stats
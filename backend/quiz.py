@@ -0,0 +1,470 @@
+import functools
+import random
+import secrets
+import threading
+import time
+from array import array
+from collections import deque, OrderedDict
+
+from flask import current_app, has_app_context
+
+from models import db, on_change, Question
+from replicas import primary_reads
+
+# Random draws tried before falling back to scanning the remaining ids
+MAX_DRAWS = 8
+
+DIFFICULTIES = (1, 2, 3, 4, 5)
+
+# Share of correct answers in a full window that moves an adaptive quiz up a difficulty,
+# and the share below which it moves down
+RAISE_AT = 0.75
+LOWER_BELOW = 0.5
+
+
+class QuestionPool:
+    """
+    In-memory pools of question ids, used to draw random quiz questions without querying for the
+    eligible set. Ids are held once, in an array per (category id, difficulty) bucket; the pool of
+    a category, of a difficulty or of all questions is the union of its buckets. The arrays only
+    grow: removed ids are recorded and skipped, so a position in a bucket never changes and
+    quiz sessions shuffle over the buckets without copying them.
+    The pools are loaded on first use. Once they are older than ttl seconds, or were invalidated,
+    one thread rebuilds them in the background while the old pools keep being served, so changes
+    made by other processes are picked up without holding up quiz requests.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        # Held during the first load, so that one caller loads and the others wait for its result
+        self.load_lock = threading.Lock()
+        self.loaded_at = None
+        self.buckets = None
+        self.removed = {}
+        # Changes made while the pools are rebuilt, applied to the new pools before they are swapped in.
+        # None when no rebuild is running.
+        self.pending = None
+        self.refresh_thread = None
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def load(self):
+        with primary_reads():
+            self.fill(db.session.query(Question.id, Question.category_id, Question.difficulty))
+
+    def fill(self, rows):
+        """
+        Replaces the pools with (question id, category id, difficulty) rows
+        """
+        filled = {}
+        for question_id, category_id, difficulty in rows:
+            bucket = filled.get((category_id, difficulty))
+            if bucket is None:
+                bucket = filled[category_id, difficulty] = array("q")
+            bucket.append(question_id)
+        buckets = {}
+        for (category_id, difficulty), bucket in filled.items():
+            buckets.setdefault(category_id, {})[difficulty] = bucket
+        with self.lock:
+            self.buckets = buckets
+            self.removed = {}
+            self.loaded_at = time.monotonic()
+            pending, self.pending = self.pending or (), None
+            for change in pending:
+                change()
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def start_refresh(self):
+        """
+        Returns True when the caller is to rebuild the pools, and records the changes made from then on,
+        or False when a rebuild is running already
+        """
+        with self.lock:
+            if self.pending is not None:
+                return False
+            self.pending = []
+            return True
+
+    def abandon_refresh(self):
+        with self.lock:
+            self.pending = None
+
+    def ensure_loaded(self):
+        """
+        Loads the pools on first use, and starts rebuilding them in a background thread once they are stale
+        """
+        if self.buckets is None:
+            with self.load_lock:
+                if self.buckets is None and self.start_refresh():
+                    try:
+                        self.load()
+                    except Exception:
+                        self.abandon_refresh()
+                        raise
+        elif self.is_stale() and self.start_refresh():
+            self.refresh_thread = threading.Thread(target=self.refresh, args=(current_app._get_current_object(),),
+                                                   name="question-pool-refresh", daemon=True)
+            self.refresh_thread.start()
+
+    def refresh(self, app):
+        try:
+            with app.app_context():
+                self.load()
+        except Exception:
+            self.abandon_refresh()
+            app.logger.exception("Rebuilding the quiz question pools failed")
+
+    def add(self, question_id, category_id, difficulty):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(functools.partial(self.add, question_id, category_id, difficulty))
+            if self.buckets is None:
+                return
+            bucket = self.buckets.setdefault(category_id, {}).setdefault(difficulty, array("q"))
+            if self.removed.get(question_id) == (category_id, difficulty):
+                del self.removed[question_id]
+            elif not contains(bucket, question_id):
+                bucket.append(question_id)
+
+    def remove(self, question_id, category_id=None, difficulty=None):
+        """
+        Removes the question from the bucket of its category and difficulty, which is looked up
+        when they are not both given
+        """
+        with self.lock:
+            known = category_id is not None and difficulty is not None
+            if known and self.pending is not None:
+                self.pending.append(functools.partial(self.remove, question_id, category_id, difficulty))
+            if self.buckets is None or question_id in self.removed:
+                return
+            if known:
+                keys = [(category_id, difficulty)]
+            else:
+                keys = [(category, level) for category, levels in self.buckets.items() for level in levels]
+            for category, level in keys:
+                if contains(self.buckets.get(category, {}).get(level, array("q")), question_id):
+                    self.removed[question_id] = (category, level)
+                    return
+
+    @staticmethod
+    def split(key):
+        """
+        Returns the category id and difficulty of the pool called key: None for all questions,
+        a category id, or a (category id or None, difficulty) pair
+        """
+        return key if isinstance(key, tuple) else (key, None)
+
+    def select(self, key):
+        """
+        Returns the buckets of the pool called key (see split)
+        """
+        category_id, difficulty = self.split(key)
+        categories = self.buckets.values() if category_id is None else [self.buckets.get(category_id, {})]
+        return [bucket for levels in categories for level, bucket in levels.items()
+                if difficulty is None or level == difficulty]
+
+    def snapshot(self, category_id=None):
+        """
+        Returns the buckets of the category (all categories for None), shared with the pool
+        """
+        with self.lock:
+            return self.select(category_id)
+
+    def size(self, key=None):
+        category_id, difficulty = self.split(key)
+        with self.lock:
+            removed = sum(1 for category, level in self.removed.values()
+                          if category_id in (None, category) and difficulty in (None, level))
+            return sum(map(len, self.select(key))) - removed
+
+    def choose(self, key=None, exclude=()):
+        """
+        Returns a random question id of the pool called key (see split) that is not in exclude,
+        or None when every question was excluded.
+        """
+        with self.lock:
+            buckets = [(bucket, len(bucket)) for bucket in self.select(key)]
+            total = sum(length for _, length in buckets)
+            if total == 0:
+                return None
+            for _ in range(MAX_DRAWS):
+                question_id = position(buckets, random.randrange(total))
+                if question_id not in exclude and question_id not in self.removed:
+                    return question_id
+            # Most of the pool has been played, so draw from what is left
+            remaining = [question_id for bucket, _ in buckets for question_id in bucket
+                         if question_id not in exclude and question_id not in self.removed]
+        return random.choice(remaining) if remaining else None
+
+    def choose_near(self, category_id=None, difficulty=None, exclude=()):
+        """
+        Returns a random question id of the category and difficulty that is not in exclude.
+        When that bucket is used up the nearest difficulties are tried, harder first on ties.
+        Returns None when every question of the category was excluded.
+        """
+        if difficulty is None:
+            return self.choose(category_id, exclude)
+        for candidate in sorted(DIFFICULTIES, key=lambda level: (abs(level - difficulty), -level)):
+            question_id = self.choose((category_id, candidate), exclude)
+            if question_id is not None:
+                return question_id
+        return None
+
+
+def contains(bucket, question_id):
+    """
+    Returns whether the array holds question_id. Searches its bytes, since `in` makes an int of each item.
+    """
+    data = bucket.tobytes()
+    needle = array(bucket.typecode, (question_id,)).tobytes()
+    start = data.find(needle)
+    # A match has to start on an item boundary
+    while start != -1 and start % bucket.itemsize:
+        start = data.find(needle, start + 1)
+    return start != -1
+
+
+def position(buckets, index):
+    """
+    Returns the id at index of (bucket, length) pairs taken one after the other
+    """
+    for bucket, length in buckets:
+        if index < length:
+            return bucket[index]
+        index -= length
+    raise IndexError(index)
+
+
+def next_difficulty(difficulty, answers, window):
+    """
+    Returns the difficulty to ask next after answers (True when correct) to questions of difficulty.
+    Once window answers were given, the difficulty goes up when at least RAISE_AT of the last window
+    were correct and down when fewer than LOWER_BELOW were.
+    """
+    recent = list(answers)[-window:]
+    if len(recent) < window:
+        return difficulty
+    share = sum(1 for answer in recent if answer) / window
+    if share >= RAISE_AT:
+        return min(difficulty + 1, DIFFICULTIES[-1])
+    if share < LOWER_BELOW:
+        return max(difficulty - 1, DIFFICULTIES[0])
+    return difficulty
+
+
+class QuizSession:
+    """
+    The questions left in a quiz, shuffled lazily over the pool's buckets: each draw swaps a random
+    remaining position into the cursor position (Fisher-Yates). The buckets are shared with the pool,
+    which only appends to them, so the session keeps their lengths when it starts and stores only
+    the positions it swapped, costing memory for the questions played rather than for the category.
+    Draws hold the session's lock, so concurrent requests on one session never get the same question.
+    """
+    __slots__ = ("category_id", "buckets", "total", "swapped", "cursor", "touched_at", "lock")
+
+    def __init__(self, category_id, buckets):
+        self.category_id = category_id
+        self.buckets = tuple((bucket, len(bucket)) for bucket in buckets)
+        self.total = sum(length for _, length in self.buckets)
+        self.swapped = {}
+        self.cursor = 0
+        self.touched_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return self.total - self.cursor
+
+    def at(self, index):
+        question_id = self.swapped.get(index)
+        return position(self.buckets, index) if question_id is None else question_id
+
+    def next_id(self):
+        with self.lock:
+            if self.cursor >= self.total:
+                return None
+            index = random.randrange(self.cursor, self.total)
+            question_id = self.at(index)
+            # The id at the cursor takes the drawn position, which stays among the remaining ones
+            self.swapped[index] = self.at(self.cursor)
+            self.swapped.pop(self.cursor, None)
+            self.cursor += 1
+            return question_id
+
+
+class AdaptiveQuizSession:
+    """
+    A quiz whose questions follow the player's level: each answer reported with record() is kept
+    in a window, and once the window is full the difficulty moves as next_difficulty decides.
+    Questions are drawn from the pool's difficulty buckets, so each draw stays O(1).
+    Answers and draws hold the session's lock, like those of QuizSession.
+    """
+    __slots__ = ("pool", "category_id", "difficulty", "answers", "played", "total", "touched_at", "lock")
+
+    def __init__(self, pool, category_id, difficulty, window):
+        self.pool = pool
+        self.category_id = category_id
+        self.difficulty = difficulty
+        self.answers = deque(maxlen=window)
+        self.played = set()
+        self.total = pool.size(category_id)
+        self.touched_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return max(0, self.total - len(self.played))
+
+    def record(self, correct):
+        with self.lock:
+            self.answers.append(bool(correct))
+            difficulty = next_difficulty(self.difficulty, self.answers, self.answers.maxlen)
+            if difficulty != self.difficulty:
+                # Start a fresh window at the new difficulty
+                self.difficulty = difficulty
+                self.answers.clear()
+
+    def next_id(self):
+        with self.lock:
+            question_id = self.pool.choose_near(self.category_id, self.difficulty, self.played)
+            if question_id is not None:
+                self.played.add(question_id)
+            return question_id
+
+
+class QuizSessionStore:
+    """
+    Quiz sessions by id, evicted once idle for ttl seconds or, beyond limit
+    sessions, least recently used first.
+    """
+
+    def __init__(self, ttl=1800, limit=10000):
+        self.ttl = ttl
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def start(self, category_id, buckets):
+        return self.add(QuizSession(category_id, buckets))
+
+    def add(self, session):
+        session_id = secrets.token_urlsafe(16)
+        with self.lock:
+            self.sessions[session_id] = session
+            self.evict()
+        return session_id
+
+    def get(self, session_id):
+        with self.lock:
+            self.evict()
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.touched_at = time.monotonic()
+                self.sessions.move_to_end(session_id)
+            return session
+
+    def end(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def evict(self):
+        expired_before = time.monotonic() - self.ttl
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.limit and session.touched_at >= expired_before:
+                break
+            del self.sessions[session_id]
+
+
+def get_question_pool():
+    """
+    Returns the app's question pool, loaded, after starting a rebuild when it is stale
+    """
+    pool = current_app.extensions["question_pool"]
+    pool.ensure_loaded()
+    return pool
+
+
+def draw_question(category_id=None, previous_questions=(), difficulty=None):
+    """
+    Returns a random Question of the category that is not in previous_questions, or None.
+    With a difficulty, the question is of that difficulty or, once those are used up, the nearest one.
+    Ids that no longer exist, e.g. deleted by another process, are dropped from the pool.
+    """
+    pool = get_question_pool()
+    exclude = set(previous_questions)
+    while True:
+        question_id = pool.choose_near(category_id, difficulty, exclude)
+        if question_id is None:
+            return None
+        question = db.session.get(Question, question_id)
+        if question is None:
+            # The pool is filled from the primary, which a lagging replica may not have caught up with
+            with primary_reads():
+                question = db.session.get(Question, question_id)
+        if question is not None and (category_id is None or question.category_id == category_id):
+            return question
+        pool.remove(question_id)
+        exclude.add(question_id)
+
+
+def get_quiz_sessions():
+    return current_app.extensions["quiz_sessions"]
+
+
+def start_quiz_session(category_id=None, adaptive=False):
+    """
+    Starts a quiz over the questions of the category (all categories for None)
+    and returns the session id along with the session.
+    """
+    return open_quiz_session(get_quiz_sessions(), get_question_pool(), category_id, adaptive, current_app.config)
+
+
+def open_quiz_session(sessions, pool, category_id, adaptive, config):
+    """
+    Starts a quiz of sessions over the questions of the loaded pool and returns the session id
+    along with the session. Adaptive quizzes start at QUIZ_START_DIFFICULTY and follow the
+    answers reported to them.
+    """
+    if adaptive:
+        session = AdaptiveQuizSession(pool, category_id, config["QUIZ_START_DIFFICULTY"], config["QUIZ_ADAPTIVE_WINDOW"])
+        session_id = sessions.add(session)
+    else:
+        session_id = sessions.start(category_id, pool.snapshot(category_id))
+    return session_id, sessions.get(session_id)
+
+
+def next_session_question(session):
+    """
+    Returns the next Question of a quiz session, or None once all were played.
+    Questions deleted since the session started are skipped.
+    """
+    get_question_pool()
+    while True:
+        question_id = session.next_id()
+        if question_id is None:
+            return None
+        question = db.session.get(Question, question_id)
+        if question is not None:
+            return question
+
+
+@on_change
+def sync_question_pool(table, action, record):
+    if not has_app_context():
+        return
+    pool = current_app.extensions.get("question_pool")
+    if pool is None:
+        return
+    if table == "questions" and action == "insert":
+        pool.add(record.id, record.category_id, record.difficulty)
+    elif table == "questions" and action == "delete":
+        pool.remove(record.id, record.category_id, record.difficulty)
+    elif table == "questions" or action != "insert":
+        pool.invalidate()
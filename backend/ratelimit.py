@@ -0,0 +1,219 @@
+import asyncio
+import functools
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from flask import current_app, g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryStore:
+    """
+    Token buckets held in process memory, up to size of them. The least recently used
+    bucket is dropped first; a dropped bucket starts full again.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+
+    def take(self, key, rate, burst, now):
+        """
+        Takes a token from the bucket of key, refilled at rate tokens per second up to burst.
+        Returns whether a token was available and, if not, the seconds until one is.
+        """
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+
+class RedisStore:
+    """
+    Token buckets kept in Redis, shared by every worker. Each take is one atomic script call.
+    The buckets expire once they would be full again.
+    """
+
+    SCRIPT = """
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url, prefix="trivia:ratelimit:"):
+        if redis is None:
+            raise RuntimeError("RATELIMIT_STORAGE_URL points to Redis but the redis package is not installed")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst, now):
+        allowed, tokens = self.script(keys=[self.prefix + key], args=[rate, burst, now])
+        return bool(allowed), 0.0 if allowed else (1 - float(tokens)) / rate
+
+
+class RateLimiter:
+    def __init__(self, store):
+        self.store = store
+        self.rejected = Counter()
+
+    def take(self, name, client, limits, logger):
+        """
+        Takes a token of client from the limits entry called name. Returns None when one was available,
+        else the seconds to wait. Limits missing from limits are not enforced, and a failing store
+        lets requests through.
+        """
+        if name not in limits:
+            return None
+        rate, burst = limits[name]
+        try:
+            allowed, retry_after = self.store.take(f"{name}:{client}", rate, burst, time.time())
+        except Exception as exception:
+            logger.warning("Rate limit store failed, letting the request through: %s", exception)
+            return None
+        if allowed:
+            return None
+        self.rejected[name] += 1
+        return max(1, math.ceil(retry_after))
+
+    def check(self, name, client):
+        """
+        Raises TooManyRequests when client has used up its tokens for the RATE_LIMITS entry called name
+        """
+        retry_after = self.take(name, client, current_app.config["RATE_LIMITS"], current_app.logger)
+        if retry_after is not None:
+            raise TooManyRequests(retry_after=retry_after)
+
+
+def client_key_of(api_key, address, api_keys):
+    """
+    Identifies a client by its API key when it is one of api_keys, else by its address. Other keys are
+    ignored, so a client can't get a fresh bucket by sending a made-up key.
+    """
+    return f"key:{api_key}" if api_key and api_key in api_keys else f"ip:{address}"
+
+
+def client_key():
+    return client_key_of(request.headers.get("X-API-Key"), request.remote_addr,
+                         current_app.config["RATELIMIT_API_KEYS"])
+
+
+def check_rate_limit(name):
+    current_app.extensions["rate_limiter"].check(name, client_key())
+
+
+def rate_limited(name):
+    """
+    Decorates a view whose requests take a token from the RATE_LIMITS bucket called name
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            check_rate_limit(name)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class AdmissionControl:
+    """
+    Caps the requests a process handles at once. Requests over the cap wait at most
+    timeout seconds for a slot and are then turned away, instead of queueing for a database connection.
+    """
+
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(limit)
+        self.rejected = 0
+
+    def admit(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            self.rejected += 1
+            raise ServiceUnavailable(retry_after=1)
+        g.admitted = True
+
+    def release(self, exception=None):
+        if g.pop("admitted", False):
+            self.slots.release()
+
+
+class AsyncAdmissionControl:
+    """
+    AdmissionControl of the async app. Requests over the cap wait on an asyncio semaphore,
+    so waiting does not block the event loop.
+    """
+
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.slots = asyncio.BoundedSemaphore(limit)
+        self.rejected = 0
+
+    async def admit(self):
+        """
+        Returns whether a slot was taken, to be given back with release()
+        """
+        if not self.slots.locked():
+            # A free slot is taken without waiting, which wait_for would not do with a timeout of 0
+            await self.slots.acquire()
+            return True
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        return True
+
+    def release(self):
+        self.slots.release()
+
+
+def create_rate_limiter(config):
+    url = config["RATELIMIT_STORAGE_URL"]
+    store = RedisStore(url) if url.startswith(("redis://", "rediss://", "unix://")) else MemoryStore()
+    return RateLimiter(store)
+
+
+def admission_limit(config):
+    """
+    Returns MAX_CONCURRENT_REQUESTS, by default the size of the connection pool, 0 when there is no cap
+    """
+    limit = config["MAX_CONCURRENT_REQUESTS"]
+    if limit is None:
+        limit = config["DB_POOL_SIZE"] + config["DB_MAX_OVERFLOW"]
+    return limit
+
+
+def init_rate_limits(app):
+    app.extensions["rate_limiter"] = create_rate_limiter(app.config)
+    limit = admission_limit(app.config)
+    if limit:
+        admission = AdmissionControl(limit, app.config["ADMISSION_TIMEOUT"])
+        app.extensions["admission"] = admission
+        app.before_request(admission.admit)
+        app.teardown_request(admission.release)
@@ -0,0 +1,177 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.exc import DBAPIError
+
+from pooling import engine_options, pool_stats
+
+
+class ReplicaSet:
+    """
+    Read replicas of the primary database, handed out round-robin.
+    A replica is checked by connecting to it at most every check_seconds, and one that
+    fails the check or drops its connections is skipped for retry_seconds.
+    """
+
+    def __init__(self, engines, retry_seconds=30, check_seconds=5):
+        self.engines = engines
+        self.retry_seconds = retry_seconds
+        self.check_seconds = check_seconds
+        self.lock = threading.Lock()
+        self.next = 0
+        self.checked_at = [None] * len(engines)
+        self.failed_at = [None] * len(engines)
+        self.reads = [0] * len(engines)
+        for engine in engines:
+            event.listen(engine, "handle_error", self.handle_error)
+
+    def handle_error(self, context):
+        if context.is_disconnect and context.engine in self.engines:
+            self.mark_failed(self.engines.index(context.engine))
+
+    def mark_failed(self, index):
+        with self.lock:
+            self.failed_at[index] = time.monotonic()
+            self.checked_at[index] = None
+
+    def is_healthy(self, index):
+        failed_at = self.failed_at[index]
+        return failed_at is None or time.monotonic() - failed_at >= self.retry_seconds
+
+    def check(self, index):
+        checked_at = self.checked_at[index]
+        if checked_at is not None and time.monotonic() - checked_at < self.check_seconds:
+            return True
+        try:
+            with self.engines[index].connect():
+                pass
+        except DBAPIError as error:
+            current_app.logger.warning("Read replica %d is unavailable: %s", index, error)
+            self.mark_failed(index)
+            return False
+        with self.lock:
+            self.checked_at[index] = time.monotonic()
+            self.failed_at[index] = None
+        return True
+
+    def choose(self):
+        """
+        Returns the engine of the next healthy replica, or None when every replica is down
+        """
+        with self.lock:
+            start = self.next
+            self.next = (self.next + 1) % len(self.engines)
+        for step in range(len(self.engines)):
+            index = (start + step) % len(self.engines)
+            if self.is_healthy(index) and self.check(index):
+                with self.lock:
+                    self.reads[index] += 1
+                return self.engines[index]
+        return None
+
+    def stats(self):
+        return [{
+            "url": engine.url.render_as_string(hide_password=True),
+            "healthy": self.is_healthy(index),
+            "reads": self.reads[index],
+            **pool_stats(engine.pool),
+        } for index, engine in enumerate(self.engines)]
+
+
+def use_replica():
+    """
+    Lets the reads of the current request go to a replica until it writes
+    """
+    g.replica_reads = True
+
+
+def replica_reads(view):
+    """
+    Decorates a read-only view so its queries are served by a replica
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        use_replica()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def primary_reads():
+    """
+    Sends the reads of the block to the primary. Used to refill the in-process caches: a lagging
+    replica would fill them again with the data from before the write that invalidated them.
+    """
+    if not has_request_context():
+        yield
+        return
+    g.primary_reads = g.get("primary_reads", 0) + 1
+    try:
+        yield
+    finally:
+        g.primary_reads -= 1
+
+
+def pin_to_primary(*args):
+    if has_request_context():
+        g.primary_pinned = True
+
+
+def replica_engine():
+    """
+    Returns the replica chosen for the current request, or None to use the primary
+    """
+    if (not has_request_context() or not g.get("replica_reads") or g.get("primary_pinned")
+            or g.get("primary_reads")):
+        return None
+    if "replica_engine" not in g:
+        replicas = current_app.extensions.get("replicas")
+        g.replica_engine = replicas.choose() if replicas else None
+    return g.replica_engine
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session sending the SELECTs of replica_reads requests to a replica, and everything else
+    to the primary. A request that writes is pinned to the primary so it reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if getattr(clause, "is_dml", False):
+            pin_to_primary()
+        elif not self._flushing and getattr(clause, "is_select", False):
+            engine = replica_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+event.listen(RoutingSession, "after_flush", pin_to_primary)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def reset_routing():
+    for name in ("replica_reads", "primary_pinned", "primary_reads", "replica_engine"):
+        g.pop(name, None)
+
+
+def init_replicas(app):
+    """
+    Creates the engines of SQLALCHEMY_REPLICA_URIS, with the pool settings of the primary
+    """
+    uris = app.config["SQLALCHEMY_REPLICA_URIS"]
+    if not uris:
+        return
+    engines = [create_engine(uri, **engine_options(dict(app.config, SQLALCHEMY_DATABASE_URI=uri))) for uri in uris]
+    app.extensions["replicas"] = ReplicaSet(engines, app.config["REPLICA_RETRY_SECONDS"],
+                                            app.config["REPLICA_CHECK_SECONDS"])
+    app.before_request(reset_routing)
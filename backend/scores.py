@@ -0,0 +1,285 @@
+import atexit
+import bisect
+import threading
+import time
+from collections import deque
+
+from flask import current_app, has_app_context
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from models import Category, db, on_change, Score
+
+
+class ScoreBuffer:
+    """
+    Answers waiting to be written to the scores table. A background thread, started with the
+    first answer, inserts them in one executemany per flush, every interval seconds or as soon as
+    size answers are waiting. At most limit answers are held; beyond that the oldest are dropped.
+    """
+
+    def __init__(self, app, size=500, interval=1.0, limit=100000):
+        self.app = app
+        self.size = size
+        self.interval = interval
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = deque()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def record(self, row):
+        with self.lock:
+            self.pending.append(row)
+            self.trim()
+            full = len(self.pending) >= self.size
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="score-flush", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+        if full:
+            self.wakeup.set()
+
+    def trim(self):
+        while len(self.pending) > self.limit:
+            self.pending.popleft()
+            self.dropped += 1
+
+    def discard(self, category_id):
+        """
+        Drops the waiting answers of a deleted category
+        """
+        with self.lock:
+            self.pending = deque(row for row in self.pending if row["category_id"] != category_id)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the waiting answers and returns how many were written. When the write fails
+        the answers are put back to be tried again on the next flush.
+        """
+        with self.flush_lock:
+            return self.write_rows(self.take())
+
+    def take(self):
+        """
+        Empties the buffer and returns the answers it held
+        """
+        with self.lock:
+            rows = list(self.pending)
+            self.pending.clear()
+        return rows
+
+    def write_rows(self, rows):
+        """
+        Writes answers taken from the buffer, by a caller holding flush_lock
+        """
+        if not rows:
+            return 0
+        try:
+            with self.app.app_context():
+                written = self.write(rows)
+        except Exception as exception:
+            self.app.logger.warning("Writing %d scores failed, will retry: %s", len(rows), exception)
+            with self.lock:
+                self.failures += 1
+                self.pending.extendleft(reversed(rows))
+                self.trim()
+            return 0
+        self.flushed += written
+        self.flushes += 1
+        return written
+
+    @staticmethod
+    def write(rows):
+        table = Score.__table__
+        # A session of its own, so a flush never commits the work of the request it runs in
+        session = db.session.session_factory()
+        try:
+            try:
+                session.execute(table.insert(), rows)
+                session.commit()
+            except IntegrityError:
+                # A category was deleted while its answers were waiting
+                session.rollback()
+                categories = set(session.execute(select(Category.id)).scalars())
+                rows = [row for row in rows if row["category_id"] is None or row["category_id"] in categories]
+                if rows:
+                    session.execute(table.insert(), rows)
+                session.commit()
+            return len(rows)
+        finally:
+            session.close()
+
+    def stats(self):
+        return {"pending": len(self.pending), "flushed": self.flushed, "flushes": self.flushes,
+                "failures": self.failures, "dropped": self.dropped}
+
+
+class Leaderboard:
+    """
+    Correct answers by player, per category plus one board (keyed None) over all quizzes.
+    The best size players of each board are kept in a list sorted by (-score, player), so an
+    update finds its slot by bisection and the top k is a slice. The boards are loaded from the
+    scores table on first use and reloaded once older than ttl seconds, to pick up other processes.
+    A reload queries and builds the new boards outside the lock, so answers keep being counted
+    meanwhile; they are replayed onto the new boards when these are swapped in.
+    """
+
+    def __init__(self, size=100, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        # Held while reloading, so that one caller reloads and the others wait for its result
+        self.load_lock = threading.Lock()
+        self.loaded_at = None
+        self.totals = {}
+        self.tops = {}
+        # Answers counted during a reload, as (category id, player, points), None otherwise
+        self.pending = None
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def ensure_loaded(self, buffer):
+        if self.is_stale():
+            with self.load_lock:
+                if self.is_stale():
+                    self.reload(buffer)
+
+    def reload(self, buffer):
+        """
+        Reloads the boards from the scores table. The answers waiting in buffer are written first,
+        as the reload would miss them, and no other flush runs until the boards are read, so each
+        answer is counted either by the query or by the replay of pending, never both.
+        """
+        with buffer.flush_lock:
+            with self.lock:
+                rows = buffer.take()
+                self.pending = []
+            try:
+                buffer.write_rows(rows)
+                rows = self.load()
+            except Exception:
+                with self.lock:
+                    self.pending = None
+                raise
+        self.fill(rows)
+
+    def load(self):
+        return db.session.execute(
+            select(Score.category_id, Score.player, func.count())
+            .where(Score.correct)
+            .group_by(Score.category_id, Score.player)
+        ).all()
+
+    def fill(self, rows):
+        """
+        Replaces the boards with (category id, player, score) rows, then counts the answers
+        recorded since the reload started
+        """
+        totals = {None: {}}
+        for category_id, player, score in rows:
+            overall = totals[None]
+            overall[player] = overall.get(player, 0) + score
+            if category_id is not None:
+                totals.setdefault(category_id, {})[player] = score
+        tops = {key: sorted((-score, player) for player, score in scores.items())[:self.size]
+                for key, scores in totals.items()}
+        with self.lock:
+            pending, self.pending = self.pending, None
+            self.totals = totals
+            self.tops = tops
+            self.loaded_at = time.monotonic()
+            for change in pending or ():
+                self.add(*change)
+
+    def add(self, category_id, player, points=1):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((category_id, player, points))
+            if self.loaded_at is None:
+                return
+            for key in (None, category_id) if category_id is not None else (None,):
+                scores = self.totals.setdefault(key, {})
+                top = self.tops.setdefault(key, [])
+                old = scores.get(player, 0)
+                scores[player] = old + points
+                index = bisect.bisect_left(top, (-old, player))
+                if index < len(top) and top[index] == (-old, player):
+                    del top[index]
+                bisect.insort(top, (-old - points, player))
+                if len(top) > self.size:
+                    top.pop()
+
+    def score(self, category_id, player):
+        with self.lock:
+            return self.totals.get(category_id, {}).get(player, 0)
+
+    def top(self, category_id=None, limit=10):
+        """
+        Returns the (player, score) pairs of the best limit players of the category, best first
+        """
+        with self.lock:
+            return [(player, -score) for score, player in self.tops.get(category_id, [])[:limit]]
+
+
+def get_score_buffer():
+    return current_app.extensions["score_buffer"]
+
+
+def get_leaderboard():
+    leaderboard = current_app.extensions["leaderboard"]
+    leaderboard.ensure_loaded(get_score_buffer())
+    return leaderboard
+
+
+def record_answer(player, category_id, question_id, correct):
+    """
+    Queues an answer to be written with the next flush and counts it on the leaderboards.
+    Returns the player's score in the category (all quizzes for None).
+    Whether the answer was correct is taken from the client: the leaderboards are trust-based.
+    """
+    leaderboard = get_leaderboard()
+    with leaderboard.lock:
+        get_score_buffer().record({"player": player, "category_id": category_id,
+                                   "question_id": question_id, "correct": correct})
+        if correct:
+            leaderboard.add(category_id, player)
+        return leaderboard.score(category_id, player)
+
+
+def init_scores(app):
+    config = app.config
+    app.extensions["score_buffer"] = ScoreBuffer(app, config["SCORE_FLUSH_SIZE"], config["SCORE_FLUSH_SECONDS"],
+                                                 config["SCORE_BUFFER_LIMIT"])
+    app.extensions["leaderboard"] = Leaderboard(config["LEADERBOARD_SIZE"], config["LEADERBOARD_TTL"])
+
+
+@on_change
+def sync_leaderboard(table, action, record):
+    if not has_app_context() or table != "categories" or action != "delete":
+        return
+    leaderboard = current_app.extensions.get("leaderboard")
+    if leaderboard is None:
+        return
+    if record is not None:
+        current_app.extensions["score_buffer"].discard(record.id)
+    leaderboard.invalidate()
@@ -0,0 +1,189 @@
+import re
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import cast, func, literal_column, Numeric, or_, select
+
+from models import db, on_change, Question
+from replicas import primary_reads
+
+WORD = re.compile(r"\w+")
+
+
+class PostgresSearch:
+    """
+    Ranked search over question and answer text on Postgres. Matches are found through
+    the GIN indexes of the ix_questions_* migration: a tsvector index for whole words
+    and word prefixes, and trigram indexes so substring matches keep using an index.
+    """
+
+    document = func.to_tsvector(literal_column("'english'"),
+                                Question.question + literal_column("' '") + Question.answer)
+    # Only ranks the rows matched through the index on document, weighting question words above answer words
+    weighted = func.setweight(func.to_tsvector(literal_column("'english'"), Question.question),
+                              literal_column("'A'")).op("||")(
+        func.setweight(func.to_tsvector(literal_column("'english'"), Question.answer), literal_column("'B'")))
+
+    def clauses(self, term):
+        """
+        Returns the WHERE condition matching term and the expression ranking the matches, None
+        for terms without words, whose matches are listed by id. The rank is cast to numeric so
+        that the rank a cursor carries compares equal to the rank it was read from.
+        """
+        words = WORD.findall(term)
+        pattern = f"%{term}%"
+        condition = or_(Question.question.ilike(pattern), Question.answer.ilike(pattern))
+        if not words:
+            return condition, None
+        query = func.to_tsquery(literal_column("'english'"), " & ".join(f"{word}:*" for word in words))
+        condition = or_(self.document.op("@@")(query), condition)
+        return condition, cast(func.ts_rank(self.weighted, query), Numeric)
+
+    def ranked(self, term):
+        """
+        Returns a select() of the matching questions, best ranked first, and the rank expression
+        """
+        condition, rank = self.clauses(term)
+        order = (Question.id,) if rank is None else (rank.desc(), Question.id)
+        return select(Question).where(condition).order_by(*order), rank
+
+    def search(self, term):
+        return self.ranked(term)[0]
+
+
+class MemorySearch:
+    """
+    Pure-Python inverted index used on databases without full-text search, e.g. SQLite.
+    Lowercased question and answer texts are indexed by trigram, so substring matches
+    only check the texts that hold every trigram of the term. Terms shorter than a trigram
+    have no trigram to look up and scan every text instead.
+    The index is built on first use and rebuilt once older than ttl seconds, by the caller
+    of ensure_loaded() or fill(): search() only reads the index it holds.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        # Held while loading, so that one caller reloads and the others wait for its result
+        self.load_lock = threading.Lock()
+        self.loaded_at = None
+        self.texts = {}
+        self.trigrams = {}
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def load(self):
+        with primary_reads():
+            self.fill(db.session.query(Question.id, Question.question, Question.answer))
+
+    def fill(self, rows):
+        """
+        Rebuilds the index from (question id, question, answer) rows
+        """
+        with self.lock:
+            self.texts = {}
+            self.trigrams = {}
+            for question_id, question, answer in rows:
+                self._add(question_id, question, answer)
+            self.loaded_at = time.monotonic()
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def ensure_loaded(self):
+        if self.is_stale():
+            with self.load_lock:
+                if self.is_stale():
+                    self.load()
+
+    def add(self, question_id, question, answer):
+        with self.lock:
+            if self.loaded_at is not None:
+                self.remove(question_id)
+                self._add(question_id, question, answer)
+
+    def _add(self, question_id, question, answer):
+        texts = (question.lower(), answer.lower())
+        self.texts[question_id] = texts
+        for trigram in self._trigrams(" ".join(texts)):
+            self.trigrams.setdefault(trigram, set()).add(question_id)
+
+    def remove(self, question_id):
+        with self.lock:
+            texts = self.texts.pop(question_id, None)
+            if texts is None:
+                return
+            for trigram in self._trigrams(" ".join(texts)):
+                postings = self.trigrams.get(trigram)
+                postings.discard(question_id)
+                if not postings:
+                    del self.trigrams[trigram]
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[index:index + 3] for index in range(len(text) - 2)}
+
+    def ranked(self, term):
+        """
+        Returns the ids of the questions whose question or answer holds term, best ranked first
+        and ties by id, along with their {question id: rank} scores.
+        Question matches rank above answer matches and matches at the start of a word rank higher.
+        """
+        term = term.lower()
+        with self.lock:
+            trigrams = self._trigrams(term)
+            if trigrams:
+                postings = sorted((self.trigrams.get(trigram, set()) for trigram in trigrams), key=len)
+                candidates = set.intersection(*postings)
+            else:
+                candidates = self.texts.keys()
+            scores = {}
+            for question_id in candidates:
+                question, answer = self.texts[question_id]
+                score = 2 * question.count(term) + answer.count(term)
+                if score:
+                    scores[question_id] = score + sum(word.startswith(term) for word in WORD.findall(question))
+        return sorted(scores, key=lambda question_id: (-scores[question_id], question_id)), scores
+
+    def search(self, term):
+        return self.ranked(term)[0]
+
+
+def get_search_index():
+    index = current_app.extensions.get("search_index")
+    if index is None:
+        if db.engine.dialect.name == "postgresql":
+            index = PostgresSearch()
+        else:
+            index = MemorySearch(current_app.config["SEARCH_INDEX_TTL"])
+        current_app.extensions["search_index"] = index
+    return index
+
+
+def search_questions(term):
+    """
+    Returns the matches for term as a select() of Question or, from the in-memory index,
+    a list of question ids, along with what they are ranked by. Both can be handed to utils.paginate.
+    """
+    index = get_search_index()
+    if isinstance(index, MemorySearch):
+        index.ensure_loaded()
+    return index.ranked(term)
+
+
+@on_change
+def sync_search_index(table, action, record):
+    if not has_app_context():
+        return
+    index = current_app.extensions.get("search_index")
+    if not isinstance(index, MemorySearch):
+        return
+    if table == "questions" and action in ("insert", "update"):
+        index.add(record.id, record.question, record.answer)
+    elif table == "questions" and action == "delete":
+        index.remove(record.id)
+    elif table == "questions" or action != "insert":
+        index.invalidate()
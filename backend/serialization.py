@@ -0,0 +1,57 @@
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """
+    Serializes obj to a compact JSON string, with orjson when it is installed
+    """
+    if orjson is None:
+        return json.dumps(obj, separators=(",", ":"))
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider serializing with orjson. Calls passing json.dumps/json.loads
+    keyword arguments are handed to the stdlib provider.
+    """
+
+    def options(self, indent=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.options()).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        body = orjson.dumps(obj, default=self.default, option=self.options(indent))
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
+
+
+def init_json(app):
+    """
+    Serializes the app's JSON with orjson when it is installed and USE_ORJSON is set,
+    else with the stdlib provider
+    """
+    if orjson is not None and app.config["USE_ORJSON"]:
+        app.json = OrjsonProvider(app)
@@ -0,0 +1,50 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+
+from models import CategoryStat, db, Question
+
+
+def category_stats():
+    """
+    Returns the {category_id: {difficulty: count}} question counts from the stats table
+    """
+    stats = {}
+    rows = db.session.execute(select(CategoryStat.category_id, CategoryStat.difficulty, CategoryStat.count))
+    for category_id, difficulty, count in rows:
+        if count:
+            stats.setdefault(category_id, {})[difficulty] = count
+    return stats
+
+
+def question_total(category_id=None):
+    """
+    Returns the number of questions, of one category when category_id is given, from the stats table
+    """
+    statement = select(func.coalesce(func.sum(CategoryStat.count), 0))
+    if category_id is not None:
+        statement = statement.where(CategoryStat.category_id == category_id)
+    return db.session.execute(statement).scalar()
+
+
+def rebuild_category_stats():
+    """
+    Recounts the questions of every category and difficulty and replaces the stored counts
+    """
+    table = CategoryStat.__table__
+    db.session.execute(table.delete())
+    db.session.execute(table.insert().from_select(
+        ["category_id", "difficulty", "count"],
+        select(Question.category_id, Question.difficulty, func.count())
+        .where(Question.category_id.isnot(None), Question.difficulty.isnot(None))
+        .group_by(Question.category_id, Question.difficulty)
+    ))
+    db.session.commit()
+
+
+@click.command("rebuild-stats")
+@with_appcontext
+def rebuild_stats_command():
+    """Recounts the questions of every category and difficulty."""
+    rebuild_category_stats()
+    click.echo(f"Counted {question_total()} questions.")
@@ -0,0 +1,33 @@
+"""
+Synthetic question banks, written by testing.seed_bank and by the benchmark's seed()
+to fill a database with many questions quickly.
+"""
+from collections import Counter
+
+from models import db, Question
+
+# Rows per executemany when seeding a bank
+SEED_BATCH = 10000
+WORDS = ("river", "planet", "painter", "battle", "empire", "novel", "composer", "island", "element",
+         "mountain", "dynasty", "museum", "ocean", "olympic", "theory", "kingdom", "desert", "symphony",
+         "volcano", "treaty", "galaxy", "cathedral", "invention", "festival", "glacier", "marathon")
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def insert_questions(size, category_ids, rng):
+    """
+    Inserts size questions made of random WORDS, spread over category_ids and the difficulties,
+    in the current transaction, with one executemany per SEED_BATCH rows.
+    Returns the number of questions inserted by (category id, difficulty).
+    """
+    counts = Counter()
+    for start in range(0, size, SEED_BATCH):
+        rows = [{"question": sentence(rng, rng.randint(8, 14)) + "?", "answer": sentence(rng, 2),
+                 "difficulty": rng.randint(1, 5), "category_id": rng.choice(category_ids)}
+                for _ in range(start, min(start + SEED_BATCH, size))]
+        db.session.execute(Question.__table__.insert(), rows)
+        counts.update((row["category_id"], row["difficulty"]) for row in rows)
+    return counts
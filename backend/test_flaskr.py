@@ -1,44 +1,47 @@
+import asyncio
+import gzip
 import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from array import array
 
-from flask_sqlalchemy import SQLAlchemy
+from alembic.script import ScriptDirectory
+from flask import g
+from sqlalchemy import create_engine, event, func, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.pool import Pool
 
+from compression import brotli
+from events import Broker
 from flaskr import create_app
-from models import Question, Category
+from flaskr.asgi import create_asgi_app
+from models import db, Question, Category, CategoryStat, Score
+from pooling import engine_options, TimedQueuePool
+from quiz import QuestionPool, QuizSession
+from ratelimit import MemoryStore
+from replicas import use_replica
+from scores import Leaderboard
+from search import MemorySearch
+from serialization import orjson, OrjsonProvider
+from stats import question_total, rebuild_category_stats
+from testing import DatabaseFileTestCase, make_test_config, read_sample_data, seed_bank, TransactionalTestCase
 
-DIALECT = ""
-USER = ""
-PASSWORD = ""
-HOST = "localhost"
-PORT = "5432"
-DATABASE_NAME = "trivia_test"
-DATABASE_PATH = f'{DIALECT}://{USER}:{PASSWORD}@{HOST}:{PORT}/{DATABASE_NAME}'
-
-class CategoryModelTestCase(unittest.TestCase):
+class CategoryModelTestCase(TransactionalTestCase):
     """This class represents the Category model test case"""
 
     def setUp(self):
         """Define test variables and initialize app."""
-
-        self.app = create_app()
+        super().setUp()
         self.client = self.app.test_client
-        self.app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_PATH
-        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
         self.new_category = {"name": "Tricky"}
         self.new_category2 = {"name": "history"}
         self.new_category3 = {"body": "miSc"}
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.app = self.app
-            self.db.init_app(self.app)
-            self.db.create_all()
-
-    def tearDown(self):
-        """Executed after reach test"""
-        pass
-
     ###################################################################################################################
     # Tests for create_category
     ###################################################################################################################
@@ -79,6 +82,107 @@ class CategoryModelTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertTrue(len(data["categories"]))
 
+    def test_get_categories_from_cache(self):
+        self.client().get("/categories")
+        res = self.client().get("/categories")
+        stats = self.app.extensions["category_cache"].stats()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 1)
+
+    def test_create_category_invalidates_cache(self):
+        self.client().get("/categories")
+        res = self.client().post("/categories", json={"name": "Cached"})
+        created = json.loads(res.data)["created"]
+        data = json.loads(self.client().get("/categories").data)
+
+        self.assertEqual(data["categories"][str(created)], "Cached")
+        self.assertEqual(self.app.extensions["category_cache"].stats()["misses"], 2)
+
+    def test_304_categories_not_modified(self):
+        res = self.client().get("/categories")
+        etag = res.headers["ETag"]
+        res = self.client().get("/categories", headers={"If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b"")
+        self.assertEqual(res.headers["ETag"], etag)
+        self.assertIn("Cache-Control", res.headers)
+
+    def test_create_category_changes_etag(self):
+        etag = self.client().get("/categories").headers["ETag"]
+        self.client().post("/categories", json={"name": "Versioned"})
+        res = self.client().get("/categories", headers={"If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+    def test_delete_category_with_questions(self):
+        with self.app.app_context():
+            category = Category("Doomed")
+            category.insert()
+            category_id = category.id
+            Question("Doomed?", "Doomed", category_id, 1).insert()
+            Category.query.get(category_id).delete()
+
+            self.assertIsNone(Category.query.get(category_id))
+            self.assertEqual(Question.query.filter_by(category_id=category_id).count(), 0)
+            self.assertEqual(question_total(category_id), 0)
+
+    ###################################################################################################################
+    # Tests for retrieve_category_stats
+    ###################################################################################################################
+
+    def test_category_stats(self):
+        res = self.client().get("/categories/stats")
+        data = json.loads(res.data)
+        with self.app.app_context():
+            counts = dict(db.session.query(Question.category_id, func.count()).group_by(Question.category_id))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual({category["id"]: category["totalQuestions"] for category in data["categories"]
+                          if category["totalQuestions"]}, counts)
+        self.assertEqual(data["totalQuestions"], sum(counts.values()))
+
+    def test_category_stats_follow_changes(self):
+        def history_stats():
+            data = json.loads(self.client().get("/categories/stats").data)
+            return next(category for category in data["categories"] if category["id"] == 4)
+
+        before = history_stats()
+        with self.app.app_context():
+            question = Question("Counted?", "Counted", 4, 5)
+            question.insert()
+            during = history_stats()
+            question.delete()
+
+        self.assertEqual(during["totalQuestions"], before["totalQuestions"] + 1)
+        self.assertEqual(during["difficulties"]["5"], before["difficulties"].get("5", 0) + 1)
+        self.assertEqual(history_stats(), before)
+
+    def test_category_stats_follow_update_after_commit(self):
+        with self.app.app_context():
+            question = Question.query.get(5)
+            # Expires the loaded attributes, so the old category is not in memory when it is replaced
+            db.session.commit()
+            question.category_id = 1
+            question.update()
+
+            self.assertEqual(question_total(4), Question.query.filter_by(category_id=4).count())
+            self.assertEqual(question_total(1), Question.query.filter_by(category_id=1).count())
+
+    def test_rebuild_category_stats(self):
+        with self.app.app_context():
+            CategoryStat.adjust({(4, 1): 10})
+            db.session.commit()
+            rebuild_category_stats()
+            total = question_total(4)
+            expected = Question.query.filter_by(category_id=4).count()
+
+        self.assertEqual(total, expected)
+
     ###################################################################################################################
     # Tests for retrieve_category_questions
     ###################################################################################################################
@@ -113,15 +217,13 @@ class CategoryModelTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
 
 
-class QuestionModelTestCase(unittest.TestCase):
+class QuestionModelTestCase(TransactionalTestCase):
     """This class represents the Question model test case"""
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        super().setUp()
         self.client = self.app.test_client
-        self.app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_PATH
-        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
         self.new_question = {"question": "What is the name of the artist who painted ‘Mona Lisa’?",
                              "answer": "Leonardo Da Vinci", "category": 2, "difficulty": 2}
         self.new_question2 = {"question": "Whose autobiography is entitled 'I Know Why the Caged Bird Sings'?",
@@ -135,18 +237,6 @@ class QuestionModelTestCase(unittest.TestCase):
         self.quiz3 = {"previous_questions": [12, 13, 14], "quiz_category": {"id": 5, "name": "Entertainment"}}
         self.quiz4 = {"quiz_category": {"id": 90, "name": "Unknown"}}
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.app = self.app
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-
-    def tearDown(self):
-        """Executed after reach test"""
-        pass
-
     ###################################################################################################################
     # Tests for create_question
     ###################################################################################################################
@@ -166,6 +256,133 @@ class QuestionModelTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "bad request")
 
+    ###################################################################################################################
+    # Tests for import_question_bank
+    ###################################################################################################################
+    def test_import_questions_ndjson(self):
+        lines = [json.dumps({"question": f"Imported question {i}?", "answer": "Yes", "category": 1, "difficulty": 2})
+                 for i in range(5)]
+        lines.append(json.dumps({"question": "No category?", "answer": "No", "difficulty": 2}))
+        lines.append("not json")
+        res = self.client().post("/questions/import?batch_size=2", data="\n".join(lines),
+                                 content_type="application/x-ndjson")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["imported"], 5)
+        self.assertEqual(data["rejected"], 2)
+        self.assertEqual([error["line"] for error in data["errors"]], [6, 7])
+        self.assertEqual([batch["rows"] for batch in data["batches"]], [2, 2, 1])
+
+    def test_import_questions_csv(self):
+        body = "question,answer,category_id,difficulty\n\"Imported, from CSV?\",Yes,3,1\nBad row,Yes,3,9\n"
+        res = self.client().post("/questions/import", data=body, content_type="text/csv")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["imported"], 1)
+        self.assertEqual(data["rejected"], 1)
+        with self.app.app_context():
+            self.assertTrue(Question.query.filter(Question.question == "Imported, from CSV?").count())
+
+    def test_400_import_unknown_format(self):
+        res = self.client().post("/questions/import?format=xml", data="<questions/>")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    ###################################################################################################################
+    # Tests for export_question_bank
+    ###################################################################################################################
+    def test_export_questions_ndjson(self):
+        res = self.client().get("/questions/export?category=4")
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+        with self.app.app_context():
+            expected = [question.format() for question in Question.query.filter_by(category_id=4).order_by(Question.id)]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "application/x-ndjson")
+        self.assertEqual(rows, expected)
+
+    def test_export_questions_csv(self):
+        res = self.client().get("/questions/export?format=csv&category=4&difficulty=2")
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0], "id,question,answer,category_id,difficulty")
+        self.assertTrue(all(line.endswith(",4,2") for line in lines[1:]))
+        self.assertTrue(len(lines) > 1)
+
+    ###################################################################################################################
+    # Tests for response compression
+    ###################################################################################################################
+    def test_gzip_questions(self):
+        plain = self.client().get("/questions")
+        res = self.client().get("/questions", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", res.headers["Vary"])
+        self.assertEqual(json.loads(gzip.decompress(res.data)), json.loads(plain.data))
+        self.assertLess(len(res.data), len(plain.data))
+
+    def test_brotli_preferred(self):
+        if brotli is None:
+            self.skipTest("brotli is not installed")
+        res = self.client().get("/questions", headers={"Accept-Encoding": "gzip, deflate, br"})
+
+        self.assertEqual(res.headers["Content-Encoding"], "br")
+        self.assertTrue(json.loads(brotli.decompress(res.data))["success"])
+
+    def test_small_body_not_compressed(self):
+        self.app.config["COMPRESS_MIN_SIZE"] = 1 << 20
+        res = self.client().get("/questions", headers={"Accept-Encoding": "gzip"})
+
+        self.assertNotIn("Content-Encoding", res.headers)
+        self.assertTrue(json.loads(res.data)["success"])
+
+    def test_compressed_body_cached(self):
+        first = self.client().get("/questions", headers={"Accept-Encoding": "gzip"})
+        second = self.client().get("/questions", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(self.app.extensions["compressed_cache"].hits, 1)
+        self.assertTrue(first.headers["ETag"].startswith("W/"))
+
+    def test_304_compressed_not_modified(self):
+        etag = self.client().get("/questions", headers={"Accept-Encoding": "gzip"}).headers["ETag"]
+        res = self.client().get("/questions", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_gzip_streamed_export(self):
+        plain = self.client().get("/questions/export")
+        res = self.client().get("/questions/export", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+
+    ###################################################################################################################
+    # Tests for the JSON provider
+    ###################################################################################################################
+    def test_json_providers_match(self):
+        stdlib_app = create_app(make_test_config(USE_ORJSON=False))
+        for path in ("/questions?page=2", "/categories", "/categories/4/questions"):
+            res = self.client().get(path)
+            stdlib_res = stdlib_app.test_client().get(path)
+
+            self.assertEqual(res.status_code, stdlib_res.status_code)
+            self.assertEqual(res.mimetype, "application/json")
+            self.assertEqual(json.loads(res.data), json.loads(stdlib_res.data))
+
+    def test_orjson_provider(self):
+        if orjson is None:
+            self.skipTest("orjson is not installed")
+
+        self.assertIsInstance(self.app.json, OrjsonProvider)
+        self.assertEqual(self.app.json.loads(self.app.json.dumps({1: "Science"})), {"1": "Science"})
+
     ###################################################################################################################
     # Tests for search_question
     ###################################################################################################################
@@ -179,6 +396,53 @@ class QuestionModelTestCase(unittest.TestCase):
         self.assertEqual(data["currentCategory"], "All")
         self.assertTrue(len(data["questions"]))
 
+    def test_search_question_answers(self):
+        res = self.client().post("/questions", json={"searchTerm": "scarab"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["totalQuestions"], 1)
+        self.assertEqual(data["questions"][0]["answer"], "Scarab")
+
+    def test_search_question_ranking(self):
+        res = self.client().post("/questions", json={"searchTerm": "soccer"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["totalQuestions"], 2)
+        self.assertTrue(all("soccer" in question["question"] for question in data["questions"]))
+
+        data = json.loads(self.client().post("/questions", json={"searchTerm": "one"}).data)
+
+        self.assertEqual([question["id"] for question in data["questions"]], [19, 18])
+        self.assertIn("one", data["questions"][0]["question"].lower())
+        self.assertEqual(data["questions"][1]["answer"], "One")
+
+    def test_search_question_by_cursor(self):
+        res = self.client().post("/questions", json={"searchTerm": "e"})
+        ranked = [question["id"] for question in json.loads(res.data)["questions"]]
+        res = self.client().post("/questions?cursor=", json={"searchTerm": "e"})
+        data = json.loads(res.data)
+        total = data["totalQuestions"]
+        ids = [question["id"] for question in data["questions"]]
+        while data["next_cursor"]:
+            res = self.client().post(f"/questions?cursor={data['next_cursor']}", json={"searchTerm": "e"})
+            data = json.loads(res.data)
+            ids += [question["id"] for question in data["questions"]]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(ids[:10], ranked)
+        self.assertNotEqual(ids, sorted(ids))
+        self.assertEqual(sorted(ids), sorted(set(ids)))
+        self.assertGreater(total, 10)
+        self.assertEqual(len(ids), total)
+
+    def test_400_search_with_listing_cursor(self):
+        data = json.loads(self.client().get("/questions?cursor=").data)
+        res = self.client().post(f"/questions?cursor={data['next_cursor']}", json={"searchTerm": "e"})
+
+        self.assertEqual(res.status_code, 400)
+
     def test_404_search_question_failed(self):
         res = self.client().post("/questions", json=self.new_question4)
         data = json.loads(res.data)
@@ -217,6 +481,28 @@ class QuestionModelTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertTrue(data["question"])
 
+    def test_get_quiz_is_random(self):
+        self.app.config["RATE_LIMITS"] = {}
+        ids = set()
+        for _ in range(50):
+            res = self.client().post("/quizzes", json=self.quiz2)
+            data = json.loads(res.data)
+            self.assertEqual(data["question"]["category_id"], self.quiz2["quiz_category"]["id"])
+            ids.add(data["question"]["id"])
+
+        self.assertGreater(len(ids), 1)
+
+    def test_get_quiz_category_exhausted(self):
+        with self.app.app_context():
+            played = [question.id for question in Question.query.filter(Question.category_id == 5)]
+        quiz = {"previous_questions": played, "quiz_category": {"id": 5, "name": "Entertainment"}}
+        res = self.client().post("/quizzes", json=quiz)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertNotIn("question", data)
+
     def test_no_quiz(self):
         res = self.client().post("/quizzes", json=self.quiz4)
         data = json.loads(res.data)
@@ -224,6 +510,427 @@ class QuestionModelTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
 
+    def test_adaptive_quiz_raises_difficulty(self):
+        quiz = {"quiz_category": {"id": 0}, "adaptive": True, "difficulty": 2, "recent_answers": [True] * 4}
+        res = self.client().post("/quizzes", json=quiz)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["question"]["difficulty"], 3)
+
+    def test_adaptive_quiz_lowers_difficulty(self):
+        quiz = {"quiz_category": {"id": 0}, "adaptive": True, "difficulty": 3,
+                "recent_answers": [True, False, False, False]}
+        data = json.loads(self.client().post("/quizzes", json=quiz).data)
+
+        self.assertEqual(data.get("question", data)["difficulty"], 2)
+
+    def test_adaptive_quiz_keeps_difficulty_until_window_is_full(self):
+        quiz = {"quiz_category": {"id": 0}, "adaptive": True, "difficulty": 2, "recent_answers": [True] * 3}
+        data = json.loads(self.client().post("/quizzes", json=quiz).data)
+
+        self.assertEqual(data.get("question", data)["difficulty"], 2)
+
+    def test_adaptive_quiz_falls_back_to_nearest_difficulty(self):
+        with self.app.app_context():
+            hard = [question.id for question in Question.query.filter_by(category_id=1, difficulty=4)]
+        quiz = {"quiz_category": {"id": 1}, "adaptive": True, "difficulty": 5}
+        data = json.loads(self.client().post("/quizzes", json=quiz).data)
+
+        self.assertEqual(data["question"]["difficulty"], 4)
+
+        data = json.loads(self.client().post("/quizzes", json=dict(quiz, previous_questions=hard)).data)
+
+        self.assertEqual(data["question"]["difficulty"], 3)
+
+    def test_400_adaptive_quiz_invalid_difficulty(self):
+        quiz = {"quiz_category": {"id": 0}, "adaptive": True, "difficulty": 9}
+        res = self.client().post("/quizzes", json=quiz)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)["success"], False)
+
+    def test_question_pool_difficulty_buckets(self):
+        pool = QuestionPool()
+        pool.fill([(1, 1, 1), (2, 1, 3), (3, 2, 3)])
+
+        self.assertEqual(pool.choose_near(1, 3), 2)
+        self.assertEqual(pool.choose_near(1, 1, exclude={1}), 2)
+        self.assertEqual(pool.size((None, 3)), 2)
+
+        pool.add(4, 1, 2)
+        pool.remove(2, 1, 3)
+
+        self.assertEqual(pool.choose_near(1, 3), 4)
+        self.assertEqual(pool.size((None, 3)), 1)
+        self.assertEqual(pool.size(1), 2)
+
+    def assertLoadedOnce(self, index, rows, use):
+        loads = []
+
+        def load():
+            loads.append(threading.current_thread())
+            time.sleep(0.05)
+            index.fill(rows)
+
+        index.load = load
+        threads = [threading.Thread(target=use) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(loads), 1)
+
+    def test_stale_question_pool_loaded_once(self):
+        pool = QuestionPool()
+        self.assertLoadedOnce(pool, [(1, 1, 1), (2, 1, 3)], pool.ensure_loaded)
+        self.assertEqual(pool.size(1), 2)
+
+    def test_stale_question_pool_served_while_rebuilt(self):
+        pool = QuestionPool()
+        pool.fill([(1, 1, 1), (2, 1, 3)])
+        pool.invalidate()
+        rebuilding = threading.Event()
+
+        def load():
+            rebuilding.wait(1)
+            pool.fill([(1, 1, 1), (2, 1, 3), (3, 1, 2)])
+
+        pool.load = load
+        with self.app.app_context():
+            pool.ensure_loaded()
+            pool.ensure_loaded()
+
+            # The old pool is served, and changes made meanwhile are kept through the swap
+            self.assertEqual(pool.size(1), 2)
+            pool.add(4, 1, 5)
+            pool.remove(1, 1, 1)
+            rebuilding.set()
+            pool.refresh_thread.join()
+
+        self.assertFalse(pool.is_stale())
+        self.assertEqual(pool.size(1), 3)
+        self.assertEqual(pool.size((None, 5)), 1)
+        self.assertIsNone(pool.choose_near(1, 1, exclude={2, 3, 4}))
+
+    def test_quiz_session_shares_pool_buckets(self):
+        pool = QuestionPool()
+        pool.fill([(question_id, question_id % 2, 1) for question_id in range(1, 101)])
+        session = QuizSession(1, pool.snapshot(1))
+        pool.add(101, 1, 1)
+        drawn = []
+        while (question_id := session.next_id()) is not None:
+            drawn.append(question_id)
+
+        self.assertEqual(sorted(drawn), list(range(1, 101, 2)))
+        self.assertEqual(session.swapped, {})
+
+    def test_stale_search_index_loaded_once(self):
+        index = MemorySearch()
+        self.assertLoadedOnce(index, [(1, "Who wrote it?", "Ada")], index.ensure_loaded)
+        self.assertEqual(index.search("wrote"), [1])
+
+    ###################################################################################################################
+    # Tests for quiz sessions
+    ###################################################################################################################
+    def test_quiz_session_serves_each_question_once(self):
+        res = self.client().post("/quizzes/sessions", json=self.quiz2)
+        data = json.loads(res.data)
+        session_id = data["session_id"]
+        total = data["totalQuestions"]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+
+        served = []
+        for _ in range(total):
+            data = json.loads(self.client().post(f"/quizzes/sessions/{session_id}/next").data)
+            self.assertEqual(data["question"]["category_id"], self.quiz2["quiz_category"]["id"])
+            served.append(data["question"]["id"])
+        data = json.loads(self.client().post(f"/quizzes/sessions/{session_id}/next").data)
+
+        self.assertEqual(len(set(served)), total)
+        self.assertNotIn("question", data)
+        self.assertEqual(data["remaining"], 0)
+
+    def test_quiz_session_draws_are_atomic(self):
+        session = QuizSession(None, [array("q", range(10000)), array("q", range(10000, 20000))])
+        drawn = []
+
+        def draw():
+            while (question_id := session.next_id()) is not None:
+                drawn.append(question_id)
+
+        # Switching threads as often as possible makes unguarded draws collide
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=draw) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        self.assertEqual(sorted(drawn), list(range(20000)))
+
+    def test_adaptive_quiz_session_follows_answers(self):
+        self.app.config.update(RATE_LIMITS={}, QUIZ_START_DIFFICULTY=2)
+        data = json.loads(self.client().post("/quizzes/sessions", json={"quiz_category": {"id": 0},
+                                                                        "adaptive": True}).data)
+        session_id = data["session_id"]
+        total = data["totalQuestions"]
+        served = []
+        difficulties = []
+        data = json.loads(self.client().post(f"/quizzes/sessions/{session_id}/next").data)
+        for _ in range(5):
+            served.append(data["question"]["id"])
+            difficulties.append(data["question"]["difficulty"])
+            data = json.loads(self.client().post(f"/quizzes/sessions/{session_id}/next", json={"correct": True}).data)
+        difficulties.append(data["question"]["difficulty"])
+
+        self.assertEqual(difficulties, [2, 2, 2, 2, 3, 3])
+        self.assertEqual(len(set(served)), 5)
+        self.assertEqual(data["remaining"], total - 6)
+
+    def test_delete_quiz_session(self):
+        data = json.loads(self.client().post("/quizzes/sessions", json=self.quiz2).data)
+        res = self.client().delete(f"/quizzes/sessions/{data['session_id']}")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["deleted"], data["session_id"])
+        self.assertEqual(self.client().post(f"/quizzes/sessions/{data['session_id']}/next").status_code, 404)
+
+    def test_404_quiz_session_unknown_category(self):
+        res = self.client().post("/quizzes/sessions", json=self.quiz4)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+
+    def test_404_quiz_session_not_found(self):
+        res = self.client().post("/quizzes/sessions/unknown/next")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "resource not found")
+
+    def test_400_quiz_session_without_category(self):
+        res = self.client().post("/quizzes/sessions", json={})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    ###################################################################################################################
+    # Tests for scores and the leaderboard
+    ###################################################################################################################
+    def clear_scores(self):
+        self.app.config["RATE_LIMITS"] = {}
+        with self.app.app_context():
+            Score.query.delete()
+            db.session.commit()
+
+    def post_score(self, player, category_id, correct=True):
+        return self.client().post("/scores", json={"player": player, "quiz_category": {"id": category_id},
+                                                   "question_id": 1, "correct": correct})
+
+    def test_create_score(self):
+        self.clear_scores()
+        res = self.post_score("ada", 1)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["score"], 1)
+        self.assertEqual(json.loads(self.post_score("ada", 1, False).data)["score"], 1)
+
+    def test_leaderboard_ranks_players(self):
+        self.clear_scores()
+        for player, category_id in [("ada", 1), ("ada", 1), ("bob", 1), ("bob", 2), ("bob", 2), ("cy", 2)]:
+            self.post_score(player, category_id)
+        science = json.loads(self.client().get("/leaderboard?category=1").data)
+        overall = json.loads(self.client().get("/leaderboard?limit=2").data)
+
+        self.assertEqual(science["leaderboard"], [{"rank": 1, "player": "ada", "score": 2},
+                                                  {"rank": 2, "player": "bob", "score": 1}])
+        self.assertEqual(overall["category"], None)
+        self.assertEqual([(entry["player"], entry["score"]) for entry in overall["leaderboard"]],
+                         [("bob", 3), ("ada", 2)])
+
+    def test_scores_are_written_in_batches(self):
+        self.clear_scores()
+        for _ in range(3):
+            self.post_score("ada", 1)
+        buffer = self.app.extensions["score_buffer"]
+
+        with self.app.app_context():
+            self.assertEqual(buffer.flush(), 3)
+            self.assertEqual(Score.query.filter_by(player="ada").count(), 3)
+        self.assertEqual(buffer.flushes, 1)
+
+    def test_scores_flush_at_size_threshold(self):
+        self.clear_scores()
+        buffer = self.app.extensions["score_buffer"]
+        buffer.size = 2
+        buffer.interval = 60
+        self.post_score("ada", 1)
+        self.post_score("ada", 1)
+        deadline = time.monotonic() + 5
+        while buffer.flushed < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(buffer.flushed, 2)
+        self.assertEqual(len(buffer), 0)
+
+    def test_leaderboard_loads_flushed_scores(self):
+        self.clear_scores()
+        self.post_score("ada", 1)
+        self.app.extensions["score_buffer"].flush()
+        app = create_app(make_test_config())
+        data = json.loads(app.test_client().get("/leaderboard?category=1").data)
+
+        self.assertEqual(data["leaderboard"], [{"rank": 1, "player": "ada", "score": 1}])
+
+    def test_400_create_score_invalid(self):
+        self.clear_scores()
+        res = self.client().post("/scores", json={"player": "", "quiz_category": {"id": 1}, "correct": True})
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.client().post("/scores", json={"player": "ada", "quiz_category": {"id": 1},
+                                                             "correct": "yes"}).status_code, 400)
+
+    def test_422_create_score_unknown_category(self):
+        self.clear_scores()
+        res = self.post_score("ada", 1000)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(json.loads(res.data)["success"], False)
+
+    def test_leaderboard_keeps_top_players(self):
+        leaderboard = Leaderboard(size=2)
+        leaderboard.fill([(1, "ada", 3), (1, "bob", 2), (1, "cy", 1)])
+
+        self.assertEqual(leaderboard.top(1), [("ada", 3), ("bob", 2)])
+
+        leaderboard.add(1, "cy")
+        leaderboard.add(1, "cy")
+
+        self.assertEqual(leaderboard.top(1), [("ada", 3), ("cy", 3)])
+        self.assertEqual(leaderboard.top(None), [("ada", 3), ("cy", 3)])
+        self.assertEqual(leaderboard.score(1, "bob"), 2)
+
+    def test_leaderboard_counts_answers_during_reload(self):
+        self.clear_scores()
+        self.post_score("ada", 1)
+        leaderboard = self.app.extensions["leaderboard"]
+        buffer = self.app.extensions["score_buffer"]
+        leaderboard.invalidate()
+        querying = threading.Event()
+        release = threading.Event()
+        load = leaderboard.load
+
+        def slow_load():
+            querying.set()
+            release.wait(5)
+            return load()
+
+        leaderboard.load = slow_load
+
+        def reload():
+            with self.app.app_context():
+                leaderboard.ensure_loaded(buffer)
+
+        thread = threading.Thread(target=reload)
+        thread.start()
+        querying.wait(5)
+        # Answers are counted while the boards rebuild, without waiting for the query
+        self.assertTrue(leaderboard.lock.acquire(timeout=1))
+        leaderboard.add(1, "bob")
+        buffer.record({"player": "bob", "category_id": 1, "question_id": None, "correct": True})
+        leaderboard.lock.release()
+        release.set()
+        thread.join()
+        buffer.flush()
+
+        self.assertEqual(leaderboard.top(1), [("ada", 1), ("bob", 1)])
+        with self.app.app_context():
+            leaderboard.invalidate()
+            leaderboard.ensure_loaded(buffer)
+        self.assertEqual(leaderboard.top(1), [("ada", 1), ("bob", 1)])
+
+    ###################################################################################################################
+    # Tests for the event stream
+    ###################################################################################################################
+    def test_event_stream_question_changes(self):
+        res = self.client().get("/events", buffered=False)
+        chunks = iter(res.response)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "text/event-stream")
+        self.assertIn(b"retry:", next(chunks))
+
+        self.client().post("/questions", json=self.new_question)
+        created = next(chunks).decode()
+
+        self.assertIn("event: question.created", created)
+        self.assertIn("Mona Lisa", created)
+
+        question_id = json.loads(created.split("data: ")[1])["id"]
+        self.client().delete(f"/questions/{question_id}")
+
+        self.assertIn(f'"id":{question_id}', next(chunks).decode())
+
+        res.close()
+        self.assertEqual(len(self.app.extensions["events"]), 0)
+
+    def test_503_event_streams_over_cap(self):
+        self.app.config["SSE_MAX_STREAMS"] = 1
+        first = self.client().get("/events", buffered=False)
+        res = self.client().get("/events")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data["message"], "service unavailable")
+        self.assertEqual(res.headers["Retry-After"], "15")
+        first.close()
+        res = self.client().get("/events", buffered=False)
+        self.assertEqual(res.status_code, 200)
+        res.close()
+
+    def test_event_stream_keepalive(self):
+        self.app.config["SSE_KEEPALIVE_SECONDS"] = 0.01
+        res = self.client().get("/events", buffered=False)
+        chunks = iter(res.response)
+        next(chunks)
+
+        self.assertEqual(next(chunks), b": keepalive\n\n")
+        res.close()
+
+    def test_event_stream_resumes_from_last_event_id(self):
+        broker = self.app.extensions["events"]
+        first = broker.publish("questions.changed", {})
+        second = broker.publish("questions.changed", {})
+        res = self.client().get("/events", buffered=False, headers={"Last-Event-ID": str(first.id)})
+        opening = next(iter(res.response)).decode()
+        res.close()
+
+        self.assertIn(f"id: {second.id}\n", opening)
+        self.assertNotIn(f"id: {first.id}\n", opening)
+
+    def test_event_stream_resets_when_history_is_gone(self):
+        broker = Broker(history=1)
+        broker.publish("questions.changed", {})
+        broker.publish("questions.changed", {})
+        broker.publish("questions.changed", {})
+
+        self.assertIsNone(broker.replay(1))
+        self.assertEqual([event.id for event in broker.replay(2)], [3])
+        self.assertEqual(broker.replay(3), [])
+
     ###################################################################################################################
     # Tests for retrieve_questions
     ###################################################################################################################
@@ -253,6 +960,51 @@ class QuestionModelTestCase(unittest.TestCase):
         self.assertTrue(len(data["categories"]))
         self.assertTrue(len(data["questions"]))
 
+    def test_get_last_page_of_questions(self):
+        res = self.client().get("/questions?page=2")
+        data = json.loads(res.data)
+        total = Question.query.count()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["totalQuestions"], total)
+        self.assertEqual(len(data["questions"]), total - 10)
+        self.assertEqual(data["questions"], sorted(data["questions"], key=lambda question: question["id"]))
+
+    def test_get_questions_by_cursor(self):
+        res = self.client().get("/questions?cursor=")
+        data = json.loads(res.data)
+        seen = [question["id"] for question in data["questions"]]
+        total = data["totalQuestions"]
+        while data["next_cursor"]:
+            res = self.client().get(f"/questions?cursor={data['next_cursor']}")
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn("totalQuestions", data)
+            seen += [question["id"] for question in data["questions"]]
+
+        self.assertEqual(len(seen), total)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_large_bank_pages(self):
+        with self.app.app_context():
+            total = seed_bank(20000)
+        res = self.client().get("/questions?page=2002")
+        data = json.loads(res.data)
+
+        self.assertEqual(total, 20019)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["totalQuestions"], total)
+        self.assertEqual(len(data["questions"]), 9)
+
+    def test_400_invalid_cursor(self):
+        res = self.client().get("/questions?cursor=not-a-cursor")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+
     def test_404_sent_requesting_beyond_valid_page(self):
         res = self.client().get("/questions?page=1000")
         data = json.loads(res.data)
@@ -261,6 +1013,67 @@ class QuestionModelTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "resource not found")
 
+    ###################################################################################################################
+    # Tests for instrumentation
+    ###################################################################################################################
+    def test_server_timing_header(self):
+        res = self.client().get("/questions?page=1")
+        timings = res.headers.getlist("Server-Timing")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(timings[0].startswith("db;dur="))
+        self.assertNotIn('desc="0 queries"', timings[0])
+
+    def test_metrics(self):
+        self.client().get("/questions?page=1")
+        res = self.client().get("/metrics")
+        body = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_requests_total{endpoint="retrieve_questions",status="200"} 1', body)
+        self.assertIn('trivia_sql_queries_total{endpoint="retrieve_questions"}', body)
+        self.assertIn("trivia_category_cache_misses_total 1", body)
+
+    def test_pool_stats(self):
+        res = self.client().get("/pool")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(data["pool"])
+
+    def test_engine_options(self):
+        options = engine_options({"SQLALCHEMY_DATABASE_URI": "postgresql://localhost/trivia", "DB_POOL_SIZE": 8,
+                                  "DB_MAX_OVERFLOW": 2, "DB_POOL_TIMEOUT": 1, "DB_POOL_RECYCLE": 60,
+                                  "DB_POOL_PRE_PING": True, "DB_STATEMENT_TIMEOUT_MS": 250})
+
+        self.assertEqual(options["poolclass"], TimedQueuePool)
+        self.assertEqual(options["pool_size"], 8)
+        self.assertEqual(options["connect_args"], {"options": "-c statement_timeout=250"})
+
+    def test_repeated_statement_is_logged(self):
+        self.app.config["SQL_REPEAT_WARN_THRESHOLD"] = 2
+        with self.assertLogs(self.app.logger, level="WARNING") as logs:
+            with self.app.test_request_context():
+                self.app.preprocess_request()
+                for question_id in (2, 4, 6):
+                    Question.query.get(question_id)
+                self.app.process_response(self.app.response_class())
+
+        self.assertTrue(any("Possible N+1 query" in line for line in logs.output))
+
+    def test_failed_statement_does_not_skew_timings(self):
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            with self.assertRaises(DBAPIError):
+                db.session.execute(text("SELECT * FROM no_such_table"))
+            db.session.rollback()
+            time.sleep(0.05)
+            db.session.execute(text("SELECT 1"))
+
+            self.assertEqual(g.sql_statements["SELECT 1"], 1)
+            self.assertLess(g.sql_seconds, 0.05)
+
     ###################################################################################################################
     # Tests for delete_question
     ###################################################################################################################
@@ -284,6 +1097,557 @@ class QuestionModelTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "unprocessable")
 
+    ###################################################################################################################
+    # Tests for rate limiting
+    ###################################################################################################################
+    def test_429_search_rate_limited(self):
+        self.app.config.update(RATE_LIMITS={"search": (0.5, 2)}, RATELIMIT_API_KEYS={"other"})
+        statuses = [self.client().post("/questions", json={"searchTerm": "title"}).status_code for _ in range(3)]
+        res = self.client().post("/questions", json={"searchTerm": "title"})
+        data = json.loads(res.data)
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "too many requests")
+        self.assertGreaterEqual(int(res.headers["Retry-After"]), 1)
+        res = self.client().post("/questions", json={"searchTerm": "title"}, headers={"X-API-Key": "other"})
+        self.assertEqual(res.status_code, 200)
+
+    def test_unknown_api_keys_share_the_address_bucket(self):
+        self.app.config.update(RATE_LIMITS={"search": (0.5, 2)}, RATELIMIT_API_KEYS={"known"})
+        statuses = [self.client().post("/questions", json={"searchTerm": "title"},
+                                       headers={"X-API-Key": f"made-up-{attempt}"}).status_code
+                    for attempt in range(3)]
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(self.client().post("/questions", json={"searchTerm": "title"}).status_code, 429)
+        res = self.client().post("/questions", json={"searchTerm": "title"}, headers={"X-API-Key": "known"})
+        self.assertEqual(res.status_code, 200)
+
+    def test_429_quiz_rate_limited(self):
+        self.app.config["RATE_LIMITS"] = {"quizzes": (0.5, 1)}
+        statuses = [self.client().post("/quizzes", json=self.quiz1).status_code for _ in range(2)]
+
+        self.assertEqual(statuses, [200, 429])
+
+    def test_token_bucket_refills(self):
+        store = MemoryStore()
+
+        self.assertEqual(store.take("client", 2, 1, now=100.0), (True, 0.0))
+        self.assertEqual(store.take("client", 2, 1, now=100.0), (False, 0.5))
+        self.assertEqual(store.take("client", 2, 1, now=100.5), (True, 0.0))
+
+    def test_503_over_concurrency_cap(self):
+        admission = self.app.extensions["admission"]
+        admission.timeout = 0
+        for _ in range(admission.limit):
+            admission.slots.acquire()
+        try:
+            res = self.client().get("/categories")
+        finally:
+            for _ in range(admission.limit):
+                admission.slots.release()
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data["message"], "service unavailable")
+        self.assertEqual(res.headers["Retry-After"], "1")
+        self.assertEqual(self.client().get("/categories").status_code, 200)
+
+    ###################################################################################################################
+    # Tests for the batch endpoints
+    ###################################################################################################################
+    def test_create_question_batch(self):
+        res = self.client().post("/questions/batch", json={"questions": [
+            {"question": "Batch one?", "answer": "One", "category": 6, "difficulty": 1},
+            {"question": "Batch two?", "answer": "Two", "category": 100, "difficulty": 1},
+            {"question": "Batch three?", "answer": "Three", "category": 6, "difficulty": 2},
+        ]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data["created"], data["rejected"]), (2, 1))
+        self.assertEqual([result["status"] for result in data["results"]], ["created", "rejected", "created"])
+        with self.app.app_context():
+            created = {result["id"]: Question.query.get(result["id"]).question
+                       for result in data["results"] if "id" in result}
+        self.assertEqual(sorted(created.values()), ["Batch one?", "Batch three?"])
+        self.client().delete("/questions/batch", json={"ids": list(created)})
+
+    def test_delete_question_batch_by_ids(self):
+        res = self.client().post("/questions/batch", json={"questions": [
+            {"question": f"Doomed {index}?", "answer": "Doomed", "category": 6, "difficulty": 1} for index in range(3)
+        ]})
+        ids = [result["id"] for result in json.loads(res.data)["results"]]
+        with self.app.app_context():
+            total = question_total(6)
+        res = self.client().delete("/questions/batch", json={"ids": ids + [100000]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["deleted"], 3)
+        self.assertEqual(data["results"][-1], {"id": 100000, "status": "not found"})
+        with self.app.app_context():
+            self.assertEqual(Question.query.filter(Question.id.in_(ids)).count(), 0)
+            self.assertEqual(question_total(6), total - 3)
+
+    def test_delete_question_batch_by_filter(self):
+        self.client().post("/questions/batch", json={"questions": [
+            {"question": f"Filtered {index}?", "answer": "Filtered", "category": 7, "difficulty": 5}
+            for index in range(2)
+        ]})
+        res = self.client().delete("/questions/batch", json={"category": 7, "difficulty": 5})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["deleted"], 2)
+        with self.app.app_context():
+            self.assertEqual(Question.query.filter_by(category_id=7, difficulty=5).count(), 0)
+
+    def test_400_question_batch(self):
+        res = self.client().delete("/questions/batch", json={"ids": ["one"]})
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.client().delete("/questions/batch", json={}).status_code, 400)
+        self.assertEqual(self.client().post("/questions/batch", json={"questions": []}).status_code, 400)
+
+    def test_400_question_batch_delete_filters(self):
+        for body in ({"category": True}, {"difficulty": False}, {"category": "4", "difficulty": 2},
+                     {"category": 4, "difficulty": "2"}, {"category": None}, {"ids": [True]},
+                     {"ids": [5], "category": "4"}):
+            res = self.client().delete("/questions/batch", json=body)
+
+            self.assertEqual(res.status_code, 400, body)
+        with self.app.app_context():
+            self.assertEqual(question_total(), 19)
+            self.assertEqual(Question.query.count(), 19)
+
+    def test_413_question_batch_too_large(self):
+        self.app.config["QUESTION_BATCH_LIMIT"] = 2
+        res = self.client().delete("/questions/batch", json={"ids": [1, 2, 3]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 413)
+        self.assertEqual(data["message"], "request entity too large")
+
+
+class QueryPlanTestCase(TransactionalTestCase):
+    """This class checks that the hot filter queries are served by an index"""
+
+    def assertUsesIndex(self, query, table, index):
+        with self.app.app_context():
+            dialect = db.engine.dialect
+            statement = str(query.statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+            if dialect.name == "sqlite":
+                plan = " ".join(row[-1] for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {statement}")))
+                # A SCAN ... USING COVERING INDEX would still read every row
+                self.assertIn(f"SEARCH {table} USING INDEX {index}", plan)
+            else:
+                # Small test tables are cheaper to scan, so only a missing index leaves a Seq Scan
+                db.session.execute(text("SET LOCAL enable_seqscan = off"))
+                plan = " ".join(row[0] for row in db.session.execute(text(f"EXPLAIN {statement}")))
+                db.session.rollback()
+                self.assertNotIn("Seq Scan", plan)
+                self.assertIn(index, plan)
+
+    def test_category_questions_use_index(self):
+        self.assertUsesIndex(Question.query.filter_by(category_id=4), "questions",
+                             "ix_questions_category_id_difficulty")
+
+    def test_category_difficulty_questions_use_index(self):
+        self.assertUsesIndex(Question.query.filter(Question.category_id == 4, Question.difficulty == 2), "questions",
+                             "ix_questions_category_id_difficulty")
+
+    def test_category_name_lookup_uses_index(self):
+        self.assertUsesIndex(Category.query.filter(func.lower(Category.name) == "history"), "categories",
+                             "ix_categories_name_lower")
+
+
+class AsyncAppTestCase(DatabaseFileTestCase):
+    """This class checks that the ASGI app keeps the JSON contracts of the WSGI app"""
+
+    def setUp(self):
+        """Define test variables and initialize both apps."""
+        super().setUp()
+        self.app = create_app(self.make_test_config())
+        self.client = self.app.test_client
+        self.asgi_app = create_asgi_app(self.make_test_config())
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        self.loop.run_until_complete(self.asgi_app.engine.dispose())
+        self.loop.close()
+
+    async def asgi_call(self, method, path, body=None):
+        path, _, query = path.partition("?")
+        scope = {"type": "http", "method": method, "path": path, "query_string": query.encode()}
+        messages = [{"type": "http.request", "body": json.dumps(body).encode() if body is not None else b""}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await self.asgi_app(scope, receive, send)
+        self.asgi_headers = dict(sent[0]["headers"])
+        return sent[0]["status"], json.loads(sent[1]["body"])
+
+    def asgi_request(self, method, path, body=None):
+        return self.loop.run_until_complete(self.asgi_call(method, path, body))
+
+    def assertSameResponse(self, method, path, body=None):
+        res = self.client().open(path, method=method, json=body)
+        status, data = self.asgi_request(method, path, body)
+
+        self.assertEqual(status, res.status_code)
+        self.assertEqual(data, json.loads(res.data))
+
+    def test_same_categories(self):
+        self.assertSameResponse("GET", "/categories")
+
+    def test_same_questions_page(self):
+        self.assertSameResponse("GET", "/questions?page=2")
+        self.assertSameResponse("GET", "/questions?cursor=")
+
+    def test_same_category_questions(self):
+        self.assertSameResponse("GET", "/categories/4/questions")
+        self.assertSameResponse("GET", "/categories/100/questions")
+
+    def test_same_search(self):
+        self.assertSameResponse("POST", "/questions", {"searchTerm": "title"})
+        self.assertSameResponse("POST", "/questions", {"searchTerm": "Nirtumizac"})
+        self.assertSameResponse("POST", "/questions?cursor=", {"searchTerm": "e"})
+
+    def test_same_errors(self):
+        self.assertSameResponse("POST", "/questions", {"answer": "Maya Angelou"})
+        self.assertSameResponse("PUT", "/categories")
+        self.assertSameResponse("DELETE", "/questions/1000")
+        self.assertSameResponse("POST", "/quizzes")
+        self.assertSameResponse("POST", "/quizzes", {"quiz_category": {"id": "history"}})
+        self.assertSameResponse("POST", "/quizzes/sessions", {"quiz_category": {"id": 100}})
+
+    def test_async_500_logged(self):
+        async def fail(session, request):
+            raise RuntimeError("boom")
+
+        self.asgi_app.routes.insert(0, ("GET", re.compile("/fail$"), fail))
+        with self.assertLogs("flaskr.asgi", level="ERROR") as logs:
+            status, data = self.asgi_request("GET", "/fail")
+
+        self.assertEqual(status, 500)
+        self.assertEqual(data, {"success": False, "error": 500, "message": "internal server error"})
+        self.assertIn("RuntimeError: boom", logs.output[0])
+
+    def test_async_event_stream(self):
+        sent = []
+
+        async def scenario():
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {"type": "http", "method": "GET", "path": "/events", "query_string": b"", "headers": []}
+            stream = asyncio.ensure_future(self.asgi_app(scope, receive, send))
+            await asyncio.sleep(0.01)
+            await self.asgi_call("POST", "/questions", {"question": "Async event?", "answer": "Yes",
+                                                        "category": 1, "difficulty": 1})
+            await asyncio.sleep(0.01)
+            created = json.loads(sent[-1]["body"].decode().split("data: ")[1])
+            await self.asgi_call("DELETE", f"/questions/{created['id']}")
+            await asyncio.sleep(0.01)
+            disconnected.set()
+            await stream
+
+        self.loop.run_until_complete(scenario())
+        body = "".join(message.get("body", b"").decode() for message in sent[1:])
+
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertIn("event: question.created", body)
+        self.assertIn("event: question.deleted", body)
+        self.assertEqual([len(fanout.queues) for fanout in self.asgi_app.fanouts.values()], [0])
+
+    def test_async_429_rate_limited(self):
+        self.asgi_app.config["RATE_LIMITS"] = {"quizzes": (0.5, 1), "search": (0.5, 1)}
+        quiz = {"quiz_category": {"id": 4, "name": "History"}}
+        statuses = [self.asgi_request("POST", "/quizzes", quiz)[0] for _ in range(2)]
+        first_search = self.asgi_request("POST", "/questions", {"searchTerm": "title"})[0]
+        status, data = self.asgi_request("POST", "/questions", {"searchTerm": "title"})
+
+        self.assertEqual(statuses, [200, 429])
+        self.assertEqual((first_search, status), (200, 429))
+        self.assertEqual(data, {"success": False, "error": 429, "message": "too many requests"})
+        self.assertGreaterEqual(int(self.asgi_headers[b"retry-after"]), 1)
+
+    def test_async_503_over_concurrency_cap(self):
+        admission = self.asgi_app.admission
+        admission.timeout = 0
+
+        async def scenario():
+            for _ in range(admission.limit):
+                await admission.slots.acquire()
+            try:
+                return await self.asgi_call("GET", "/categories")
+            finally:
+                for _ in range(admission.limit):
+                    admission.release()
+
+        status, data = self.loop.run_until_complete(scenario())
+
+        self.assertEqual(status, 503)
+        self.assertEqual(data["message"], "service unavailable")
+        self.assertEqual(self.asgi_headers[b"retry-after"], b"1")
+        self.assertEqual(self.asgi_request("GET", "/categories")[0], 200)
+
+    def test_async_writes_keep_category_stats(self):
+        def science_total():
+            stats = json.loads(self.client().get("/categories/stats").data)
+            return next(category["totalQuestions"] for category in stats["categories"] if category["id"] == 1)
+
+        self.asgi_request("POST", "/questions", {"question": "Async stats?", "answer": "Yes",
+                                                 "category": 1, "difficulty": 1})
+
+        self.assertEqual(science_total(), 4)
+        with self.app.app_context():
+            question = Question.query.filter(Question.question == "Async stats?").one()
+        self.asgi_request("DELETE", f"/questions/{question.id}")
+
+        self.assertEqual(science_total(), 3)
+
+    def test_async_quiz(self):
+        status, data = self.asgi_request("POST", "/quizzes", {"previous_questions": [5, 9, 23],
+                                                              "quiz_category": {"id": 4, "name": "History"}})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data["question"]["id"], 12)
+
+    def test_async_adaptive_quiz(self):
+        quiz = {"quiz_category": {"id": 0}, "adaptive": True, "difficulty": 2, "recent_answers": [True] * 4}
+        status, data = self.asgi_request("POST", "/quizzes", quiz)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data["question"]["difficulty"], 3)
+        self.assertSameResponse("POST", "/quizzes", {"quiz_category": {"id": 0}, "adaptive": True, "difficulty": 9})
+
+    def test_async_adaptive_quiz_session(self):
+        self.asgi_app.config.update(RATE_LIMITS={}, QUIZ_START_DIFFICULTY=2)
+        _, data = self.asgi_request("POST", "/quizzes/sessions", {"quiz_category": {"id": 0}, "adaptive": True})
+        session_id = data["session_id"]
+        difficulties = []
+        _, data = self.asgi_request("POST", f"/quizzes/sessions/{session_id}/next")
+        for _ in range(5):
+            difficulties.append(data["question"]["difficulty"])
+            _, data = self.asgi_request("POST", f"/quizzes/sessions/{session_id}/next", {"correct": True})
+        difficulties.append(data["question"]["difficulty"])
+
+        self.assertEqual(difficulties, [2, 2, 2, 2, 3, 3])
+
+
+class ReplicaTestCase(DatabaseFileTestCase):
+    """This class checks that read-only routes are served by the read replicas"""
+
+    def setUp(self):
+        """Define test variables and create two replicas holding their own data."""
+        super().setUp()
+        self.paths = []
+        self.replicas = [self.create_replica("Replica A?"), self.create_replica("Replica B?")]
+        self.missing_replica = "sqlite:////nonexistent/trivia_replica.db"
+
+    def tearDown(self):
+        """Executed after reach test"""
+        for path in self.paths:
+            os.remove(path)
+
+    def create_replica(self, question):
+        handle, path = tempfile.mkstemp(prefix="trivia_replica_", suffix=".db")
+        os.close(handle)
+        self.paths.append(path)
+        engine = create_engine(f"sqlite:///{path}")
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(Category.__table__.insert(), {"id": 1, "name": "Replica"})
+            connection.execute(Question.__table__.insert(), {"question": question, "answer": "Replica",
+                                                             "difficulty": 1, "category_id": 1})
+        engine.dispose()
+        return f"sqlite:///{path}"
+
+    def create_app(self, replicas):
+        app = create_app(self.make_test_config(SQLALCHEMY_REPLICA_URIS=replicas))
+        self.addCleanup(lambda: [engine.dispose() for engine in app.extensions["replicas"].engines])
+        return app
+
+    def category_question(self, client):
+        data = json.loads(client.get("/categories/1/questions").data)
+        return data["questions"][0]["question"]
+
+    def test_reads_go_to_replica(self):
+        res = self.create_app(self.replicas[:1]).test_client().get("/questions")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([question["question"] for question in data["questions"]], ["Replica A?"])
+
+    def test_caches_refill_from_primary(self):
+        app = self.create_app(self.replicas[:1])
+        client = app.test_client()
+        with app.app_context():
+            Category("Written").insert()
+        data = json.loads(client.get("/categories").data)
+
+        # The replica never received the write, and only has its own category
+        self.assertIn("Written", data["categories"].values())
+        self.assertEqual(data["categories"]["1"], "Science")
+        self.assertEqual(self.category_question(client), "Replica A?")
+
+    def test_replicas_round_robin(self):
+        client = self.create_app(self.replicas).test_client()
+
+        self.assertEqual({self.category_question(client), self.category_question(client)},
+                         {"Replica A?", "Replica B?"})
+
+    def test_failover_to_next_replica(self):
+        app = self.create_app([self.missing_replica, self.replicas[0]])
+        client = app.test_client()
+
+        self.assertEqual(self.category_question(client), "Replica A?")
+        self.assertEqual(self.category_question(client), "Replica A?")
+        replicas = json.loads(client.get("/pool").data)["replicas"]
+        self.assertEqual([replica["healthy"] for replica in replicas], [False, True])
+
+    def test_quiz_draws_questions_the_replica_lacks(self):
+        client = self.create_app(self.replicas[:1]).test_client()
+        res = client.post("/quizzes", json={"previous_questions": [], "quiz_category": {"id": 1}})
+        data = json.loads(res.data)
+
+        # The pool holds the primary's questions, which the replica does not have
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(data["question"]["id"], (20, 21, 22))
+
+    def test_primary_serves_reads_without_replicas(self):
+        client = self.create_app([self.missing_replica]).test_client()
+
+        self.assertNotIn("Replica", self.category_question(client))
+
+    def test_writes_go_to_primary(self):
+        app = self.create_app(self.replicas[:1])
+        res = app.test_client().post("/questions", json={"question": "Primary?", "answer": "Primary",
+                                                         "category": 1, "difficulty": 1})
+
+        self.assertEqual(res.status_code, 200)
+        with app.app_context():
+            question = Question.query.filter(Question.question == "Primary?").one_or_none()
+            self.assertIsNotNone(question)
+            question.delete()
+
+    def test_request_pinned_to_primary_after_write(self):
+        app = self.create_app(self.replicas[:1])
+        with app.test_request_context():
+            use_replica()
+            self.assertEqual(Category.query.count(), 1)
+            category = Category("Pinned")
+            category.insert()
+            self.assertIsNotNone(Category.query.filter(Category.name == "Pinned").one_or_none())
+            category.delete()
+
+
+class StartupTestCase(DatabaseFileTestCase):
+    """This class checks that building the app stays free of database work"""
+    sample_data = False
+
+    def setUp(self):
+        """Define test variables and create an empty database."""
+        super().setUp()
+        self.app = create_app({"SQLALCHEMY_DATABASE_URI": self.database_url})
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        with self.app.app_context():
+            db.get_engine().dispose()
+
+    def test_create_app_does_no_database_io(self):
+        connections = []
+
+        def count_connection(*args):
+            connections.append(args)
+
+        event.listen(Pool, "connect", count_connection)
+        try:
+            create_app({"SQLALCHEMY_DATABASE_URI": self.database_url})
+        finally:
+            event.remove(Pool, "connect", count_connection)
+
+        self.assertEqual(connections, [])
+
+    def test_create_app_with_blank_database_settings(self):
+        # The URL config.py builds before its database settings are filled in
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql://:@:/"})
+        result = app.test_cli_runner().invoke(args=["seed", "--help"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(engine_options(app.config), {})
+
+    def test_sample_data_is_stamped_at_migration_head(self):
+        # Otherwise `flask db upgrade` replays migrations on a database loaded from trivia.psql
+        scripts = ScriptDirectory(os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations"))
+
+        self.assertEqual(read_sample_data()["alembic_version"], [{"version_num": scripts.get_current_head()}])
+
+    def test_seed_command(self):
+        result = self.app.test_cli_runner().invoke(args=["seed"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Seeded 7 categories and 19 questions", result.output)
+        with self.app.app_context():
+            self.assertEqual(question_total(), 19)
+
+        result = self.app.test_cli_runner().invoke(args=["seed"])
+
+        self.assertIn("nothing to seed", result.output)
+
+    def test_seed_command_fails_on_database_error(self):
+        with self.app.app_context():
+            db.session.add(Category("Science"))
+            db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=["seed"])
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Error: Seeding the database failed", result.output)
+        self.assertNotIn("Seeded", result.output)
+        with self.app.app_context():
+            self.assertEqual(Category.query.count(), 1)
+
+
+class TransactionalTestCaseTestCase(unittest.TestCase):
+    """This class checks that transactional tests leave the test database as they found it"""
+
+    def test_changes_are_rolled_back(self):
+        class Writes(TransactionalTestCase):
+            def runTest(self):
+                self.app.test_client().post("/categories", json={"name": "Rolled back"})
+                with self.app.app_context():
+                    seed_bank(1000)
+                    self.assertEqual(question_total(), 1019)
+
+        result = unittest.TestResult()
+        Writes().run(result)
+        app = create_app(make_test_config())
+
+        self.assertTrue(result.wasSuccessful(), result.errors + result.failures)
+        with app.app_context():
+            self.assertIsNone(Category.query.filter(Category.name == "Rolled back").one_or_none())
+            self.assertEqual(question_total(), 19)
+            db.get_engine().dispose()
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
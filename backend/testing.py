@@ -0,0 +1,177 @@
+import atexit
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, event, func, select
+
+from flaskr import create_app
+from models import Category, CategoryStat, db, notify_change, Question
+from synthetic import insert_questions
+
+SAMPLE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trivia.psql")
+
+sample_database = None
+
+
+def read_sample_data(path=SAMPLE_DATA):
+    """
+    Returns the rows of the COPY blocks of a pg_dump file by table name, converted to the column types.
+    Tables without a model, like alembic_version, keep their values as text.
+    """
+    tables = {}
+    rows = None
+    with open(path, encoding="utf-8") as dump:
+        for line in dump:
+            line = line.rstrip("\n")
+            if rows is None:
+                if line.startswith("COPY public."):
+                    name, _, columns = line[len("COPY public."):].partition(" ")
+                    table = db.metadata.tables.get(name)
+                    names = columns[columns.index("(") + 1:columns.index(")")].split(", ")
+                    types = [table.c[column].type.python_type if table is not None else str for column in names]
+                    rows = tables.setdefault(name, [])
+            elif line == "\\.":
+                rows = None
+            else:
+                rows.append({column: None if value == "\\N" else convert(value)
+                             for column, convert, value in zip(names, types, line.split("\t"))})
+    return tables
+
+
+def seed_sample_data(connection):
+    """
+    Inserts the sample categories and questions of trivia.psql, with their ids
+    """
+    data = read_sample_data()
+    for table in db.metadata.sorted_tables:
+        if data.get(table.name):
+            connection.execute(table.insert(), data[table.name])
+
+
+def sample_database_path():
+    """
+    Returns the path of a SQLite file holding the sample data, created on first use and removed at exit
+    """
+    global sample_database
+    if sample_database is None:
+        handle, path = tempfile.mkstemp(prefix="trivia_test_", suffix=".db")
+        os.close(handle)
+        atexit.register(os.remove, path)
+        engine = create_engine(f"sqlite:///{path}")
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            seed_sample_data(connection)
+        engine.dispose()
+        sample_database = path
+    return sample_database
+
+
+def get_database_url():
+    """
+    Returns the URL of the database the tests run against: TEST_DATABASE_URL, expected to hold
+    trivia.psql, or else the SQLite file of sample_database_path
+    """
+    return os.environ.get("TEST_DATABASE_URL") or f"sqlite:///{sample_database_path()}"
+
+
+def make_test_config(**overrides):
+    """
+    Returns the test_config of create_app for the test database. Answers are only written on an
+    explicit flush or once SCORE_FLUSH_SIZE are waiting, so tests do not race the flush thread.
+    """
+    config = {
+        "SQLALCHEMY_DATABASE_URI": get_database_url(),
+        "SCORE_FLUSH_SECONDS": 3600,
+    }
+    config.update(overrides)
+    if config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite") and "SQLALCHEMY_ENGINE_OPTIONS" not in overrides:
+        # The connection of a test transaction is shared with the score flush thread
+        config["SQLALCHEMY_ENGINE_OPTIONS"] = {"connect_args": {"check_same_thread": False}}
+    return config
+
+
+def seed_bank(size, seed=0):
+    """
+    Adds size synthetic questions, spread over the existing categories and difficulties, in the
+    current transaction, and returns the number of questions. Rows go in one executemany per
+    SEED_BATCH, so a large bank takes a fraction of a second.
+    """
+    category_ids = db.session.execute(select(Category.id).order_by(Category.id)).scalars().all()
+    counts = insert_questions(size, category_ids, random.Random(seed))
+    CategoryStat.adjust(counts)
+    db.session.commit()
+    notify_change("questions", "bulk")
+    return db.session.execute(select(func.count()).select_from(Question)).scalar()
+
+
+def disable_pysqlite_transactions(dbapi_connection, connection_record):
+    # pysqlite starts and ends transactions on its own, which breaks SAVEPOINTs; SQLAlchemy
+    # emits BEGIN itself instead
+    dbapi_connection.isolation_level = None
+
+
+def begin_sqlite_transaction(connection):
+    connection.exec_driver_sql("BEGIN")
+
+
+class TransactionalTestCase(unittest.TestCase):
+    """
+    Runs each test in a transaction that is rolled back afterwards, so tests see the sample data
+    and leave nothing behind. The app session works in a SAVEPOINT, started again after every
+    commit or rollback, so the code under test commits and rolls back as usual.
+    """
+
+    def setUp(self):
+        self.app = create_app(make_test_config())
+        with self.app.app_context():
+            self.engine = db.engine
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine, "connect", disable_pysqlite_transactions)
+            event.listen(self.engine, "begin", begin_sqlite_transaction)
+        self.connection = self.engine.connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+        self.app_session = db.session
+        db.session = db.create_scoped_session({"bind": self.connection, "binds": {}})
+        event.listen(db.session.session_factory, "after_transaction_end", self.restart_savepoint)
+
+    def restart_savepoint(self, session, transaction):
+        if not self.savepoint.is_active:
+            self.savepoint = self.connection.begin_nested()
+
+    def tearDown(self):
+        # Answers still waiting would be written after the rollback, by the exit flush
+        buffer = self.app.extensions["score_buffer"]
+        with buffer.lock:
+            buffer.pending.clear()
+        refresh = self.app.extensions["question_pool"].refresh_thread
+        if refresh is not None:
+            refresh.join()
+        db.session.remove()
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
+        self.engine.dispose()
+
+
+class DatabaseFileTestCase(unittest.TestCase):
+    """
+    Gives each test a SQLite file of its own, a copy of the sample data unless sample_data is False,
+    removed afterwards. For tests that cannot run in the transaction of TransactionalTestCase, such
+    as those of the async app, which has an engine of its own.
+    """
+    sample_data = True
+
+    def setUp(self):
+        handle, self.database_path = tempfile.mkstemp(prefix="trivia_test_", suffix=".db")
+        os.close(handle)
+        self.addCleanup(os.remove, self.database_path)
+        if self.sample_data:
+            shutil.copyfile(sample_database_path(), self.database_path)
+        self.database_url = f"sqlite:///{self.database_path}"
+
+    def make_test_config(self, **overrides):
+        return make_test_config(SQLALCHEMY_DATABASE_URI=self.database_url, **overrides)
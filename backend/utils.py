@@ -1,21 +1,202 @@
-from models import Category, db, Question
+import base64
+import binascii
+import bisect
+import json
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import abort
+
+from models import Category, db, format_question_row, Question, QUESTION_COLUMNS
+from stats import rebuild_category_stats
 
 QUESTIONS_PER_PAGE = 10
 
 
-def paginate_questions(request, selection):
-    page = request.args.get("page", 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    questions = [questions.format() for questions in selection]
-    current_questions = questions[start:end]
+class Page:
+    """
+    The page of a question listing asked for by the `page` or `cursor` request argument.
+    Offset pages are sliced in the database with LIMIT/OFFSET. Cursor pages seek past the last
+    question of the previous page, so every page costs the same, and only the first one (an
+    empty cursor) counts the questions. Listings page in Question.id order; ranked search
+    results keep their order, best first, with cursors seeking on (rank, id).
+    Page builds the statements and the response fields; running them is left to the app,
+    so the WSGI and the async app page alike.
+    """
+
+    def __init__(self, args):
+        self.by_cursor = "cursor" in args
+        self.number = args.get("page", 1, type=int)
+        token = args.get("cursor", "")
+        try:
+            self.after = decode_cursor(token) if token else None
+        except ValueError:
+            abort(400)
+        self.counted = not token
+        # Ranks of the questions on the page, by id, for the cursor of the next page
+        self.ranks = {}
+
+    def seek(self, ranked):
+        """
+        Returns the (rank, id) of the cursor, answering 400 to a cursor of a listing ranked otherwise
+        """
+        if self.after is None:
+            return None
+        if (self.after[0] is not None) != ranked:
+            abort(400)
+        return self.after
+
+    def statement(self, selection, rank=None):
+        """
+        Returns the statement selecting the QUESTION_COLUMNS of the page of a select() of Question,
+        ordered by the rank expression, best first, when one is given.
+        A cursor page selects one question more, which tells whether another page follows.
+        """
+        if rank is not None:
+            selection = selection.with_only_columns(*QUESTION_COLUMNS, rank.label("rank"))
+        else:
+            selection = selection.with_only_columns(*QUESTION_COLUMNS)
+        if not self.by_cursor:
+            if self.number < 1:
+                return selection.limit(0)
+            return selection.offset((self.number - 1) * QUESTIONS_PER_PAGE).limit(QUESTIONS_PER_PAGE)
+        after = self.seek(rank is not None)
+        if rank is None:
+            selection = selection.order_by(None).order_by(Question.id)
+            if after is not None:
+                selection = selection.where(Question.id > after[1])
+        else:
+            selection = selection.order_by(None).order_by(rank.desc(), Question.id)
+            if after is not None:
+                selection = selection.where(or_(rank < after[0], and_(rank == after[0], Question.id > after[1])))
+        return selection.limit(QUESTIONS_PER_PAGE + 1)
+
+    def questions(self, rows):
+        """
+        Formats the rows of statement(), keeping their ranks for the next cursor
+        """
+        questions = []
+        for row in rows:
+            questions.append(format_question_row(row))
+            if "rank" in row._fields:
+                self.ranks[row.id] = float(row.rank)
+        return questions
 
-    return current_questions
+    def ids(self, question_ids, ranks=None):
+        """
+        Returns the ids of the page of a list of question ids, like statement() does for queries.
+        With ranks, a {question id: rank} mapping, the list is ranked best first, ties by id.
+        """
+        if not self.by_cursor:
+            if self.number < 1:
+                return []
+            start = (self.number - 1) * QUESTIONS_PER_PAGE
+            question_ids = question_ids[start:start + QUESTIONS_PER_PAGE]
+        else:
+            after = self.seek(ranks is not None)
+            if ranks is None:
+                question_ids = sorted(question_ids)
+                start = bisect.bisect_right(question_ids, after[1]) if after is not None else 0
+            else:
+                keys = [(-ranks[question_id], question_id) for question_id in question_ids]
+                start = bisect.bisect_right(keys, (-after[0], after[1])) if after is not None else 0
+            question_ids = question_ids[start:start + QUESTIONS_PER_PAGE + 1]
+        if ranks is not None:
+            self.ranks = {question_id: ranks[question_id] for question_id in question_ids}
+        return question_ids
+
+    def fields(self, questions, total):
+        """
+        Returns the formatted questions of the page and the pagination fields of the response.
+        total is called for the number of questions of the listing, when the page reports it.
+        """
+        if not self.by_cursor:
+            return questions, {"totalQuestions": total()}
+        fields = {"next_cursor": None}
+        if len(questions) > QUESTIONS_PER_PAGE:
+            questions = questions[:QUESTIONS_PER_PAGE]
+            last_id = questions[-1]["id"]
+            fields["next_cursor"] = encode_cursor(last_id, self.ranks.get(last_id))
+        if self.counted:
+            fields["totalQuestions"] = total()
+        return questions, fields
+
+
+def count_statement(selection):
+    """
+    Returns the single COUNT of the rows of a select() of Question, without
+    the ORDER BY that only matters for the page itself.
+    """
+    return select(func.count()).select_from(selection.order_by(None).subquery())
+
+
+def paginate(args, selection, total=None, rank=None):
+    """
+    Formats the requested page of a select() of Question, or of a list of question ids.
+    rank is the expression a selection is ranked by or, for a list, the {question id: rank}
+    mapping it is ranked by, as returned by search_questions().
+    Returns the questions and the pagination fields of the response. total counts the
+    questions of selection, with a COUNT query by default.
+    """
+    page = Page(args)
+    if isinstance(selection, list):
+        questions = load_questions(page.ids(selection, rank))
+    else:
+        questions = page.questions(db.session.execute(page.statement(selection, rank)))
+    return page.fields(questions, total or (lambda: count_questions(selection)))
+
+
+def load_questions(question_ids):
+    """
+    Formats the questions of question_ids in the same order
+    """
+    rows = db.session.execute(select(*QUESTION_COLUMNS).where(Question.id.in_(question_ids)))
+    questions = {row.id: format_question_row(row) for row in rows}
+    return [questions[question_id] for question_id in question_ids if question_id in questions]
+
+
+def encode_cursor(question_id, rank=None):
+    """
+    Wraps the id of the last question on a page, and its rank for ranked listings,
+    into an opaque cursor token
+    """
+    position = {"id": question_id} if rank is None else {"rank": rank, "id": question_id}
+    payload = json.dumps(position).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """
+    Returns the (rank, question id) held by a cursor token, with a None rank for unranked listings.
+    Raises ValueError for tokens that were not made by encode_cursor.
+    """
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        question_id = position["id"]
+        rank = position.get("rank")
+    except (TypeError, KeyError, AttributeError, UnicodeDecodeError, json.JSONDecodeError,
+            binascii.Error) as exception:
+        raise ValueError("invalid cursor") from exception
+    if type(question_id) is not int or not (rank is None or type(rank) in (int, float)):
+        raise ValueError("invalid cursor")
+    return rank, question_id
+
+
+def count_questions(selection):
+    """
+    Counts the questions of a select() of Question, or of a list of question ids
+    """
+    if isinstance(selection, list):
+        return len(selection)
+    return db.session.execute(count_statement(selection)).scalar()
 
 
 def populate_database():
     """
-    Populates database on first run
+    Populates database on first run. Raises the database error, after a rollback, when the rows cannot be written.
     """
     categories = [
         Category("Science"),
@@ -65,8 +246,23 @@ def populate_database():
         db.session.bulk_save_objects(categories)
         db.session.bulk_save_objects(questions)
         db.session.commit()
-    except Exception as exception:
-        print(exception)
+    except Exception:
         db.session.rollback()
+        raise
     finally:
-        db.close()
+        db.session.close()
+
+
+@click.command("seed")
+@with_appcontext
+def seed_command():
+    """Fills an empty database with the sample categories and questions."""
+    if Category.query.count() and Question.query.count():
+        click.echo("The database already holds questions, nothing to seed.")
+        return
+    try:
+        populate_database()
+        rebuild_category_stats()
+    except SQLAlchemyError as exception:
+        raise click.ClickException(f"Seeding the database failed: {exception}") from exception
+    click.echo(f"Seeded {Category.query.count()} categories and {Question.query.count()} questions.")